@@ -1,15 +1,22 @@
 """Tests suite for tulflow harvest (Functions for harvesting OAI in Airflow Tasks)."""
 import hashlib
+import threading
+import tracemalloc
 import unittest
+import weakref
 import boto3
 import httpretty
 
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
 from unittest import mock
 from airflow.models import DAG
+from botocore.exceptions import ClientError
 from lxml import etree
 from moto import mock_aws
-from tulflow import harvest
+from tulflow import harvest, harvest_sickle
 
 DEFAULT_DATE = datetime(2019, 8, 16)
 NS = {
@@ -364,6 +371,34 @@ class TestOAIHarvestInteraction(unittest.TestCase):
         self.assertIn(b"<setSpec>dpla_test</setSpec>", xml_output)
         self.assertIn(b"<dcterms:title>lizards</dcterms:title>", xml_output)
 
+    @httpretty.activate
+    @mock.patch("tulflow.harvest_sickle.xml_to_dict")
+    def test_harvest_oai_lazy_metadata(self, mock_xml_to_dict, **kwargs):
+        """Test harvesting & processing records never converts their metadata to a dict."""
+        httpretty.register_uri(
+            httpretty.GET,
+            "http://127.0.0.1/alma/oai",
+            body=marc
+        )
+        kwargs["oai_endpoint"] = "http://127.0.0.1/alma/oai"
+        kwargs["harvest_params"] = {
+            "metadataPrefix": "marc21",
+            "from": None,
+            "until": None
+        }
+
+        records = list(harvest.harvest_oai(**kwargs))
+        self.assertEqual([record.deleted for record in records], [False, True, True])
+        self.assertTrue(records[0].has_metadata)
+        self.assertFalse(hasattr(records[1], "metadata"))
+        harvest.process_xml(records, mock.Mock(), "test-dir", **kwargs)
+        mock_xml_to_dict.assert_not_called()
+
+        mock_xml_to_dict.return_value = {"leader": ["01407nam a2200445 4500"]}
+        self.assertEqual(records[0].metadata, {"leader": ["01407nam a2200445 4500"]})
+        self.assertEqual(records[0].metadata, {"leader": ["01407nam a2200445 4500"]})
+        mock_xml_to_dict.assert_called_once_with(records[0].metadata_element, strip_ns=True)
+
     @httpretty.activate
     def test_harvest_oai_no_records(self, **kwargs):
         """Test Calling OAI-PMH HTTP Endpoint & Returning XML String."""
@@ -531,7 +566,12 @@ class TestOAIHarvestInteraction(unittest.TestCase):
         kwargs["timestamp"] = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
         mock_process.return_value = {"updated": 2, "deleted": 0}
         actual = harvest.oai_to_s3(**kwargs)
-        self.assertEqual(actual, {"updated": 4, "deleted": 0, "sets_with_no_records": []})
+        self.assertEqual(actual, {
+            "updated": 4,
+            "deleted": 0,
+            "sets_with_no_records": [],
+            "set_counts": {"set1": {"updated": 2, "deleted": 0}, "set2": {"updated": 2, "deleted": 0}},
+        })
 
     @mock.patch("tulflow.harvest.harvest_oai")
     @mock.patch("tulflow.harvest.dag_s3_prefix")
@@ -551,7 +591,53 @@ class TestOAIHarvestInteraction(unittest.TestCase):
         mock_process.return_value = {"updated": 0, "deleted": 0}
         actual = harvest.oai_to_s3(**kwargs)
         self.assertFalse(mock_process.called)
-        self.assertEqual(actual, {"updated": 0, "deleted": 0, "sets_with_no_records": ["set1", "set2"]})
+        self.assertEqual(actual, {
+            "updated": 0,
+            "deleted": 0,
+            "sets_with_no_records": ["set1", "set2"],
+            "set_counts": {},
+        })
+
+    @mock.patch("tulflow.harvest_async.oai_to_s3_async")
+    @mock.patch("tulflow.harvest.harvest_oai")
+    def test_oai_to_s3_harvest_partitions(self, mock_harvest, mock_oai_to_s3_async, **kwargs):
+        """Test oai_to_s3 hands date-partitioned harvests to the async engine."""
+        kwargs["oai_endpoint"] = "http://test/combine/oai"
+        kwargs["harvest_from_date"] = "2020-01-01"
+        kwargs["harvest_partitions"] = 4
+        mock_oai_to_s3_async.return_value = {"updated": 2, "deleted": 0, "sets_with_no_records": []}
+        actual = harvest.oai_to_s3(**kwargs)
+        self.assertFalse(mock_harvest.called)
+        mock_oai_to_s3_async.assert_called_once_with(**kwargs)
+        self.assertEqual(actual, {"updated": 2, "deleted": 0, "sets_with_no_records": []})
+
+    def test_partition_date_range_days(self):
+        """Test splitting a day granularity window into contiguous sub-ranges."""
+        ranges = harvest.partition_date_range("2020-01-01", "2020-01-10", 3)
+        self.assertEqual(ranges, [
+            ("2020-01-01", "2020-01-03"),
+            ("2020-01-04", "2020-01-06"),
+            ("2020-01-07", "2020-01-10"),
+        ])
+
+    def test_partition_date_range_seconds(self):
+        """Test splitting a second granularity window, keeping an open until date open."""
+        with mock.patch("tulflow.harvest.datetime", wraps=datetime) as mock_datetime:
+            mock_datetime.now.return_value = datetime(2020, 1, 1, 0, 0, 3)
+            ranges = harvest.partition_date_range("2020-01-01T00:00:00Z", None, 2)
+        self.assertEqual(ranges, [
+            ("2020-01-01T00:00:00Z", "2020-01-01T00:00:01Z"),
+            ("2020-01-01T00:00:02Z", None),
+        ])
+
+    def test_partition_date_range_unsplittable(self):
+        """Test windows that cannot be split are harvested in one request."""
+        self.assertEqual(harvest.partition_date_range(None, "2020-01-10", 3), [(None, "2020-01-10")])
+        self.assertEqual(harvest.partition_date_range("2020-01-01", "2020-01-10", 1), [("2020-01-01", "2020-01-10")])
+        self.assertEqual(
+            harvest.partition_date_range("2020-01-01", "2020-01-02", 5),
+            [("2020-01-01", "2020-01-01"), ("2020-01-02", "2020-01-02")],
+        )
 
     @mock.patch("tulflow.harvest.harvest_oai")
     @mock.patch("tulflow.harvest.dag_s3_prefix")
@@ -568,4 +654,388 @@ class TestOAIHarvestInteraction(unittest.TestCase):
         kwargs["timestamp"] = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
         mock_process.return_value = {"updated": 2, "deleted": 0}
         actual = harvest.oai_to_s3(**kwargs)
-        self.assertEqual(actual, {"updated": 2, "deleted": 0, "sets_with_no_records": []})
\ No newline at end of file
+        self.assertEqual(actual, {"updated": 2, "deleted": 0, "sets_with_no_records": [], "set_counts": {}})
+
+    @mock.patch("tulflow.harvest.harvest_oai")
+    @mock.patch("tulflow.harvest.dag_s3_prefix")
+    @mock.patch("tulflow.harvest.process_xml")
+    def test_oai_to_s3_harvest_no_set_not_process_empty_data(self, mock_process, _mock_prefix, mock_harvest, **kwargs):
+        """Test oai_to_s3 does not process an empty harvest of all sets."""
+        dag = DAG(dag_id="test_slacksuccess", start_date=DEFAULT_DATE)
+        kwargs["oai_endpoint"] = "http://test/combine/oai"
+        kwargs["metadataPrefix"] = "blergh"
+        kwargs["all_sets"] = True
+        kwargs["dag"] = dag
+        kwargs["timestamp"] = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        mock_harvest.return_value = []
+        actual = harvest.oai_to_s3(**kwargs)
+        self.assertFalse(mock_process.called)
+        self.assertEqual(actual, {"updated": 0, "deleted": 0, "sets_with_no_records": [None], "set_counts": {}})
+
+def oai_records(count, deleted=()):
+    """Build harvested-record stand-ins: a header identifier & an OAI record element."""
+    records = []
+    for index in range(count):
+        record = etree.fromstring(
+            '<record xmlns="http://www.openarchives.org/OAI/2.0/">'
+            + ('<header status="deleted">' if index in deleted else "<header>")
+            + f"<identifier>oai:{index}</identifier></header></record>"
+        )
+        records.append(SimpleNamespace(header=SimpleNamespace(identifier=f"oai:{index}"), xml=record))
+    return records
+
+
+class TestChunkSizing(unittest.TestCase):
+    """Test Class for cutting process_xml chunks by serialized size."""
+
+    def test_process_xml_chunk_bytes(self):
+        """Test chunks are cut once their records reach chunk_bytes, capped by records_per_file."""
+        records = oai_records(60)
+        for index, record in enumerate(records):
+            # Record sizes vary from about 100 bytes to about 4 KB.
+            etree.SubElement(record.xml, "{http://www.openarchives.org/OAI/2.0/}about").text = (
+                "x" * (4000 if index % 10 == 0 else 10)
+            )
+        writer = mock.Mock()
+        processed = harvest.process_xml(
+            records, writer, "test-dir", chunk_bytes=5000, records_per_file=25
+        )
+        self.assertEqual(processed, {"updated": 60, "deleted": 0})
+        chunks = [call.args[0] for call in writer.call_args_list if call.args[1] == "test-dir/new-updated"]
+        sizes = [chunk.count("airflow-record-id") for chunk in chunks]
+        self.assertEqual(sum(sizes), 60)
+        self.assertLess(max(sizes), 25)
+        for chunk in chunks[:-1]:
+            # Cut once past the target, so at most one record over it.
+            self.assertGreaterEqual(len(chunk.encode("utf-8")), 5000)
+            self.assertLess(len(chunk.encode("utf-8")), 5000 + 4500)
+        processed = harvest.process_xml(
+            oai_records(60), writer, "test-dir", chunk_bytes=10 ** 6, records_per_file=25
+        )
+        sizes = [call.args[0].count("airflow-record-id") for call in writer.call_args_list[-3:]]
+        self.assertEqual(sizes, [25, 25, 10])
+
+    def test_oai_xml_nbytes(self):
+        """Test OaiXml tracks the serialized size of its records."""
+        collection = harvest.OaiXml("test_dag", "2019-08-30")
+        for record in oai_records(3):
+            record.xml.attrib["airflow-record-id"] = record.header.identifier
+            collection.append(record.xml)
+        self.assertGreater(collection.nbytes, 0)
+        self.assertEqual(collection.nbytes, len(b"".join(collection.records)))
+
+
+class TestCompactS3Chunks(unittest.TestCase):
+    """Test Class for merging small harvested chunks in S3."""
+
+    @mock_aws
+    def test_oai_to_s3_compacts_small_set_outputs(self):
+        """Test many small per-set chunks are merged into size-targeted files, counts kept."""
+        conn = boto3.client("s3", aws_access_key_id="kittens", aws_secret_access_key="puppies")
+        conn.create_bucket(Bucket="test-bucket")
+        oai_sets = [f"set{number}" for number in range(6)]
+
+        def harvest_set(**kwargs):
+            number = int(kwargs["harvest_params"]["set"][3:])
+            return [
+                SimpleNamespace(header=record.header, xml=record.xml)
+                for record in oai_records(number * 3 + 3)[number * 3:]
+            ]
+
+        kwargs = {
+            "included_sets": oai_sets,
+            "dag": mock.Mock(dag_id="test_dag"),
+            "timestamp": "2019-08-30",
+            "bucket_name": "test-bucket",
+            "access_id": "kittens",
+            "access_secret": "puppies",
+            "compact_bytes": 1000,
+        }
+        with mock.patch("tulflow.harvest.harvest_oai", side_effect=harvest_set):
+            with self.assertLogs() as log:
+                actual = harvest.oai_to_s3(**kwargs)
+        self.assertEqual(actual["updated"], 18)
+        self.assertEqual(actual["set_counts"]["set5"], {"updated": 3, "deleted": 0})
+        self.assertIn("INFO:root:Set set5: 3 updated, 0 deleted", log.output)
+        objects = conn.list_objects_v2(Bucket="test-bucket", Prefix="test_dag/2019-08-30/")["Contents"]
+        # Six chunks of three records (about 450 bytes each), merged pairwise; no deleted chunks.
+        self.assertEqual(len(objects), 3)
+        record_ids = []
+        for item in objects:
+            self.assertTrue(item["Key"].startswith("test_dag/2019-08-30/new-updated/"))
+            body = conn.get_object(Bucket="test-bucket", Key=item["Key"])["Body"].read()
+            collection = etree.fromstring(body)
+            self.assertEqual(collection.get("dag-id"), "test_dag")
+            record_ids.extend(record.get("airflow-record-id") for record in collection)
+        self.assertEqual(sorted(record_ids, key=lambda id: int(id[4:])), [f"oai:{n}" for n in range(18)])
+
+
+class TestRunManifest(unittest.TestCase):
+    """Test Class for the run manifest & record index written by the harvest."""
+
+    def harvest(self, conn, **extra):
+        """Harvest six sets of three records (one deleted) with a run manifest."""
+        conn.create_bucket(Bucket="test-bucket")
+
+        def harvest_set(**kwargs):
+            number = int(kwargs["harvest_params"]["set"][3:])
+            return [
+                SimpleNamespace(header=record.header, xml=record.xml)
+                for record in oai_records(number * 3 + 3, deleted=[1])[number * 3:]
+            ]
+
+        kwargs = {
+            "included_sets": [f"set{number}" for number in range(6)],
+            "dag": mock.Mock(dag_id="test_dag"),
+            "timestamp": "2019-08-30",
+            "bucket_name": "test-bucket",
+            "access_id": "kittens",
+            "access_secret": "puppies",
+            "write_manifest": True,
+            **extra,
+        }
+        with mock.patch("tulflow.harvest.harvest_oai", side_effect=harvest_set):
+            with self.assertLogs():
+                actual = harvest.oai_to_s3(**kwargs)
+        self.assertEqual(actual["manifest"], "test_dag/2019-08-30/manifest.json")
+        manifest = harvest.load_manifest("test-bucket", actual["manifest"], "kittens", "puppies")
+        return actual, manifest
+
+    def assert_manifest_matches_s3(self, conn, manifest):
+        """Every chunk & record in the manifest matches the objects in S3."""
+        objects = conn.list_objects_v2(Bucket="test-bucket", Prefix="test_dag/2019-08-30/")["Contents"]
+        sizes = {item["Key"]: item["Size"] for item in objects}
+        del sizes["test_dag/2019-08-30/manifest.json"]
+        self.assertEqual(dict(manifest.chunk_sizes()), sizes)
+        for chunk in manifest.to_dict()["chunks"]:
+            body = conn.get_object(Bucket="test-bucket", Key=chunk["key"])["Body"].read()
+            self.assertEqual(chunk["md5"], hashlib.md5(body).hexdigest())
+            self.assertEqual(chunk["record_count"], len(etree.fromstring(body)))
+        locations = manifest.record_locations()
+        self.assertEqual(sorted(locations), sorted(f"oai:{number}" for number in range(18)))
+        for record_id, location in locations.items():
+            record = manifest.record_element(
+                harvest.get_s3_record("test-bucket", location, "kittens", "puppies")
+            )
+            self.assertEqual(record.get("airflow-record-id"), record_id)
+            self.assertEqual(record.findtext("oai:header/oai:identifier", namespaces=NS), record_id)
+
+    @mock_aws
+    def test_oai_to_s3_writes_manifest(self):
+        """Test the manifest lists every chunk written, and locates every record in them."""
+        conn = boto3.client("s3", aws_access_key_id="kittens", aws_secret_access_key="puppies")
+        actual, manifest = self.harvest(conn)
+        self.assertEqual((actual["updated"], actual["deleted"]), (17, 1))
+        self.assertEqual(len(manifest.chunk_sizes("test_dag/2019-08-30/new-updated/")), 6)
+        self.assertEqual(len(manifest.chunk_sizes("test_dag/2019-08-30/deleted/")), 1)
+        self.assert_manifest_matches_s3(conn, manifest)
+
+    @mock_aws
+    def test_oai_to_s3_manifest_after_compaction(self):
+        """Test compacted chunks are replaced in the manifest, their record offsets shifted."""
+        conn = boto3.client("s3", aws_access_key_id="kittens", aws_secret_access_key="puppies")
+        _, manifest = self.harvest(conn, compact_bytes=1000)
+        self.assertEqual(len(manifest.chunk_sizes("test_dag/2019-08-30/new-updated/")), 3)
+        self.assert_manifest_matches_s3(conn, manifest)
+
+    def test_process_xml_without_manifest(self):
+        """Test chunks are unchanged & no manifest is kept unless one is asked for."""
+        writer = mock.Mock()
+        harvest.process_xml(oai_records(3), writer, "test_dag/2019-08-30")
+        manifest = harvest.RunManifest("test_dag/2019-08-30")
+        harvest.process_xml(oai_records(3), writer, "test_dag/2019-08-30", manifest=manifest)
+        self.assertEqual(writer.call_args_list[0][0], writer.call_args_list[1][0])
+        chunk, prefix = writer.call_args_list[1][0]
+        self.assertEqual(manifest.chunk_sizes(), [(harvest.chunk_key(chunk, prefix), len(chunk))])
+
+
+class TestBackgroundWriter(unittest.TestCase):
+    """Test Class for uploading process_xml chunks in the background."""
+
+    def test_process_xml_overlaps_writes(self):
+        """Test harvesting carries on while a chunk is being written."""
+        started = threading.Event()
+        release = threading.Event()
+        written = []
+
+        def slow_writer(string, prefix, **_kwargs):
+            started.set()
+            release.wait(5)
+            written.append((prefix, string.count("airflow-record-id")))
+
+        def data():
+            records = oai_records(5, deleted=[4])
+            yield from records[:3]
+            # The first chunk (two records) is uploading, yet the next record is consumed.
+            self.assertTrue(started.wait(5))
+            self.assertFalse(release.is_set())
+            release.set()
+            yield from records[3:]
+
+        processed = harvest.process_xml(
+            data(), slow_writer, "test-dir", records_per_file=2, max_pending_writes=1
+        )
+        self.assertEqual(processed, {"updated": 4, "deleted": 1})
+        self.assertEqual(written, [
+            ("test-dir/new-updated", 2),
+            ("test-dir/new-updated", 2),
+            ("test-dir/deleted", 1),
+        ])
+
+    def test_process_xml_background_matches_sync(self):
+        """Test background writes produce exactly the chunks & counts of synchronous writes."""
+        sync_writer = mock.Mock()
+        background_writer = mock.Mock()
+        records = oai_records(7, deleted=[1, 5])
+        sync = harvest.process_xml(records, sync_writer, "test-dir", records_per_file=2)
+        records = oai_records(7, deleted=[1, 5])
+        background = harvest.process_xml(
+            records, background_writer, "test-dir", records_per_file=2, max_pending_writes=2
+        )
+        self.assertEqual(sync, {"updated": 5, "deleted": 2})
+        self.assertEqual(background, sync)
+        self.assertEqual(
+            [call.args for call in background_writer.call_args_list],
+            [call.args for call in sync_writer.call_args_list],
+        )
+
+    def test_process_xml_write_error_fails(self):
+        """Test a failed background upload still fails the run."""
+        writer = mock.Mock(side_effect=[None, IOError("S3 is down")])
+        with self.assertLogs(level="ERROR") as log:
+            with self.assertRaisesRegex(IOError, "S3 is down"):
+                harvest.process_xml(
+                    oai_records(3), writer, "test-dir", records_per_file=1, max_pending_writes=1
+                )
+        self.assertIn("ERROR:root:Writing chunk to test-dir/new-updated failed: S3 is down", log.output)
+
+    @mock_aws
+    def test_process_xml_s3_write_error_fails(self):
+        """Test a background S3 upload failing (here, a missing bucket) fails the run."""
+        kwargs = {
+            "bucket_name": "missing-bucket",
+            "access_id": "kittens",
+            "access_secret": "puppies",
+            "records_per_file": 1,
+            "max_pending_writes": 1,
+        }
+        with self.assertLogs(level="ERROR") as log:
+            with self.assertRaisesRegex(ClientError, "NoSuchBucket"):
+                harvest.process_xml(oai_records(3), harvest.dag_write_string_to_s3, "test-dir", **kwargs)
+        self.assertTrue(any("Writing chunk to test-dir/new-updated failed" in line for line in log.output))
+
+    def test_background_writer_backpressure(self):
+        """Test calls block once max_pending chunks are waiting for upload."""
+        release = threading.Event()
+        writer = harvest.BackgroundWriter(lambda *args, **kwargs: release.wait(5), max_pending=1)
+        writer("in flight", "prefix")
+        writer("queued", "prefix")
+        blocked = threading.Thread(target=writer, args=("blocked", "prefix"))
+        blocked.start()
+        blocked.join(0.2)
+        self.assertTrue(blocked.is_alive())
+        release.set()
+        blocked.join(5)
+        self.assertFalse(blocked.is_alive())
+        writer.close()
+
+
+class MockOaiPager(BaseHTTPRequestHandler):
+    """Stand-in OAI-PMH endpoint serving `pages` pages of 200 MARC records each."""
+    pages = 1
+    field = '<datafield tag="500" ind1=" " ind2=" "><subfield code="a">' + "x" * 60 + "</subfield></datafield>"
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        page = int(parse_qs(urlparse(self.path).query).get("resumptionToken", ["0"])[0])
+        records = "".join(
+            f"<record><header><identifier>oai:{page}:{index}</identifier></header><metadata>"
+            f'<record xmlns="http://www.loc.gov/MARC21/slim"><controlfield tag="001">{index}</controlfield>'
+            f"{self.field * 40}</record></metadata></record>"
+            for index in range(200)
+        )
+        token = page + 1 if page + 1 < self.pages else ""
+        body = (
+            '<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"><ListRecords>'
+            f"{records}<resumptionToken>{token}</resumptionToken></ListRecords></OAI-PMH>"
+        ).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_args):  # pylint: disable=arguments-differ
+        pass
+
+
+class TestHarvestMemory(unittest.TestCase):
+    """Memory regression tests: harvested pages & processed records must not be retained."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), MockOaiPager)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.endpoint = f"http://127.0.0.1:{cls.server.server_port}/oai"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def harvest_pages(self, pages, records_per_file):
+        """Harvest & process `pages` pages, returning (peak traced MB growth, output MB, most
+        harvested pages alive at once).
+
+        tracemalloc counts Python allocations: the pages' content & the serialized records.
+        Pages are also followed by weakref, counted alive whenever a chunk is written.
+        """
+        MockOaiPager.pages = pages
+        written = []
+        responses = []
+        most_alive = []
+        harvest_page = harvest_sickle.HarvestSickle.harvest
+
+        def tracked_harvest(client, **kwargs):
+            response = harvest_page(client, **kwargs)
+            responses.append(weakref.ref(response))
+            return response
+
+        def writer(string, prefix, **kwargs):
+            written.append(len(string))
+            most_alive.append(sum(1 for response in responses if response() is not None))
+
+        tracemalloc.start()
+        try:
+            baseline = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            with mock.patch.object(harvest_sickle.HarvestSickle, "harvest", tracked_harvest):
+                with self.assertNoLogs(level="WARNING"):
+                    harvest.process_xml(
+                        harvest.harvest_oai(oai_endpoint=self.endpoint, harvest_params={"metadataPrefix": "marc21"}),
+                        writer,
+                        "test-dir",
+                        records_per_file=records_per_file,
+                    )
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        # Full chunks, then the final new-updated chunk if any records are left; no deleted chunk.
+        self.assertEqual(len(written), -(-pages * 200 // records_per_file))
+        self.assertEqual(len(responses), pages)
+        return (peak - baseline) / 2 ** 20, sum(written) / 2 ** 20, max(most_alive)
+
+    def test_memory_flat_across_pages(self):
+        """Test peak memory does not grow with the number of harvested pages, and each page
+        is freed once the next one is harvested."""
+        small_growth, _, _ = self.harvest_pages(5, records_per_file=200)
+        growth, output, most_alive = self.harvest_pages(40, records_per_file=200)
+        self.assertGreater(output, 40)
+        self.assertLess(growth, small_growth + 5)
+        self.assertLessEqual(most_alive, 2)
+
+    def test_memory_bounded_by_chunk_output(self):
+        """Test records are held serialized, not as trees, while a chunk fills."""
+        growth, output, most_alive = self.harvest_pages(20, records_per_file=10 ** 6)
+        # The serialized records, then the chunk joined & decoded from them for the final write:
+        # about three times the output. Retaining each page's content would add another one.
+        self.assertLess(growth, 3.5 * output)
+        self.assertLessEqual(most_alive, 2)
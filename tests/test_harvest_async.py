@@ -0,0 +1,248 @@
+"""Tests suite for tulflow harvest_async (asyncio OAI-PMH harvest engine)."""
+import asyncio
+import unittest
+import aiohttp
+
+from unittest import mock
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from tulflow import harvest_async
+
+OAI_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">
+    <responseDate>2019-08-30T13:46:14Z</responseDate>
+    <request verb="ListRecords">http://127.0.0.1/combine/oai</request>
+"""
+
+page_one = OAI_HEADER + """
+    <ListRecords>
+        <record>
+            <header><identifier>oai:cats</identifier></header>
+            <metadata><oai_dc:dc xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/">cats</oai_dc:dc></metadata>
+        </record>
+        <record>
+            <header><identifier>oai:no-metadata</identifier></header>
+        </record>
+        <record>
+            <header status="deleted"><identifier>oai:gone</identifier></header>
+        </record>
+        <resumptionToken>page-two</resumptionToken>
+    </ListRecords>
+</OAI-PMH>
+"""
+
+page_two = OAI_HEADER + """
+    <ListRecords>
+        <record>
+            <header><identifier>oai:dogs</identifier></header>
+            <metadata><oai_dc:dc xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/">dogs</oai_dc:dc></metadata>
+        </record>
+        <resumptionToken></resumptionToken>
+    </ListRecords>
+</OAI-PMH>
+"""
+
+no_records = OAI_HEADER + """
+    <error code="noRecordsMatch">No records.</error>
+</OAI-PMH>
+"""
+
+
+def records_page(*identifiers, datestamp="2020-01-01"):
+    """Build a single ListRecords page holding the given record identifiers."""
+    records = "".join(
+        f"""<record><header><identifier>{identifier}</identifier><datestamp>{datestamp}</datestamp>
+        </header>
+        <metadata><oai_dc:dc xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/"/></metadata></record>"""
+        for identifier in identifiers
+    )
+    return OAI_HEADER + f"<ListRecords>{records}</ListRecords></OAI-PMH>"
+
+
+list_sets = OAI_HEADER + """
+    <ListSets>
+        <set><setSpec>a</setSpec><setName>A</setName></set>
+        <set><setSpec>b</setSpec><setName>B</setName></set>
+        <set><setSpec>x</setSpec><setName>X</setName></set>
+    </ListSets>
+</OAI-PMH>
+"""
+
+
+class MockOaiEndpoint:
+    """Local aiohttp OAI-PMH endpoint with optional failures before succeeding."""
+
+    def __init__(self, failures=0, status=503, retry_after="0"):
+        self.failures = failures
+        self.status = status
+        self.retry_after = retry_after
+        self.requests = []
+
+    async def handle(self, request):
+        self.requests.append(dict(request.query))
+        if self.failures:
+            self.failures -= 1
+            return web.Response(status=self.status, headers={"Retry-After": self.retry_after})
+        if request.query.get("verb") == "ListSets":
+            body = list_sets
+        elif request.query.get("set") == "empty":
+            body = no_records
+        elif request.query.get("set") == "ranged":
+            # Record oai:moved changed mid-harvest, so both date ranges return it; the
+            # older copy is returned last.
+            if request.query.get("from") == "2020-01-01":
+                await asyncio.sleep(0.1)
+                body = records_page("oai:one", "oai:moved", datestamp="2020-01-02")
+            else:
+                body = records_page("oai:moved", "oai:two", datestamp="2020-01-04")
+        elif request.query.get("resumptionToken") == "page-two":
+            body = page_two
+        else:
+            body = page_one
+        return web.Response(text=body, content_type="text/xml")
+
+    def server(self):
+        app = web.Application()
+        app.router.add_get("/oai", self.handle)
+        return TestServer(app)
+
+
+class TestAsyncOaiClient(unittest.IsolatedAsyncioTestCase):
+    """Test Class for the asyncio OAI-PMH client."""
+
+    async def asyncSetUp(self):
+        self.endpoint = MockOaiEndpoint()
+        self.server = self.endpoint.server()
+        await self.server.start_server()
+        self.url = str(self.server.make_url("/oai"))
+
+    async def asyncTearDown(self):
+        await self.server.close()
+
+    async def test_list_records_follows_resumption_tokens(self):
+        """Test records are harvested across pages, skipping records without metadata."""
+        async with harvest_async.AsyncOaiClient(self.url) as client:
+            records = [record async for record in client.list_records(metadataPrefix="dc", until=None)]
+        identifiers = [record.header.identifier for record in records]
+        self.assertEqual(identifiers, ["oai:cats", "oai:gone", "oai:dogs"])
+        self.assertTrue(records[1].deleted)
+        self.assertEqual(self.endpoint.requests[0], {"verb": "ListRecords", "metadataPrefix": "dc"})
+        self.assertEqual(self.endpoint.requests[1], {"verb": "ListRecords", "resumptionToken": "page-two"})
+
+    async def test_list_records_ignore_deleted(self):
+        """Test deleted records are skipped when asked to."""
+        async with harvest_async.AsyncOaiClient(self.url, ignore_deleted=True) as client:
+            records = [record async for record in client.list_records(metadataPrefix="dc")]
+        self.assertEqual([record.header.identifier for record in records], ["oai:cats", "oai:dogs"])
+
+    async def test_retry_honours_retry_after(self):
+        """Test retrying on a 503 with the server's Retry-After header."""
+        self.endpoint.failures = 2
+        async with harvest_async.AsyncOaiClient(self.url) as client:
+            with mock.patch("asyncio.sleep") as mock_sleep:
+                records = [record async for record in client.list_records(metadataPrefix="dc")]
+        self.assertEqual(len(records), 3)
+        self.assertEqual(mock_sleep.call_args_list, [mock.call(0), mock.call(0)])
+
+    async def test_retry_backoff_without_retry_after(self):
+        """Test retrying with exponential backoff, then failing once retries run out."""
+        self.endpoint.failures = 5
+        self.endpoint.status = 504
+        self.endpoint.retry_after = ""
+        async with harvest_async.AsyncOaiClient(self.url, max_retries=2) as client:
+            with mock.patch("asyncio.sleep") as mock_sleep:
+                with self.assertRaises(aiohttp.ClientResponseError):
+                    await client.harvest(verb="ListRecords")
+        self.assertEqual(mock_sleep.call_args_list, [mock.call(2), mock.call(4)])
+
+    async def test_harvest_oai_async_no_records(self):
+        """Test noRecordsMatch yields no records rather than raising."""
+        kwargs = {"harvest_params": {"metadataPrefix": "dc", "set": "empty"}}
+        async with harvest_async.AsyncOaiClient(self.url) as client:
+            records = [record async for record in harvest_async.harvest_oai_async(client, **kwargs)]
+        self.assertEqual(records, [])
+
+    async def test_generate_oai_sets_async_excluded(self):
+        """Test excluded sets are removed from the asynchronously listed sets."""
+        async with harvest_async.AsyncOaiClient(self.url) as client:
+            oai_sets = await harvest_async.generate_oai_sets_async(client, excluded_sets=["x"])
+        self.assertEqual(sorted(oai_sets), ["a", "b"])
+
+    async def test_process_xml_async(self):
+        """Test process_xml consuming the async stream of records."""
+        writer = mock.Mock()
+        kwargs = {"harvest_params": {"metadataPrefix": "dc"}}
+        async with harvest_async.AsyncOaiClient(self.url) as client:
+            records = harvest_async.harvest_oai_async(client, **kwargs)
+            processed = await harvest_async.process_xml_async(records, writer, "test-dir", **kwargs)
+        self.assertEqual(processed, {"updated": 2, "deleted": 1})
+        prefixes = [call.args[1] for call in writer.call_args_list]
+        self.assertEqual(prefixes, ["test-dir/new-updated", "test-dir/deleted"])
+        self.assertIn('airflow-record-id="oai:dogs"', writer.call_args_list[0].args[0])
+
+    @mock.patch("tulflow.harvest.dag_write_string_to_s3")
+    async def test_harvest_to_s3_async_sets(self, mock_writer):
+        """Test harvesting several sets concurrently over one session."""
+        kwargs = {
+            "oai_endpoint": self.url,
+            "metadata_prefix": "dc",
+            "included_sets": ["a", "empty", "b"],
+            "dag": mock.Mock(dag_id="test_dag"),
+            "timestamp": "2019-08-30",
+        }
+        async with aiohttp.ClientSession() as session:
+            actual = await harvest_async.harvest_to_s3_async(session, **kwargs)
+        self.assertEqual(actual, {
+            "updated": 4,
+            "deleted": 2,
+            "sets_with_no_records": ["empty"],
+            "set_counts": {"a": {"updated": 2, "deleted": 1}, "b": {"updated": 2, "deleted": 1}},
+        })
+        self.assertEqual(mock_writer.call_count, 4)
+        self.assertEqual(mock_writer.call_args.args[1].split("/")[:2], ["test_dag", "2019-08-30"])
+
+    @mock.patch("tulflow.harvest.dag_write_string_to_s3")
+    async def test_harvest_to_s3_async_partitions(self, mock_writer):
+        """Test splitting the from/until window, merging counts & de-duplicating records."""
+        kwargs = {
+            "oai_endpoint": self.url,
+            "metadata_prefix": "dc",
+            "included_sets": ["ranged"],
+            "harvest_from_date": "2020-01-01",
+            "harvest_until_date": "2020-01-04",
+            "harvest_partitions": 2,
+            "dag": mock.Mock(dag_id="test_dag"),
+            "timestamp": "2019-08-30",
+        }
+        with self.assertLogs() as log:
+            actual = await harvest_async.harvest_to_s3_async(**kwargs)
+        self.assertEqual(actual, {
+            "updated": 3,
+            "deleted": 0,
+            "sets_with_no_records": [],
+            "set_counts": {"ranged": {"updated": 3, "deleted": 0}},
+        })
+        self.assertIn("INFO:root:Skipping duplicate record oai:moved", log.output)
+        ranges = sorted((query["from"], query["until"]) for query in self.endpoint.requests)
+        self.assertEqual(ranges, [("2020-01-01", "2020-01-02"), ("2020-01-03", "2020-01-04")])
+        written = "".join(call.args[0] for call in mock_writer.call_args_list)
+        self.assertEqual(written.count('airflow-record-id="oai:moved"'), 1)
+        self.assertNotIn("<datestamp>2020-01-02</datestamp>", written)
+
+    async def test_unique_records_keeps_newest_datestamp(self):
+        """Test the newest copy of a duplicated record is kept whichever arrives first."""
+        def record(datestamp):
+            return mock.Mock(header=mock.Mock(identifier="oai:moved", datestamp=datestamp))
+
+        async def stream(*records):
+            for item in records:
+                yield item
+
+        older, newer, same = record("2020-01-02"), record("2020-01-04"), record("2020-01-04")
+        for records, expected in [
+                ((newer, older, same), [newer]),
+                ((older, newer, same), [older, newer]),
+        ]:
+            with self.subTest(records=[item.header.datestamp for item in records]):
+                kept = [item async for item in harvest_async.unique_records(stream(*records), {})]
+                self.assertEqual(kept, expected)
@@ -0,0 +1,46 @@
+"""Tests suite for tulflow import time (modules DAG files import at every parse)."""
+import re
+import subprocess
+import sys
+import unittest
+
+# Modules DAG files import, & the heavy dependencies they must leave to first use.
+DAG_PARSE_MODULES = [
+    "tulflow.tasks",
+    "tulflow.harvest",
+    "tulflow.process",
+    "tulflow.transform",
+    "tulflow.validate",
+]
+HEAVY_MODULES = ["airflow", "pandas", "sickle", "boto3", "requests"]
+# Cumulative import time budget (microseconds); eagerly importing Airflow alone takes seconds.
+IMPORT_BUDGET = 500000
+
+
+def import_times(module):
+    """Cumulative `python -X importtime` microseconds per module, importing one module in a
+    fresh interpreter, and the heavy modules it left imported."""
+    code = f"import sys, {module}; print(*sorted(set(sys.modules) & {set(HEAVY_MODULES)!r}))"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \| (\s*)(\S+)", line)
+        if match and not match.group(2):
+            times[match.group(3)] = int(match.group(1))
+    return times, result.stdout.split()
+
+
+class TestImportTime(unittest.TestCase):
+    """Test Class for keeping tulflow cheap to import at DAG parse time."""
+
+    def test_dag_parse_imports_are_light(self):
+        for module in DAG_PARSE_MODULES:
+            with self.subTest(module=module):
+                times, heavy = import_times(module)
+                self.assertEqual(heavy, [])
+                self.assertLess(times[module], IMPORT_BUDGET)
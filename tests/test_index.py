@@ -0,0 +1,219 @@
+"""Tests suite for tulflow index (bulk indexing XML records into Solr)."""
+import io
+import json
+import threading
+import unittest
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import boto3
+import requests
+from lxml import etree
+from airflow.models import Connection
+from moto import mock_aws
+from tulflow import harvest, index
+
+
+class MockSolrUpdate(BaseHTTPRequestHandler):
+    """Stand-in Solr /update handler recording posted JSON bodies."""
+    failures = 0
+    status = 503
+    bodies = []
+    params = []
+    lock = threading.Lock()
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        with self.lock:
+            failed = MockSolrUpdate.failures > 0
+            if failed:
+                MockSolrUpdate.failures -= 1
+            else:
+                MockSolrUpdate.bodies.append(json.loads(body))
+                MockSolrUpdate.params.append(parse_qs(urlparse(self.path).query))
+        if failed:
+            response = json.dumps({"error": {"msg": "Solr is busy"}}).encode("utf-8")
+            self.send_response(MockSolrUpdate.status)
+        else:
+            response = b'{"responseHeader": {"status": 0}}'
+            self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *_args):  # pylint: disable=arguments-differ
+        pass
+
+
+def transformed_xml(start, count):
+    """Build a transformed XML file of `count` records, as transform_s3_xsl writes them."""
+    records = "".join(
+        f'<record airflow-record-id="rec-{number}"><title>Title {number}</title>'
+        f"<subject>cats</subject><subject>dogs</subject></record>"
+        for number in range(start, start + count)
+    )
+    return f'<collection dag-id="test_dag">{records}</collection>'
+
+
+def deleted_xml(start, count):
+    """Build a harvested deleted records chunk, as process_xml writes them."""
+    collection = harvest.OaiXml("test_dag", "2019-08-30")
+    for number in range(start, start + count):
+        record = etree.fromstring(
+            '<record xmlns="http://www.openarchives.org/OAI/2.0/"><header status="deleted">'
+            f"<identifier>oai:{number}</identifier></header></record>"
+        )
+        record.attrib["airflow-record-id"] = f"oai:{number}"
+        collection.append(record)
+    return collection.tostring()
+
+
+class TestSolrIndexer(unittest.TestCase):
+    """Test Class for the bulk Solr indexer, against a local stand-in Solr."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), MockSolrUpdate)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.solr_url = f"http://127.0.0.1:{cls.server.server_port}/solr/test-collection"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        MockSolrUpdate.failures = 0
+        MockSolrUpdate.status = 503
+        MockSolrUpdate.bodies = []
+        MockSolrUpdate.params = []
+
+    def test_record_to_solr_doc(self):
+        record = etree.fromstring(
+            '<record airflow-record-id="oai:1"><title>Cats</title><subject>a</subject>'
+            '<subject>b</subject><!-- note --><field name="format">Book</field></record>'
+        )
+        self.assertEqual(index.record_to_solr_doc(record), {
+            "title": "Cats",
+            "subject": ["a", "b"],
+            "format": "Book",
+            "id": "oai:1",
+        })
+
+    def test_iter_xml_records(self):
+        source = io.BytesIO(transformed_xml(0, 3).encode("utf-8"))
+        ids = [record.get("airflow-record-id") for record in index.iter_xml_records(source)]
+        self.assertEqual(ids, ["rec-0", "rec-1", "rec-2"])
+
+    def test_index_batches(self):
+        indexer = index.SolrIndexer(self.solr_url, batch_size=100, concurrency=3, commit_within=5000)
+        with self.assertLogs() as log:
+            stats = indexer.index({"id": str(number)} for number in range(1050))
+        self.assertEqual(stats["documents"], 1050)
+        self.assertEqual(stats["requests"], 11)
+        self.assertGreater(stats["docs_per_second"], 0)
+        self.assertIn("docs/sec", log.output[0])
+        ids = sorted(int(doc["id"]) for body in MockSolrUpdate.bodies for doc in body)
+        self.assertEqual(ids, list(range(1050)))
+        self.assertEqual(sorted(len(body) for body in MockSolrUpdate.bodies)[0], 50)
+        for params in MockSolrUpdate.params:
+            self.assertEqual(params, {"commitWithin": ["5000"], "wt": ["json"]})
+
+    def test_index_retries_failed_batches(self):
+        MockSolrUpdate.failures = 2
+        indexer = index.SolrIndexer(self.solr_url, batch_size=10, concurrency=1, backoff_factor=0)
+        stats = indexer.index({"id": str(number)} for number in range(25))
+        self.assertEqual(stats["documents"], 25)
+        self.assertEqual(sum(len(body) for body in MockSolrUpdate.bodies), 25)
+
+    def test_index_raises_once_retries_run_out(self):
+        MockSolrUpdate.failures = 10
+        MockSolrUpdate.status = 500
+        indexer = index.SolrIndexer(self.solr_url, batch_size=10, max_retries=1, backoff_factor=0)
+        with self.assertRaisesRegex(requests.exceptions.HTTPError, "Solr is busy"):
+            indexer.index({"id": str(number)} for number in range(25))
+
+    @mock_aws
+    def test_s3_to_solr(self):
+        conn = boto3.client("s3", aws_access_key_id="kittens", aws_secret_access_key="puppies")
+        conn.create_bucket(Bucket="test-bucket")
+        conn.put_object(Bucket="test-bucket", Key="dag/transformed/1.xml", Body=transformed_xml(0, 150))
+        conn.put_object(Bucket="test-bucket", Key="dag/transformed/2.xml", Body=transformed_xml(150, 80))
+        kwargs = {
+            "bucket": "test-bucket",
+            "source_prefix": "dag/transformed",
+            "access_id": "kittens",
+            "access_secret": "puppies",
+            "solr_url": self.solr_url,
+            "batch_size": 100,
+        }
+        stats = index.s3_to_solr(**kwargs)
+        self.assertEqual(stats["documents"], 230)
+        self.assertEqual(stats["requests"], 3)
+        docs = {doc["id"]: doc for body in MockSolrUpdate.bodies for doc in body}
+        self.assertEqual(len(docs), 230)
+        self.assertEqual(docs["rec-229"], {
+            "id": "rec-229",
+            "title": "Title 229",
+            "subject": ["cats", "dogs"],
+        })
+
+    @mock_aws
+    def test_s3_to_solr_doc_builder(self):
+        conn = boto3.client("s3", aws_access_key_id="kittens", aws_secret_access_key="puppies")
+        conn.create_bucket(Bucket="test-bucket")
+        conn.put_object(Bucket="test-bucket", Key="dag/transformed/1.xml", Body=transformed_xml(0, 5))
+        kwargs = {
+            "bucket": "test-bucket",
+            "source_prefix": "dag/transformed",
+            "solr_url": self.solr_url,
+            "doc_builder": lambda record: {"id": record.get("airflow-record-id").upper()},
+        }
+        index.s3_to_solr(**kwargs)
+        self.assertEqual(MockSolrUpdate.bodies, [[{"id": f"REC-{number}"} for number in range(5)]])
+
+    @mock_aws
+    def test_s3_deletes_to_solr(self):
+        conn = boto3.client("s3", aws_access_key_id="kittens", aws_secret_access_key="puppies")
+        conn.create_bucket(Bucket="test-bucket")
+        for number in range(3):
+            conn.put_object(
+                Bucket="test-bucket",
+                Key=f"test_dag/2019-08-30/deleted/{number}.xml",
+                Body=deleted_xml(number * 4000, 4000),
+            )
+        conn.put_object(Bucket="test-bucket", Key="test_dag/2019-08-30/new-updated/0.xml", Body=transformed_xml(0, 5))
+        kwargs = {
+            "bucket": "test-bucket",
+            "access_id": "kittens",
+            "access_secret": "puppies",
+            "dag": mock.Mock(dag_id="test_dag"),
+            "timestamp": "2019-08-30",
+            "solr_conn": Connection(host="127.0.0.1", port=self.server.server_port),
+            "collection": "test-collection",
+        }
+        stats = index.s3_deletes_to_solr(**kwargs)
+        self.assertEqual(stats["documents"], 12000)
+        self.assertEqual(stats["requests"], 3)
+        ids = [record_id for body in MockSolrUpdate.bodies for record_id in body["delete"]]
+        self.assertEqual(sorted(ids), sorted(f"oai:{number}" for number in range(12000)))
+
+    @mock_aws
+    def test_list_s3_keys_past_1000(self):
+        conn = boto3.client("s3", aws_access_key_id="kittens", aws_secret_access_key="puppies")
+        conn.create_bucket(Bucket="test-bucket")
+        for number in range(1001):
+            conn.put_object(Bucket="test-bucket", Key=f"dag/deleted/{number}.xml", Body=b"")
+        keys = index.list_s3_keys("test-bucket", "dag/deleted", "kittens", "puppies")
+        self.assertEqual(sorted(keys), sorted(f"dag/deleted/{number}.xml" for number in range(1001)))
+
+    def test_delete_batches(self):
+        indexer = index.SolrIndexer(self.solr_url)
+        stats = indexer.delete((str(number) for number in range(7)), batch_size=3)
+        self.assertEqual(stats["requests"], 3)
+        self.assertEqual(
+            sorted(MockSolrUpdate.bodies, key=lambda body: body["delete"][0]),
+            [{"delete": ["0", "1", "2"]}, {"delete": ["3", "4", "5"]}, {"delete": ["6"]}],
+        )
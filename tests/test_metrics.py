@@ -0,0 +1,159 @@
+"""Tests suite for tulflow metrics (per-stage timers & counters)."""
+import os
+import socket
+import tempfile
+import unittest
+
+from unittest import mock
+from lxml import etree
+from tulflow import harvest, metrics
+
+
+class TestMetrics(unittest.TestCase):
+    """Test Class for pipeline stage metrics."""
+
+    def test_disabled_is_a_no_op(self):
+        self.assertIs(metrics.timer("stage"), metrics.NULL_TIMER)
+        with metrics.timer("stage") as stage:
+            stage.add(records=1, nbytes=10)
+        metrics.count("stage", records=1)
+        with metrics.collecting("pipeline", metrics=False) as collected:
+            self.assertIsNone(collected)
+            self.assertIs(metrics.timer("stage"), metrics.NULL_TIMER)
+        self.assertEqual(metrics.with_summary({"updated": 1}, collected), {"updated": 1})
+
+    @mock.patch("tulflow.metrics.time.perf_counter")
+    def test_timers_and_counters(self, mock_perf_counter):
+        mock_perf_counter.side_effect = [0.0, 2.0, 10.0, 12.0]
+        with self.assertLogs() as log:
+            with metrics.collecting("pipeline", metrics=True) as collected:
+                with metrics.timer("upload", records=5) as stage:
+                    stage.add(nbytes=1000)
+                with metrics.timer("upload", records=5, nbytes=1000):
+                    pass
+                metrics.count("fetch", records=3, nbytes=30)
+        self.assertIsNone(metrics.CURRENT.get())
+        summary = collected.summary()
+        self.assertEqual(summary["upload"], {
+            "calls": 2,
+            "records": 10,
+            "bytes": 2000,
+            "seconds": 4.0,
+            "records_per_second": 2.5,
+            "bytes_per_second": 500.0,
+        })
+        self.assertEqual(summary["fetch"]["records_per_second"], None)
+        self.assertIn("INFO:root:pipeline fetch: ", log.output[0])
+        self.assertEqual(metrics.with_summary({"updated": 1}, collected)["metrics"], summary)
+
+    def test_merge_results(self):
+        upload = {"calls": 1, "records": 5, "bytes": 1000, "seconds": 2.0}
+        merged = metrics.merge_results([
+            {"transformed": 5, "report": "a.csv", "metrics": {"upload": dict(upload, records_per_second=2.5)}},
+            {"transformed": 3, "skipped": 2, "metrics": {"upload": upload, "fetch": upload}},
+        ])
+        self.assertEqual((merged["transformed"], merged["skipped"]), (8, 2))
+        self.assertNotIn("report", merged)
+        self.assertEqual(merged["metrics"]["upload"], {
+            "calls": 2,
+            "records": 10,
+            "bytes": 2000,
+            "seconds": 4.0,
+            "records_per_second": 2.5,
+            "bytes_per_second": 500.0,
+        })
+        self.assertEqual(merged["metrics"]["fetch"]["records"], 5)
+        self.assertEqual(metrics.merge_results([{"transformed": 1}]), {"transformed": 1})
+
+    def test_statsd_and_prometheus_output(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(("127.0.0.1", 0))
+        receiver.settimeout(5)
+        self.addCleanup(receiver.close)
+        with tempfile.TemporaryDirectory() as textfile_dir:
+            textfile = os.path.join(textfile_dir, "tulflow.prom")
+            kwargs = {
+                "statsd_host": "127.0.0.1",
+                "statsd_port": receiver.getsockname()[1],
+                "prometheus_textfile": textfile,
+            }
+            with self.assertLogs():
+                with metrics.collecting("harvest", **kwargs):
+                    metrics.count("fetch", records=3, nbytes=30)
+            with open(textfile, encoding="utf-8") as prom:
+                prometheus = prom.read()
+            self.assertEqual(os.listdir(textfile_dir), ["tulflow.prom"])
+        lines = [receiver.recv(1024).decode("utf-8") for _ in range(4)]
+        self.assertEqual(lines, [
+            "tulflow.harvest.fetch.calls:0|c",
+            "tulflow.harvest.fetch.records:3|c",
+            "tulflow.harvest.fetch.bytes:30|c",
+            "tulflow.harvest.fetch.seconds:0.0|ms",
+        ])
+        self.assertIn("# TYPE tulflow_stage_records_total counter\n", prometheus)
+        self.assertIn('tulflow_stage_bytes_total{pipeline="harvest",stage="fetch"} 30\n', prometheus)
+
+    def test_instrumented_process_xml(self):
+        """Test stages timed in a pipeline, including background upload threads."""
+        written = []
+
+        @metrics.instrumented("pipeline")
+        def pipeline(**kwargs):
+            records = []
+            for number in range(3):
+                record = mock.Mock()
+                record.header.identifier = f"oai:{number}"
+                record.xml = etree.fromstring(
+                    '<record xmlns="http://www.openarchives.org/OAI/2.0/"><header/></record>'
+                )
+                records.append(record)
+
+            def writer(chunk, prefix, **_kwargs):
+                with metrics.timer("s3_put", nbytes=len(chunk)):
+                    written.append(prefix)
+
+            return harvest.process_xml(records, writer, "test", **kwargs)
+
+        with self.assertLogs():
+            result = pipeline(metrics=True, max_pending_writes=1)
+        self.assertEqual(result["updated"], 3)
+        self.assertEqual(result["metrics"]["serialize"]["records"], 3)
+        self.assertEqual(result["metrics"]["s3_put"]["calls"], len(written))
+        with self.assertLogs():
+            self.assertNotIn("metrics", pipeline())
+
+    def test_record_logger_modes(self):
+        with self.assertLogs() as log:
+            record_log = metrics.record_logger("Processed")
+            for number in range(3):
+                record_log.log("Added record %s", number)
+            record_log.close()
+        self.assertEqual(log.output, [f"INFO:root:Added record {number}" for number in range(3)])
+
+        with self.assertLogs() as log:
+            record_log = metrics.record_logger("Processed", log_mode="sample", log_sample_every=2)
+            for number in range(5):
+                record_log.log("Added record %s", number)
+            record_log.close()
+        self.assertEqual(log.output[:3], [
+            "INFO:root:Added record 0 (record 1)",
+            "INFO:root:Added record 2 (record 3)",
+            "INFO:root:Added record 4 (record 5)",
+        ])
+        self.assertRegex(log.output[3], r"^INFO:root:Processed: 5 records, [\d.]+ records/sec$")
+
+        with self.assertRaises(ValueError):
+            metrics.record_logger("Processed", log_mode="verbose")
+
+    @mock.patch("tulflow.metrics.time.monotonic")
+    def test_record_logger_summary(self, mock_monotonic):
+        mock_monotonic.side_effect = [0.0, 10.0, 31.0, 40.0, 50.0]
+        with self.assertLogs() as log:
+            record_log = metrics.record_logger("Transformed", log_mode="summary", log_summary_seconds=30)
+            for number in range(3):
+                record_log.log("Transforming Record %s", number)
+            record_log.close()
+        self.assertEqual(log.output, [
+            "INFO:root:Transformed: 2 records, 0.1 records/sec",
+            "INFO:root:Transformed: 3 records, 0.1 records/sec",
+        ])
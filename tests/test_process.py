@@ -1,4 +1,5 @@
 """Tests suite for tulflow harvest (Functions for harvesting OAI in Airflow Tasks)."""
+import io
 import unittest
 import boto3
 import httpretty
@@ -196,6 +197,20 @@ class TestS3ProcessInteractions(unittest.TestCase):
         test_run = process.get_s3_content(bucket, key, access_id, access_secret)
         self.assertEqual(test_run, b"test more content")
 
+    @mock_aws
+    def test_get_s3_stream(self):
+        bucket = "test_bucket"
+        key = "test_key_stream"
+        access_id = "test_access_id"
+        access_secret = "test_access_secret"
+        conn = boto3.client("s3", aws_access_key_id=access_id, aws_secret_access_key=access_secret)
+        conn.create_bucket(Bucket=bucket)
+        conn.put_object(Bucket=bucket, Key=key, Body="test streamed content")
+        body = process.get_s3_stream(bucket, key, access_id, access_secret)
+        self.assertEqual(body.read(4), b"test")
+        self.assertEqual(body.read(), b" streamed content")
+        self.assertIsNone(process.get_s3_stream(bucket, "missing", access_id, access_secret))
+
     @mock_aws
     def test_list_s3_content(self):
         bucket = "test_bucket"
@@ -212,6 +227,20 @@ class TestS3ProcessInteractions(unittest.TestCase):
         test_run_pref = process.list_s3_content(bucket, access_id, access_secret, prefix=prefix)
         self.assertEqual(test_run_pref, ["test_prefix/item1"])
 
+    @mock_aws
+    def test_list_s3_content_sizes(self):
+        bucket = "test_bucket"
+        access_id = "test_access_id"
+        access_secret = "test_access_secret"
+        conn = boto3.client("s3", aws_access_key_id=access_id, aws_secret_access_key=access_secret)
+        conn.create_bucket(Bucket=bucket)
+        for number in range(1005):
+            conn.put_object(Bucket=bucket, Key=f"test_prefix/{number:04}", Body="x" * number)
+        conn.put_object(Bucket=bucket, Key="other", Body="elsewhere")
+        test_run = process.list_s3_content_sizes(bucket, access_id, access_secret, prefix="test_prefix")
+        self.assertEqual(len(test_run), 1005)
+        self.assertEqual(test_run[1004], ("test_prefix/1004", 1004))
+
     @mock_aws
     def test_genereate_s3_object(self):
         bucket = "test_bucket"
@@ -226,4 +255,14 @@ class TestS3ProcessInteractions(unittest.TestCase):
         test_object_exists = conn.list_objects(Bucket=bucket)
         self.assertEqual(test_content_exists["Body"].read(), body)
         self.assertEqual(test_content_exists["ResponseMetadata"]["HTTPStatusCode"], 200)
-        self.assertEqual(test_object_exists["Contents"][0]["Key"], key)
\ No newline at end of file
+        self.assertEqual(test_object_exists["Contents"][0]["Key"], key)
+
+    @mock_aws
+    def test_generate_s3_object_from_buffer(self):
+        conn = boto3.client("s3", aws_access_key_id="kittens", aws_secret_access_key="puppies")
+        conn.create_bucket(Bucket="test_bucket")
+        buffer = io.BytesIO()
+        buffer.write(b"<test>buffered content</test>")
+        process.generate_s3_object(buffer, "test_bucket", "buffered", "kittens", "puppies")
+        body = conn.get_object(Bucket="test_bucket", Key="buffered")["Body"].read()
+        self.assertEqual(body, b"<test>buffered content</test>")
@@ -1,8 +1,11 @@
 """Tests suite for tulflow harvest (Functions for harvesting OAI in Airflow Tasks)."""
 import json
+import requests
+import threading
 import unittest
 import requests_mock
 
+from concurrent.futures import ThreadPoolExecutor
 from re import compile as re_compile
 from tulflow.solr_api_utils import SolrApiUtils
 from unittest.mock import patch
@@ -172,4 +175,340 @@ class TestSolrApiUtils(unittest.TestCase):
             f"&replicationFactor={replicationFactor}"
             f"&maxShardsPerNode={maxShardsPerNode}"
         )
-        mock_get_from_solr_api.assert_called_with(path)
\ No newline at end of file
+        mock_get_from_solr_api.assert_called_with(path)
+
+    @requests_mock.mock()
+    def test_remove_and_recreate_round_trips(self, rm):
+        cluster = {
+            "cluster": {
+                "collections": {"test_collection": {}, "other_collection": {}},
+                "aliases": {"test_alias": "test_collection,other_collection"},
+            }
+        }
+        rm.get(re_compile(".*action=CLUSTERSTATUS"), json=cluster)
+        rm.get(re_compile(".*action=(CREATEALIAS|DELETE|CREATE)&"), json={})
+
+        def refresh():
+            rm.reset_mock()
+            SolrApiUtils.remove_and_recreate_collection_from_alias(
+                collection="test_collection",
+                alias="test_alias",
+                solr_url=self.sc_url,
+            )
+            return [request.qs["action"][0] for request in rm.request_history]
+
+        # Baseline: the same refresh with cluster state re-fetched on every use.
+        with patch.object(SolrApiUtils, "state_is_stale", return_value=True):
+            uncached = refresh()
+        actions = refresh()
+        self.assertEqual(actions, ["clusterstatus", "createalias", "delete", "create", "createalias"])
+        changes = [action for action in uncached if action != "clusterstatus"]
+        self.assertEqual(changes, [action for action in actions if action != "clusterstatus"])
+        self.assertEqual(len(uncached) - len(actions), uncached.count("clusterstatus") - 1)
+        self.assertGreater(uncached.count("clusterstatus"), 1)
+        self.assertEqual(rm.request_history[-1].qs["collections"], ["other_collection,test_collection"])
+
+    def test_session_retries_and_auth(self):
+        solrcloud = SolrApiUtils(self.sc_url, auth_user="user", auth_pass="pass", max_retries=5)
+        retries = solrcloud.session.get_adapter(self.sc_url).max_retries
+        self.assertEqual(solrcloud.session.auth, ("user", "pass"))
+        self.assertEqual(retries.total, 5)
+        self.assertEqual(retries.status_forcelist, (502, 503, 504))
+        self.assertEqual((retries.connect, retries.read, retries.other), (5, 0, 0))
+        change_retries = solrcloud.change_session.get_adapter(self.sc_url).max_retries
+        self.assertEqual(solrcloud.change_session.auth, ("user", "pass"))
+        self.assertEqual((change_retries.total, change_retries.connect, change_retries.read), (5, 5, 0))
+        self.assertEqual(tuple(change_retries.status_forcelist), ())
+
+    def test_session_for_changes_does_not_retry_statuses(self):
+        reads = [
+            "/solr/admin/collections?action=CLUSTERSTATUS",
+            "/solr/admin/collections?action=List",
+            "/solr/admin/collections?action=REQUESTSTATUS&requestid=1",
+            "/api/cluster/configs?omitHeader=true",
+            "/solr/funcake/select",
+        ]
+        changes = [
+            "/solr/admin/collections?action=CREATE&name=coll",
+            "/solr/admin/collections?action=DELETE&name=coll&async=1",
+            "/solr/admin/collections?action=CREATEALIAS&name=alias&collections=coll",
+            "/solr/admin/collections?action=RELOAD&name=coll",
+            "/solr/admin/configs?action=CREATE&name=conf&baseConfigSet=_default",
+        ]
+        self.assertEqual({self.solrcloud.session_for(path) for path in reads}, {self.solrcloud.session})
+        self.assertEqual({self.solrcloud.session_for(path) for path in changes}, {self.solrcloud.change_session})
+
+    @patch("tulflow.solr_api_utils.time.sleep")
+    @requests_mock.mock()
+    def test_remove_and_recreate_collections_from_aliases(self, mock_sleep, rm):
+        cluster = {
+            "cluster": {
+                "collections": {"coll1": {}, "coll2": {}, "coll3": {}, "keep": {}},
+                "aliases": {"alias1": "coll1,keep", "alias2": "coll2,coll3"},
+            }
+        }
+        rm.get(re_compile(".*action=CLUSTERSTATUS"), json=cluster)
+        rm.get(re_compile(".*action=(CREATEALIAS|DELETE|CREATE)&"), json={})
+        rm.get(re_compile(".*action=REQUESTSTATUS"), [
+            {"json": {"status": {"state": "running"}}},
+            {"json": {"status": {"state": "completed"}}},
+        ])
+        specs = [
+            {"collection": "coll1", "alias": "alias1", "configset": "conf1"},
+            {"collection": "coll2", "alias": "alias2", "configset": "conf2"},
+            {"collection": "coll3", "alias": "alias2", "replicationFactor": 2},
+        ]
+        refreshed = SolrApiUtils.remove_and_recreate_collections_from_aliases(
+            specs,
+            solr_url=self.sc_url,
+            max_workers=3,
+        )
+        self.assertEqual(refreshed, ["coll1", "coll2", "coll3"])
+        queries = [request.qs for request in rm.request_history]
+        async_ids = [query["async"][0] for query in queries if "async" in query]
+        self.assertEqual(len(async_ids), 6)
+        self.assertEqual(len(set(async_ids)), 6)
+        polled = {query["requestid"][0] for query in queries if query["action"] == ["requeststatus"]}
+        self.assertEqual(polled, set(async_ids))
+        creates = [query for query in queries if query["action"] == ["create"]]
+        self.assertEqual(
+            sorted(query["collection.configname"][0] for query in creates),
+            ["_default", "conf1", "conf2"],
+        )
+        alias_updates = [
+            query["collections"][0] for query in queries
+            if query["action"] == ["createalias"] and query["name"] == ["alias2"]
+        ]
+        self.assertEqual(len(alias_updates), 4)
+        self.assertEqual(sorted(alias_updates[-1].split(",")), ["coll2", "coll3"])
+
+    @patch("tulflow.solr_api_utils.time.sleep")
+    @requests_mock.mock()
+    def test_remove_and_recreate_collections_failed_request(self, mock_sleep, rm):
+        cluster = {"cluster": {"collections": {"coll1": {}}, "aliases": {"alias1": "coll1,keep"}}}
+        rm.get(re_compile(".*action=CLUSTERSTATUS"), json=cluster)
+        rm.get(re_compile(".*action=(CREATEALIAS|DELETE|CREATE)&"), json={})
+        rm.get(re_compile(".*action=REQUESTSTATUS"), json={
+            "status": {"state": "failed", "msg": "Could not delete"}
+        })
+        specs = [{"collection": "coll1", "alias": "alias1"}]
+        with self.assertRaisesRegex(RuntimeError, "failed: Could not delete"):
+            with self.assertLogs(level="ERROR"):
+                SolrApiUtils.remove_and_recreate_collections_from_aliases(
+                    specs,
+                    solr_url=self.sc_url,
+                )
+
+    @patch("tulflow.solr_api_utils.time.sleep")
+    @requests_mock.mock()
+    def test_remove_and_recreate_collections_one_fails_in_flight(self, mock_sleep, rm):
+        cluster = {
+            "cluster": {
+                "collections": {"coll1": {}, "coll2": {}, "keep": {}},
+                "aliases": {"alias1": "coll1,keep", "alias2": "coll2,keep"},
+            }
+        }
+        coll2_failed = threading.Event()
+        mock_sleep.side_effect = lambda seconds: coll2_failed.wait(1)
+        changes = {}
+
+        def change(request, context):
+            if "async" in request.qs:
+                changes[request.qs["async"][0]] = (request.qs["action"][0], request.qs["name"][0])
+            if request.qs["action"] == ["create"] and request.qs["name"] == ["coll2"]:
+                coll2_failed.set()
+                context.status_code = 400
+                return {"error": {"msg": "Underlying core creation failed"}}
+            return {}
+
+        def request_status(request, context):
+            # coll1's DELETE stays in flight until coll2's CREATE has failed.
+            if changes[request.qs["requestid"][0]] == ("delete", "coll1") and not coll2_failed.is_set():
+                return {"status": {"state": "running"}}
+            return {"status": {"state": "completed"}}
+
+        rm.get(re_compile(".*action=CLUSTERSTATUS"), json=cluster)
+        rm.get(re_compile(".*action=(CREATEALIAS|DELETE|CREATE)&"), json=change)
+        rm.get(re_compile(".*action=REQUESTSTATUS"), json=request_status)
+        specs = [
+            {"collection": "coll1", "alias": "alias1"},
+            {"collection": "coll2", "alias": "alias2"},
+        ]
+        with self.assertRaisesRegex(requests.exceptions.HTTPError, "Underlying core creation failed"):
+            with self.assertLogs(level="ERROR") as log:
+                SolrApiUtils.remove_and_recreate_collections_from_aliases(
+                    specs,
+                    solr_url=self.sc_url,
+                    max_workers=2,
+                )
+        self.assertTrue(coll2_failed.is_set())
+        self.assertEqual(len(log.output), 1)
+        self.assertIn("Refreshing coll2 in alias2 failed", log.output[0])
+        queries = [request.qs for request in rm.request_history]
+        alias1_updates = [
+            query["collections"][0] for query in queries
+            if query["action"] == ["createalias"] and query["name"] == ["alias1"]
+        ]
+        self.assertEqual(alias1_updates, ["keep", "keep,coll1"])
+
+    def test_next_collection_version(self):
+        self.solrcloud.collections = ["funcake-2", "funcake-10", "funcake-init", "other-11"]
+        self.assertEqual(self.solrcloud.collection_versions("funcake"), ["funcake-10", "funcake-2"])
+        self.assertEqual(self.solrcloud.next_collection_version("funcake"), "funcake-11")
+        self.assertEqual(self.solrcloud.next_collection_version("funcake-2"), "funcake-11")
+        self.assertEqual(self.solrcloud.next_collection_version("new"), "new-1")
+
+    @requests_mock.mock()
+    def test_create_next_collection_version(self, rm):
+        cluster = {"cluster": {"collections": {"funcake-1": {}, "funcake-2": {}}, "aliases": {}}}
+        rm.get(re_compile(".*action=CLUSTERSTATUS"), json=cluster)
+        rm.get(re_compile(".*action=CREATE&"), json={})
+        collection = SolrApiUtils.create_next_collection_version(
+            collection="funcake",
+            configset="funcake-5",
+            solr_url=self.sc_url,
+        )
+        self.assertEqual(collection, "funcake-3")
+        self.assertEqual(rm.last_request.qs["name"], ["funcake-3"])
+        self.assertEqual(rm.last_request.qs["collection.configname"], ["funcake-5"])
+
+    @requests_mock.mock()
+    def test_blue_green_swap_alias(self, rm):
+        cluster = {
+            "cluster": {
+                "collections": {name: {} for name in [
+                    "funcake-1", "funcake-2", "funcake-3", "funcake-4", "funcake-init", "temple",
+                ]},
+                "aliases": {"funcake": "funcake-init,funcake-3,temple", "pinned": "funcake-1"},
+            }
+        }
+        rm.get(re_compile(".*action=CLUSTERSTATUS"), json=cluster)
+        rm.get(re_compile(".*action=(CREATEALIAS|DELETE)&"), json={})
+        rm.get(re_compile(".*/solr/funcake-4/select"), json={})
+        deleted = SolrApiUtils.blue_green_swap_alias(
+            collection="funcake-4",
+            alias="funcake",
+            solr_url=self.sc_url,
+            warm_queries=["*:*", {"q": "cats", "facet.field": "format"}],
+        )
+        self.assertEqual(deleted, ["funcake-2"])
+        history = rm.request_history
+        self.assertEqual([request.qs for request in history[:2]], [
+            {"q": ["*:*"], "rows": ["0"]},
+            {"q": ["cats"], "facet.field": ["format"], "rows": ["0"]},
+        ])
+        swaps = [request.qs for request in history if request.qs.get("action") == ["createalias"]]
+        self.assertEqual(len(swaps), 1)
+        self.assertEqual(swaps[0]["collections"], ["temple,funcake-4"])
+        deletes = [request.qs["name"] for request in history if request.qs.get("action") == ["delete"]]
+        self.assertEqual(deletes, [["funcake-2"]])
+
+    @requests_mock.mock()
+    def test_configset_index(self, rm):
+        configsets = ["tul_cob-catalog-9", "tul_cob-catalog-10", "tul_cob-web-2", "_default", "funcake-1"]
+        rm.get(self.matcher, json={"configSets": configsets})
+        index = self.solrcloud.get_configset_index()
+        self.assertIs(self.solrcloud.get_configset_index(), index)
+        self.assertEqual(rm.call_count, 1)
+        self.assertEqual(index.versions["tul_cob-catalog"], [9, 10])
+        self.assertEqual(self.solrcloud.latest_configset("tul_cob-catalog"), "tul_cob-catalog-10")
+        self.assertIsNone(self.solrcloud.latest_configset("_default"))
+        self.assertEqual(
+            self.solrcloud.recent_configsets_with_prefix("tul_cob"),
+            ["tul_cob-catalog-10", "tul_cob-web-2"],
+        )
+        self.assertEqual(self.solrcloud.recent_configsets_with_prefix("nope"), [])
+
+    @requests_mock.mock()
+    def test_create_and_delete_configset_invalidate_index(self, rm):
+        rm.get(re_compile(".*/api/cluster/configs.*"), json={"configSets": ["funcake-1", "_default"]})
+        rm.get(re_compile(".*/solr/admin/configs.*"), json={})
+        self.assertEqual(self.solrcloud.most_recent_configsets(), ["funcake-1"])
+        self.solrcloud.create_configset("funcake-2")
+        self.assertEqual(rm.last_request.qs, {"action": ["create"], "name": ["funcake-2"], "baseconfigset": ["_default"]})
+        self.assertEqual(self.solrcloud.most_recent_configsets(), ["funcake-2"])
+        self.solrcloud.delete_configset("funcake-2")
+        self.assertEqual(self.solrcloud.most_recent_configsets(), ["funcake-1"])
+        self.assertEqual(rm.call_count, 3)
+
+    @requests_mock.mock()
+    def test_alias_refresh_reuses_cached_state(self, rm):
+        rm.get(re_compile(".*action=ListAliases"), json={"aliases": {"alias": "coll1,coll2"}})
+        rm.get(re_compile(".*action=List$"), json={"collections": ["coll1", "coll2"]})
+        rm.get(re_compile(".*action=(CREATEALIAS|DELETE|CREATE)&"), json={})
+        self.solrcloud.remove_collection_from_alias(collection="coll1", alias="alias")
+        self.solrcloud.delete_collection("coll1")
+        self.solrcloud.create_collection(collection="coll1")
+        self.solrcloud.add_collection_to_alias(collection="coll1", alias="alias")
+        self.solrcloud.remove_collection_from_alias(collection="coll2", alias="alias")
+        actions = [request.qs["action"][0] for request in rm.request_history]
+        self.assertEqual(
+            actions,
+            ["listaliases", "createalias", "list", "delete", "create", "createalias", "createalias"],
+        )
+        self.assertEqual(self.solrcloud.get_aliases(), {"alias": "coll1"})
+        self.assertEqual(self.solrcloud.get_collections(), ["coll2", "coll1"])
+        self.assertEqual(self.solrcloud.state_version, 7)
+
+    @patch("tulflow.solr_api_utils.time.monotonic")
+    @requests_mock.mock()
+    def test_state_ttl_expiry(self, mock_monotonic, rm):
+        rm.get(self.matcher, json={"collections": ["coll1"]})
+        mock_monotonic.return_value = 100
+        solrcloud = SolrApiUtils(self.sc_url, state_ttl=60)
+        solrcloud.get_collections()
+        mock_monotonic.return_value = 150
+        solrcloud.get_collections()
+        self.assertEqual(rm.call_count, 1)
+        mock_monotonic.return_value = 161
+        solrcloud.get_collections()
+        self.assertEqual(rm.call_count, 2)
+
+    @requests_mock.mock()
+    def test_failed_change_refetches_state(self, rm):
+        rm.get(re_compile(".*action=ListAliases"), json={"aliases": {"alias": "coll1,coll2"}})
+        rm.get(
+            re_compile(".*action=CREATEALIAS&"),
+            status_code=400,
+            json={"error": {"msg": "Can't create alias"}},
+        )
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self.solrcloud.remove_collection_from_alias(collection="coll1", alias="alias")
+        self.assertIsNone(self.solrcloud.aliases)
+        self.assertEqual(self.solrcloud.get_aliases(), {"alias": "coll1,coll2"})
+        actions = [request.qs["action"][0] for request in rm.request_history]
+        self.assertEqual(actions, ["listaliases", "createalias", "listaliases"])
+
+    @patch("tulflow.solr_api_utils.time.sleep")
+    @requests_mock.mock()
+    def test_shared_client_change_fails_in_flight(self, mock_sleep, rm):
+        cluster = {"cluster": {"collections": {"coll1": {}}, "aliases": {}}}
+        polling, create_failed = threading.Event(), threading.Event()
+        mock_sleep.side_effect = lambda seconds: create_failed.wait(1)
+
+        def create(request, context):
+            create_failed.set()
+            context.status_code = 400
+            return {"error": {"msg": "Underlying core creation failed"}}
+
+        def request_status(request, context):
+            # The DELETE stays in flight until the CREATE has failed & dropped cached state.
+            polling.set()
+            return {"status": {"state": "completed" if create_failed.is_set() else "running"}}
+
+        rm.get(re_compile(".*action=CLUSTERSTATUS"), json=cluster)
+        rm.get(re_compile(".*action=DELETE&"), json={})
+        rm.get(re_compile(".*action=CREATE&"), json=create)
+        rm.get(re_compile(".*action=REQUESTSTATUS"), json=request_status)
+        solrcloud = SolrApiUtils(self.sc_url, cluster_status=True)
+        solrcloud.load_cluster_status()
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            deleted = executor.submit(solrcloud.delete_collection, "coll1", run_async=True)
+            polling.wait(5)
+            created = executor.submit(solrcloud.create_collection, "coll2")
+        self.assertIsNone(deleted.result())
+        with self.assertRaisesRegex(requests.exceptions.HTTPError, "Underlying core creation failed"):
+            created.result()
+        self.assertEqual(solrcloud.get_collections(), ["coll1"])
+        actions = [request.qs["action"][0] for request in rm.request_history]
+        self.assertEqual(actions.count("clusterstatus"), 2)
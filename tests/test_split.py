@@ -0,0 +1,260 @@
+"""Tests suite for tulflow split (parallel processing of byte ranges of one large collection)."""
+import mmap
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import boto3
+import requests_mock
+from lxml import etree
+from moto import mock_aws
+from tulflow import harvest, metrics, process, split, transform
+from tests.test_transform import XSL_URL, XSLT_1_0
+
+COLLECTION = (
+    b'<?xml version="1.0" encoding="UTF-8"?>\n<!-- export -->\n'
+    b'<collection xmlns="http://www.loc.gov/MARC21/slim" note="a > b">\n'
+    b'  <record><datafield tag="773"><record>nested</record></datafield></record>\n'
+    b"  <!-- <record> in a comment -->\n"
+    b'  <record/>\n'
+    b'  <record id="3" note="/>"><![CDATA[</record>]]><leader/></record>\n'
+    b"</collection>\n"
+)
+
+
+def marc_collection(count):
+    """Build an Alma style MARC XML collection of `count` records of varying size."""
+    records = b"".join(
+        b'<record><controlfield tag="001">%d</controlfield><datafield tag="245">'
+        b'<subfield code="a">%s</subfield></datafield></record>\n' % (number, b"x" * (number % 7 * 50))
+        for number in range(count)
+    )
+    return b'<collection xmlns="http://www.loc.gov/MARC21/slim">\n' + records + b"</collection>"
+
+
+def record_ids(collection):
+    """The 001 of each record in a parsed collection range."""
+    return [record[0].text for record in collection]
+
+
+class TestRecordBoundaries(unittest.TestCase):
+    """Test Class for finding record boundaries without parsing."""
+
+    def test_record_boundaries(self):
+        boundaries = split.record_boundaries(COLLECTION)
+        self.assertEqual([COLLECTION[start:end] for (start, end) in boundaries], [
+            b'<record><datafield tag="773"><record>nested</record></datafield></record>',
+            b"<record/>",
+            b'<record id="3" note="/>"><![CDATA[</record>]]><leader/></record>',
+        ])
+
+    def test_record_boundaries_alma_export(self):
+        with open("tests/fixtures/alma_bibs__new_1.xml", "rb") as fixture_file:
+            data = fixture_file.read()
+        records = etree.fromstring(data)
+        boundaries = split.record_boundaries(data)
+        self.assertEqual(
+            [etree.tostring(etree.fromstring(data[start:end])) for (start, end) in boundaries],
+            [etree.tostring(record).strip() for record in records],
+        )
+
+    def test_record_boundaries_empty_or_mixed(self):
+        self.assertEqual(split.record_boundaries(b"<collection/>"), [])
+        self.assertEqual(split.record_boundaries(b"<collection>\n</collection>"), [])
+        with self.assertRaises(split.UnsplittableCollection):
+            split.record_boundaries(b"<collection><record/>text<record/></collection>")
+        with self.assertRaises(split.UnsplittableCollection):
+            split.record_boundaries(b"<collection><record/><other/></collection>")
+
+    def test_split_ranges(self):
+        boundaries = [(0, 10), (10, 20), (20, 60), (60, 70), (70, 80)]
+        self.assertEqual(split.split_ranges(boundaries, 2), [(0, 60, 3), (60, 80, 2)])
+        self.assertEqual(split.split_ranges(boundaries, 1), [(0, 80, 5)])
+        self.assertEqual(len(split.split_ranges(boundaries, 10)), 5)
+        self.assertEqual(split.split_ranges([], 4), [])
+
+
+class TestProcessCollection(unittest.TestCase):
+    """Test Class for processing ranges of a collection in parallel, in order."""
+
+    def test_process_collection(self):
+        data = marc_collection(500)
+        with self.assertLogs() as log:
+            results = split.process_collection(data, record_ids, parts=4, workers=4)
+        self.assertEqual(len(results), 4)
+        self.assertEqual([record_id for ids in results for record_id in ids], [str(n) for n in range(500)])
+        self.assertEqual(log.output, ["INFO:root:Split 500 records into 4 ranges"])
+
+    def test_process_collection_mmap(self):
+        with tempfile.TemporaryFile() as source:
+            source.write(marc_collection(100))
+            source.flush()
+            with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                with self.assertLogs():
+                    results = split.process_collection(data, record_ids, parts=3)
+        self.assertEqual([record_id for ids in results for record_id in ids], [str(n) for n in range(100)])
+
+    @mock_aws
+    def test_process_s3_collection_from_manifest(self):
+        """Test a manifest's record index splits an object into ranged GETs, no full read."""
+        conn = boto3.client("s3", aws_access_key_id="kittens", aws_secret_access_key="puppies")
+        conn.create_bucket(Bucket="test-bucket")
+        oai_xml = harvest.OaiXml("test_dag", "2019-08-30")
+        for number in range(40):
+            record = etree.fromstring(
+                '<record xmlns="http://www.openarchives.org/OAI/2.0/"><header>'
+                f"<identifier>oai:{number}</identifier></header></record>"
+            )
+            record.attrib["airflow-record-id"] = f"oai:{number}"
+            oai_xml.append(record)
+        chunk = oai_xml.tostring()
+        manifest = harvest.RunManifest("test_dag/2019-08-30")
+        key = manifest.add(chunk, "test_dag/2019-08-30/new-updated", oai_xml.record_index())["key"]
+        conn.put_object(Bucket="test-bucket", Key=key, Body=chunk)
+
+        def ids(collection):
+            return [record.get("airflow-record-id") for record in collection]
+
+        with mock.patch("tulflow.process.get_s3_content") as get_s3_content:
+            with self.assertLogs():
+                results = split.process_s3_collection(
+                    "test-bucket", key, ids, "kittens", "puppies", manifest=manifest, parts=4
+                )
+        get_s3_content.assert_not_called()
+        self.assertEqual(len(results), 4)
+        self.assertEqual([record_id for part in results for record_id in part], [f"oai:{n}" for n in range(40)])
+
+        with self.assertLogs():
+            results = split.process_s3_collection("test-bucket", key, ids, "kittens", "puppies", parts=2)
+        self.assertEqual([record_id for part in results for record_id in part], [f"oai:{n}" for n in range(40)])
+
+    @mock_aws
+    def test_transform_s3_xsl_split(self):
+        """Test a large file transformed in parallel ranges matches it transformed whole."""
+        conn = boto3.client("s3", aws_access_key_id="kittens", aws_secret_access_key="puppies")
+        conn.create_bucket(Bucket="test-bucket")
+        records = "".join(
+            f'<record airflow-record-id="oai:{number}"><title>Title {number}</title></record>'
+            for number in range(200)
+        )
+        conn.put_object(Bucket="test-bucket", Key="dag/filtered/1.xml", Body=f"<collection>{records}</collection>")
+        kwargs = {
+            "bucket": "test-bucket",
+            "source_prefix": "dag/filtered",
+            "xsl_filename": "transforms/test.xsl",
+            "xsl_engine": "lxml",
+        }
+        with requests_mock.Mocker() as mocker:
+            mocker.get(XSL_URL, content=XSLT_1_0)
+            with self.assertLogs():
+                whole = transform.transform_s3_xsl(destination_prefix="dag/whole", **kwargs)
+            with self.assertLogs() as log:
+                parts = transform.transform_s3_xsl(
+                    destination_prefix="dag/split", split_bytes=1000, split_parts=4, **kwargs
+                )
+        self.assertEqual(whole, parts)
+        self.assertIn("INFO:root:Split 200 records into 4 ranges", log.output)
+        self.assertEqual(
+            conn.get_object(Bucket="test-bucket", Key="dag/split/1.xml")["Body"].read(),
+            conn.get_object(Bucket="test-bucket", Key="dag/whole/1.xml")["Body"].read(),
+        )
+
+    @mock_aws
+    def test_transform_s3_xsl_split_unsplittable_file_whole(self):
+        """Test a large file the boundary scan can't split is transformed whole, not failed."""
+        conn = boto3.client("s3", aws_access_key_id="kittens", aws_secret_access_key="puppies")
+        conn.create_bucket(Bucket="test-bucket")
+        records = "".join(
+            f'<record airflow-record-id="oai:{number}"><title>Title {number}</title></record>'
+            for number in range(100)
+        )
+        body = f'<collection>{records}<![CDATA[a < b]]>{records}</collection>'
+        conn.put_object(Bucket="test-bucket", Key="dag/filtered/1.xml", Body=body)
+        kwargs = {
+            "bucket": "test-bucket",
+            "source_prefix": "dag/filtered",
+            "xsl_filename": "transforms/test.xsl",
+            "xsl_engine": "lxml",
+        }
+        with requests_mock.Mocker() as mocker:
+            mocker.get(XSL_URL, content=XSLT_1_0)
+            with self.assertLogs():
+                whole = transform.transform_s3_xsl(destination_prefix="dag/whole", **kwargs)
+            with self.assertLogs() as log:
+                parts = transform.transform_s3_xsl(
+                    destination_prefix="dag/split", split_bytes=1000, split_parts=4, **kwargs
+                )
+        self.assertEqual(parts, whole)
+        self.assertEqual(parts, {"transformed": 200})
+        self.assertIn(
+            "WARNING:root:Transforming File dag/filtered/1.xml whole, it can't be split: "
+            "Collection has content other than <record> records",
+            log.output,
+        )
+        self.assertEqual(
+            conn.get_object(Bucket="test-bucket", Key="dag/split/1.xml")["Body"].read(),
+            conn.get_object(Bucket="test-bucket", Key="dag/whole/1.xml")["Body"].read(),
+        )
+
+    @mock_aws
+    def test_transform_s3_xsl_split_from_manifest(self):
+        """Test a large file the run manifest indexes is transformed from ranged GETs, never
+        downloaded whole, & matches it transformed whole."""
+        conn = boto3.client("s3", aws_access_key_id="kittens", aws_secret_access_key="puppies")
+        conn.create_bucket(Bucket="test-bucket")
+        records = "".join(
+            f'<record airflow-record-id="oai:{number}"><title>Title {number}</title></record>'
+            for number in range(200)
+        )
+        body = f"<collection>{records}</collection>".encode("utf-8")
+        index = [
+            [f"oai:{number}", start, end - start]
+            for number, (start, end) in enumerate(split.record_boundaries(body))
+        ]
+        manifest = harvest.RunManifest("dag/2019-08-30")
+        key = manifest.add(body, "dag/2019-08-30/new-updated", index)["key"]
+        manifest.write(bucket_name="test-bucket")
+        conn.put_object(Bucket="test-bucket", Key=key, Body=body)
+        kwargs = {
+            "bucket": "test-bucket",
+            "source_prefix": "dag/2019-08-30/new-updated",
+            "manifest_key": "dag/2019-08-30/manifest.json",
+            "xsl_filename": "transforms/test.xsl",
+            "xsl_engine": "lxml",
+        }
+        with requests_mock.Mocker() as mocker:
+            mocker.get(XSL_URL, content=XSLT_1_0)
+            with self.assertLogs():
+                whole = transform.transform_s3_xsl(destination_prefix="dag/whole", **kwargs)
+            with mock.patch("tulflow.process.get_s3_content", wraps=process.get_s3_content) as get_s3_content:
+                with self.assertLogs() as log:
+                    parts = transform.transform_s3_xsl(
+                        destination_prefix="dag/split", split_bytes=1000, split_parts=4, **kwargs
+                    )
+        self.assertEqual(whole, parts)
+        self.assertEqual(
+            [call.args[1] for call in get_s3_content.call_args_list], ["dag/2019-08-30/manifest.json"]
+        )
+        self.assertIn(f"INFO:root:Split 200 records of {key} into 4 ranges", log.output)
+        filename = key.rsplit("/", 1)[1]
+        self.assertEqual(
+            conn.get_object(Bucket="test-bucket", Key=f"dag/split/{filename}")["Body"].read(),
+            conn.get_object(Bucket="test-bucket", Key=f"dag/whole/{filename}")["Body"].read(),
+        )
+
+
+class TestRecordLoggerThreads(unittest.TestCase):
+    """Test Class for a record logger shared by the threads transforming ranges."""
+
+    def test_record_logger_counts_every_thread(self):
+        record_log = metrics.RecordLogger("Transformed", mode="sample", every=10 ** 9)
+
+        def log_records(_):
+            for number in range(10000):
+                record_log.log("Transforming Record %s", number)
+
+        with self.assertLogs():
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                list(executor.map(log_records, range(8)))
+        self.assertEqual(record_log.count, 80000)
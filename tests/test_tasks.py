@@ -1,14 +1,23 @@
 """Tests suite for tulflow tasks (generic Airflow Tasks as Functions)."""
 import unittest
+import boto3
 
 from datetime import datetime
 from airflow.models import Connection, DAG, TaskInstance
 from airflow.utils.state import State
+from moto import mock_aws
+from tulflow import harvest, transform, validate
 from tulflow.tasks import (
+    blue_green_swap_sc_alias,
+    create_next_sc_collection,
     create_sc_collection,
     get_solr_url,
     get_solr_url_template,
+    parallel_filter_s3_schematron,
+    parallel_transform_s3_xsl,
     refresh_sc_collection_for_alias,
+    refresh_sc_collections_for_aliases,
+    shard_s3_keys,
     swap_sc_alias,
 )
 
@@ -92,6 +101,131 @@ class TestSolrCloudTasks(unittest.TestCase):
         self.assertEqual("my-configset", task.op_kwargs["configset"])
         self.assertEqual("refresh_sc_collection_for_alias", task_instance.task_id)
 
+    def test_refresh_sc_collections_for_aliases(self):
+        """Test refresh_sc_collections_for_aliases task instance contains expected config values."""
+        dag = DAG(dag_id="test_refresh_sc_collections_for_aliases", start_date=DEFAULT_DATE)
+        sc_conn = Connection(conn_id="SOLRCLOUD", conn_type="http", host="http://localhost")
+        specs = [
+            {"collection": "my-collection", "alias": "my-alias", "configset": "my-configset"},
+            {"collection": "my-other-collection", "alias": "my-other-alias"},
+        ]
+        task = refresh_sc_collections_for_aliases(dag=dag, sc_conn=sc_conn, specs=specs)
+
+        self.assertEqual(specs, task.op_kwargs["specs"])
+        self.assertEqual(4, task.op_kwargs["max_workers"])
+        self.assertEqual("http://localhost", task.op_kwargs["solr_url"])
+        self.assertEqual("refresh_sc_collections_for_aliases", task.task_id)
+
+    def test_blue_green_sc_tasks(self):
+        """Test blue/green create & swap task instances contain expected config values."""
+        dag = DAG(dag_id="test_blue_green_sc_tasks", start_date=DEFAULT_DATE)
+        sc_conn = Connection(conn_id="SOLRCLOUD", conn_type="http", host="http://localhost")
+        create = create_next_sc_collection(
+            dag=dag,
+            sc_conn=sc_conn,
+            sc_coll_name="my-collection",
+            configset="my-configset",
+        )
+        swap = blue_green_swap_sc_alias(
+            dag=dag,
+            sc_conn=sc_conn,
+            sc_alias="my-alias",
+            warm_queries=["*:*"],
+        )
+
+        self.assertEqual("my-collection", create.op_kwargs["collection"])
+        self.assertEqual("my-configset", create.op_kwargs["configset"])
+        class CreatedTaskInstance:
+            """Stand-in task instance whose create task pushed the next generation's name."""
+            def xcom_pull(self, task_ids):
+                return {create.task_id: "my-collection-v2"}[task_ids]
+
+        rendered = swap.render_template(swap.op_kwargs, {"ti": CreatedTaskInstance()})
+        self.assertEqual("my-collection-v2", rendered["collection"])
+        self.assertIn("op_kwargs", swap.template_fields)
+        self.assertEqual("my-alias", swap.op_kwargs["alias"])
+        self.assertEqual(["*:*"], swap.op_kwargs["warm_queries"])
+        self.assertEqual(2, swap.op_kwargs["keep"])
+
+    def test_blue_green_swap_sc_alias_collection(self):
+        """Test the swapped collection can be named, or pulled from another create task."""
+        dag = DAG(dag_id="test_blue_green_swap_sc_alias", start_date=DEFAULT_DATE)
+        sc_conn = Connection(conn_id="SOLRCLOUD", conn_type="http", host="http://localhost")
+        named = blue_green_swap_sc_alias(
+            dag=dag, sc_conn=sc_conn, sc_alias="my-alias", sc_coll_name="my-collection-v3"
+        )
+        pulled = blue_green_swap_sc_alias(
+            dag=DAG(dag_id="test_blue_green_swap_sc_alias_pulled", start_date=DEFAULT_DATE),
+            sc_conn=sc_conn,
+            sc_alias="my-alias",
+            create_task_id="create_next_catalog",
+        )
+
+        self.assertEqual("my-collection-v3", named.op_kwargs["collection"])
+        self.assertEqual(
+            "{{ ti.xcom_pull(task_ids='create_next_catalog') }}", pulled.op_kwargs["collection"]
+        )
+
+
+class TestS3ShardTasks(unittest.TestCase):
+    """Tests for sharding S3 keys across Airflow mapped tasks."""
+
+    @mock_aws
+    def test_shard_s3_keys(self):
+        conn = boto3.client("s3", aws_access_key_id="kittens", aws_secret_access_key="puppies")
+        conn.create_bucket(Bucket="test-bucket")
+        sizes = {"a": 900, "b": 500, "c": 400, "d": 300, "e": 100, "f": 100}
+        for key, size in sizes.items():
+            conn.put_object(Bucket="test-bucket", Key=f"source/{key}.xml", Body="x" * size)
+        conn.put_object(Bucket="test-bucket", Key="other/g.xml", Body="x")
+
+        shards = shard_s3_keys("test-bucket", "source", shards=2, access_id="kittens", access_secret="puppies")
+        self.assertEqual(shards, [
+            [["source/a.xml", "source/d.xml"], 0],
+            [["source/b.xml", "source/c.xml", "source/e.xml", "source/f.xml"], 1],
+        ])
+        shards = shard_s3_keys("test-bucket", "source", shards=10)
+        self.assertEqual(len(shards), 6)
+        self.assertEqual(shard_s3_keys("test-bucket", "missing", shards=2), [])
+
+    @mock_aws
+    def test_shard_s3_keys_from_manifest(self):
+        conn = boto3.client("s3", aws_access_key_id="kittens", aws_secret_access_key="puppies")
+        conn.create_bucket(Bucket="test-bucket")
+        manifest = harvest.RunManifest("dag/2019-08-30")
+        for size in [900, 500, 400, 300]:
+            manifest.add("x" * size, "dag/2019-08-30/new-updated", [])
+        manifest.add("x" * 100, "dag/2019-08-30/deleted", [])
+        manifest.write(bucket_name="test-bucket")
+
+        shards = shard_s3_keys(
+            "test-bucket", "dag/2019-08-30/new-updated", shards=2, manifest_key="dag/2019-08-30/manifest.json"
+        )
+        self.assertEqual(
+            [sorted(manifest.chunks[key]["bytes"] for key in keys) for (keys, _) in shards],
+            [[300, 900], [400, 500]],
+        )
+
+    def test_parallel_tasks(self):
+        dag = DAG(dag_id="test_parallel_tasks", start_date=DEFAULT_DATE)
+        op_kwargs = {"bucket": "test-bucket", "source_prefix": "source", "report_prefix": "report"}
+        shard, mapped, reduce = parallel_filter_s3_schematron(dag, op_kwargs, shards=8)
+        self.assertEqual(shard.task_id, "filter_s3_schematron_shards")
+        self.assertEqual(shard.op_kwargs["shards"], 8)
+        self.assertEqual(mapped.partial_kwargs["python_callable"], validate.filter_s3_schematron_shard)
+        self.assertEqual(mapped.partial_kwargs["op_kwargs"], op_kwargs)
+        self.assertIn("op_args", mapped.expand_input.value)
+        self.assertEqual(reduce.python_callable, validate.merge_schematron_shards)
+        self.assertIn("shard_results", reduce.op_kwargs)
+        self.assertEqual(shard.downstream_task_ids, {"filter_s3_schematron"})
+        self.assertEqual(reduce.upstream_task_ids, {"filter_s3_schematron"})
+
+        _, mapped, reduce = parallel_transform_s3_xsl(dag, op_kwargs)
+        self.assertEqual(mapped.task_id, "transform_s3_xsl")
+        self.assertEqual(mapped.partial_kwargs["python_callable"], transform.transform_s3_xsl_shard)
+        self.assertEqual(reduce.python_callable, transform.merge_transform_shards)
+        self.assertEqual(transform.merge_transform_shards([{"transformed": 3}, {"transformed": 4}]), {"transformed": 7})
+
 
 class TestTasksGetSolrUrl(unittest.TestCase):
     """Tests for tasks.get_solr_url function."""
@@ -1,11 +1,17 @@
 """Tests suite for tulflow.transform (functions for transforming XML or JSON in Airflow Tasks)."""
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
 import unittest
 import boto3
+import requests_mock
 
 from unittest.mock import patch
 from lxml import etree
 from moto import mock_aws
-from tulflow import transform
+from tulflow import harvest, transform
 
 
 class TestXSLTransform(unittest.TestCase):
@@ -143,3 +149,345 @@ class TestXSLTransform(unittest.TestCase):
             etree.tostring(test_output_content, pretty_print=True),
             etree.tostring(should_match_output, pretty_print=True)
         )
+
+
+class TestTransformPerFileOutput(unittest.TestCase):
+    """Regression test for transform output scaling with the number of source files."""
+
+    @mock_aws
+    @patch("tulflow.transform.prepare_saxon_engine", return_value="/tmp/saxon.jar")
+    @patch("subprocess.check_output")
+    def test_transform_s3_xsl_writes_only_each_files_records(self, mocked_subprocess, _saxon):
+        files = 300
+        conn = boto3.client("s3", aws_access_key_id="kittens", aws_secret_access_key="puppies")
+        conn.create_bucket(Bucket="test-bucket")
+        for number in range(files):
+            records = "".join(
+                f'<record airflow-record-id="rec-{number:03}-{index}"/>' for index in range(2)
+            )
+            conn.put_object(
+                Bucket="test-bucket",
+                Key=f"dag/filtered/{number:03}.xml",
+                Body=f"<collection>{records}</collection>",
+            )
+        mocked_subprocess.return_value = b"<doc><title>Cats</title></doc>"
+        kwargs = {
+            "bucket": "test-bucket",
+            "source_prefix": "dag/filtered",
+            "destination_prefix": "dag/transformed",
+            "access_id": "kittens",
+            "access_secret": "puppies",
+            "log_mode": "summary",
+        }
+        with patch("tulflow.process.generate_s3_object", wraps=transform.process.generate_s3_object) as upload:
+            with self.assertLogs():
+                result = transform.transform_s3_xsl(**kwargs)
+        self.assertEqual(result, {"transformed": files * 2})
+        uploaded = [call.args[0].getbuffer().nbytes for call in upload.call_args_list]
+        self.assertEqual(len(uploaded), files)
+        # Upload volume is linear: every destination file is the same size.
+        self.assertEqual(set(uploaded), {uploaded[0]})
+        output = etree.fromstring(
+            conn.get_object(Bucket="test-bucket", Key="dag/transformed/299.xml")["Body"].read()
+        )
+        self.assertEqual(
+            [record.get("airflow-record-id") for record in output],
+            ["rec-299-0", "rec-299-1"],
+        )
+        self.assertEqual(output.get("dag-id"), "no-dag-provided")
+
+
+class TestWithRecordId(unittest.TestCase):
+    """Test Class for adding airflow-record-ids to serialized XSLT results."""
+
+    def test_with_record_id_splices_start_tag(self):
+        result = b'<?xml version="1.0" encoding="UTF-8"?>\n<dc x="1>2" xmlns="urn:dc"><t/></dc>\n'
+        with patch("tulflow.transform.etree.fromstring") as fromstring:
+            fragment = transform.with_record_id(result, 'oai:1&"2')
+        fromstring.assert_not_called()
+        self.assertEqual(fragment, b'<dc x="1>2" xmlns="urn:dc" airflow-record-id="oai:1&amp;&quot;2"><t/></dc>')
+        self.assertEqual(transform.with_record_id(b"<dc\n/>", "oai:1"), b'<dc\n airflow-record-id="oai:1"/>')
+
+    def test_with_record_id_rejects_malformed_results(self):
+        for result in [b"<r/><s/>", b"<r><a/></r><s/>", b"<r></r><r></r>", b"<r>", b"<r/>text", b"<r></s>"]:
+            with self.subTest(result=result):
+                with self.assertRaises(etree.XMLSyntaxError):
+                    transform.with_record_id(result, "oai:1")
+        self.assertEqual(
+            transform.with_record_id(b"<r><r/></r>", "oai:1"),
+            b'<r airflow-record-id="oai:1"><r/></r>',
+        )
+
+    def test_with_record_id_falls_back_to_parsing(self):
+        latin1 = '<?xml version="1.0" encoding="ISO-8859-1"?><dc>caf\xe9</dc>'.encode("latin-1")
+        self.assertEqual(
+            transform.with_record_id(latin1, "oai:1"),
+            '<dc airflow-record-id="oai:1">caf\xe9</dc>'.encode("utf-8"),
+        )
+        self.assertEqual(
+            transform.with_record_id(b'<!-- note --><dc airflow-record-id="old"/>', "oai:1"),
+            b'<dc airflow-record-id="oai:1"/>',
+        )
+
+
+XSLT_1_0 = b"""<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+  <xsl:output method="xml" encoding="UTF-8"/>
+  <xsl:template match="/record">
+    <doc><title><xsl:value-of select="title"/></title></doc>
+  </xsl:template>
+</xsl:stylesheet>"""
+XSL_URL = "https://raw.githubusercontent.com/tulibraries/aggregator_mdx/main/transforms/test.xsl"
+
+
+class TestXslEngines(unittest.TestCase):
+    """Test Class for choosing & running XSLT engines."""
+
+    def test_lxml_engine_pickles_uncompiled(self):
+        engine = transform.LxmlXsltEngine(XSLT_1_0)
+        record = etree.fromstring("<collection><record><title>Cats</title></record></collection>")[0]
+        self.assertEqual(
+            transform.with_record_id(engine.transform(record), "oai:1"),
+            b'<doc airflow-record-id="oai:1"><title>Cats</title></doc>',
+        )
+        copy = pickle.loads(pickle.dumps(engine))
+        self.assertIsNone(copy._xslt)  # pylint: disable=protected-access
+        self.assertEqual(copy.transform(record), engine.transform(record))
+
+    @patch("tulflow.transform.prepare_saxon_engine", return_value="/tmp/saxon.jar")
+    def test_get_xsl_engine(self, _saxon):
+        kwargs = {"xsl_filename": "transforms/test.xsl"}
+        engine = transform.get_xsl_engine(**kwargs)
+        self.assertIsInstance(engine, transform.SaxonEngine)
+        self.assertEqual((engine.xsl, engine.saxon), (XSL_URL, "/tmp/saxon.jar"))
+        with open("tests/fixtures/xsl-sample-simple.xsl", "rb") as fixture_file:
+            xslt_2_0 = fixture_file.read()
+        with requests_mock.Mocker() as mocker:
+            mocker.get(XSL_URL, content=XSLT_1_0)
+            self.assertIsInstance(transform.get_xsl_engine(xsl_engine="auto", **kwargs), transform.LxmlXsltEngine)
+            mocker.get(XSL_URL, content=xslt_2_0)
+            with self.assertLogs():
+                self.assertIsInstance(transform.get_xsl_engine(xsl_engine="auto", **kwargs), transform.SaxonEngine)
+            self.assertIsInstance(transform.get_xsl_engine(xsl_engine="lxml", **kwargs), transform.LxmlXsltEngine)
+        with self.assertRaises(ValueError):
+            transform.get_xsl_engine(xsl_engine="xalan", **kwargs)
+
+    @mock_aws
+    @patch("subprocess.check_output")
+    def test_transform_s3_xsl_with_lxml(self, mocked_subprocess):
+        conn = boto3.client("s3", aws_access_key_id="kittens", aws_secret_access_key="puppies")
+        conn.create_bucket(Bucket="test-bucket")
+        conn.put_object(
+            Bucket="test-bucket",
+            Key="dag/filtered/1.xml",
+            Body='<collection><record airflow-record-id="oai:1"><title>Cats</title></record>'
+                 '<record airflow-record-id="oai:2"><title>Dogs</title></record></collection>',
+        )
+        kwargs = {
+            "bucket": "test-bucket",
+            "source_prefix": "dag/filtered",
+            "destination_prefix": "dag/transformed",
+            "xsl_filename": "transforms/test.xsl",
+            "xsl_engine": "lxml",
+        }
+        with requests_mock.Mocker() as mocker:
+            mocker.get(XSL_URL, content=XSLT_1_0)
+            with self.assertLogs():
+                self.assertEqual(transform.transform_s3_xsl(**kwargs), {"transformed": 2})
+        mocked_subprocess.assert_not_called()
+        self.assertEqual(
+            conn.get_object(Bucket="test-bucket", Key="dag/transformed/1.xml")["Body"].read(),
+            b'<collection dag-id="no-dag-provided" dag-timestamp="no-timestamp-provided">'
+            b'<doc airflow-record-id="oai:1"><title>Cats</title></doc>'
+            b'<doc airflow-record-id="oai:2"><title>Dogs</title></doc></collection>',
+        )
+
+
+class TestTransformFromManifest(unittest.TestCase):
+    """Test Class for transforming the files a harvest run manifest lists."""
+
+    @mock_aws
+    def test_transform_s3_xsl_from_manifest(self):
+        """Test only the files the manifest lists under the source prefix are transformed."""
+        conn = boto3.client("s3", aws_access_key_id="kittens", aws_secret_access_key="puppies")
+        conn.create_bucket(Bucket="test-bucket")
+        body = '<collection><record airflow-record-id="oai:1"><title>Cats</title></record></collection>'
+        manifest = harvest.RunManifest("dag/2019-08-30")
+        key = manifest.add(body, "dag/2019-08-30/new-updated", [["oai:1", 12, 60]])["key"]
+        manifest.write(bucket_name="test-bucket")
+        conn.put_object(Bucket="test-bucket", Key=key, Body=body)
+        # Not in the manifest, so not transformed.
+        conn.put_object(Bucket="test-bucket", Key="dag/2019-08-30/new-updated/stray", Body=body)
+        kwargs = {
+            "bucket": "test-bucket",
+            "source_prefix": "dag/2019-08-30/new-updated",
+            "destination_prefix": "dag/2019-08-30/transformed",
+            "manifest_key": "dag/2019-08-30/manifest.json",
+            "xsl_filename": "transforms/test.xsl",
+            "xsl_engine": "lxml",
+        }
+        with requests_mock.Mocker() as mocker:
+            mocker.get(XSL_URL, content=XSLT_1_0)
+            with self.assertLogs():
+                self.assertEqual(transform.transform_s3_xsl(**kwargs), {"transformed": 1})
+        transformed = conn.list_objects_v2(Bucket="test-bucket", Prefix="dag/2019-08-30/transformed/")
+        self.assertEqual(
+            [item["Key"] for item in transformed["Contents"]],
+            [key.replace("new-updated", "transformed")],
+        )
+
+
+class TestIncrementalTransform(unittest.TestCase):
+    """Test Class for skipping files already transformed on reruns."""
+
+    @mock_aws
+    def test_transform_s3_xsl_incremental(self):
+        """Test a rerun skips files already transformed from the same source & stylesheet."""
+        conn = boto3.client("s3", aws_access_key_id="kittens", aws_secret_access_key="puppies")
+        conn.create_bucket(Bucket="test-bucket")
+        for number in range(3):
+            conn.put_object(
+                Bucket="test-bucket",
+                Key=f"dag/filtered/{number}.xml",
+                Body=f'<collection><record airflow-record-id="oai:{number}"><title>{number}</title>'
+                     f'</record><record airflow-record-id="oai:{number}b"/></collection>',
+            )
+        kwargs = {
+            "bucket": "test-bucket",
+            "source_prefix": "dag/filtered",
+            "destination_prefix": "dag/transformed",
+            "xsl_filename": "transforms/test.xsl",
+            "xsl_engine": "lxml",
+            "incremental": True,
+        }
+        with requests_mock.Mocker() as mocker:
+            mocker.get(XSL_URL, content=XSLT_1_0)
+            with self.assertLogs():
+                self.assertEqual(transform.transform_s3_xsl(**kwargs), {"transformed": 6, "skipped": 0})
+            metadata = conn.head_object(Bucket="test-bucket", Key="dag/transformed/1.xml")["Metadata"]
+            self.assertEqual(metadata["tulflow-records"], "2")
+            self.assertTrue(metadata["tulflow-fingerprint"].endswith(":" + hashlib.sha1(XSLT_1_0).hexdigest()))
+
+            conn.put_object(
+                Bucket="test-bucket",
+                Key="dag/filtered/1.xml",
+                Body='<collection><record airflow-record-id="oai:1"><title>One</title></record></collection>',
+            )
+            with self.assertLogs() as log:
+                self.assertEqual(transform.transform_s3_xsl(**kwargs), {"transformed": 5, "skipped": 2})
+            self.assertEqual(
+                [line for line in log.output if "Transforming File" in line],
+                ["INFO:root:Transforming File dag/filtered/1.xml"],
+            )
+            self.assertIn(
+                b"<title>One</title>",
+                conn.get_object(Bucket="test-bucket", Key="dag/transformed/1.xml")["Body"].read(),
+            )
+
+            mocker.get(XSL_URL, content=XSLT_1_0.replace(b"<doc", b"<doc "))
+            with self.assertLogs():
+                self.assertEqual(transform.transform_s3_xsl(**kwargs), {"transformed": 5, "skipped": 0})
+
+
+class TestTransformShards(unittest.TestCase):
+    """Test Class for transforming S3 keys in shards & merging their results."""
+
+    @mock_aws
+    def test_transform_s3_xsl_shards_merge_counts_and_metrics(self):
+        """Test merged shard results add up every count & stage metric of the shards."""
+        conn = boto3.client("s3", aws_access_key_id="kittens", aws_secret_access_key="puppies")
+        conn.create_bucket(Bucket="test-bucket")
+        for number in range(3):
+            conn.put_object(
+                Bucket="test-bucket",
+                Key=f"dag/filtered/{number}.xml",
+                Body=f'<collection><record airflow-record-id="oai:{number}"/></collection>',
+            )
+        kwargs = {
+            "bucket": "test-bucket",
+            "source_prefix": "dag/filtered",
+            "destination_prefix": "dag/transformed",
+            "xsl_filename": "transforms/test.xsl",
+            "xsl_engine": "lxml",
+            "incremental": True,
+            "metrics": True,
+        }
+        with requests_mock.Mocker() as mocker:
+            mocker.get(XSL_URL, content=XSLT_1_0)
+            with self.assertLogs():
+                transform.transform_s3_xsl_shard(["dag/filtered/0.xml"], 0, **kwargs)
+                shard_results = [
+                    transform.transform_s3_xsl_shard(["dag/filtered/0.xml", "dag/filtered/1.xml"], 0, **kwargs),
+                    transform.transform_s3_xsl_shard(["dag/filtered/2.xml"], 1, **kwargs),
+                ]
+        merged = transform.merge_transform_shards(shard_results)
+        self.assertEqual((merged["transformed"], merged["skipped"]), (3, 1))
+        self.assertEqual(merged["metrics"]["xslt"]["records"], 2)
+        self.assertEqual(
+            merged["metrics"]["xslt"]["calls"],
+            sum(result["metrics"]["xslt"]["calls"] for result in shard_results),
+        )
+
+
+SAXON_URL = "https://repo1.maven.org/maven2/net/sf/saxon/Saxon-HE/12.5/Saxon-HE-12.5.jar"
+FAKE_JAR = b"PK fake saxon jar"
+
+
+@patch("tulflow.transform.SAXON_SHA1", hashlib.sha1(FAKE_JAR).hexdigest())
+class TestPrepareSaxonEngine(unittest.TestCase):
+    """Test Class for provisioning the Saxon jar."""
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def test_concurrent_provisioning_downloads_once(self):
+        paths = []
+
+        def prepare():
+            paths.append(transform.prepare_saxon_engine(saxon_path=self.cache_dir))
+
+        with requests_mock.Mocker() as mocker:
+            mocker.get(SAXON_URL, content=FAKE_JAR)
+            with self.assertLogs():
+                threads = [threading.Thread(target=prepare) for _ in range(8)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            self.assertEqual(mocker.call_count, 1)
+        jar_path = os.path.join(self.cache_dir, "saxon.jar")
+        self.assertEqual(paths, [jar_path] * 8)
+        with open(jar_path, "rb") as jar:
+            self.assertEqual(jar.read(), FAKE_JAR)
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ["saxon.jar", "saxon.jar.lock", "saxon.jar.sha1"])
+
+    def test_existing_jar_is_verified_once(self):
+        jar_path = os.path.join(self.cache_dir, "saxon.jar")
+        with open(jar_path, "wb") as jar:
+            jar.write(FAKE_JAR)
+        with patch("tulflow.transform.file_sha1", wraps=transform.file_sha1) as file_sha1:
+            self.assertEqual(transform.prepare_saxon_engine(saxon_path=self.cache_dir), jar_path)
+            self.assertEqual(transform.prepare_saxon_engine(saxon_path=self.cache_dir), jar_path)
+        self.assertEqual(file_sha1.call_count, 1)
+
+    def test_bad_download_leaves_nothing_behind(self):
+        with requests_mock.Mocker() as mocker:
+            mocker.get(SAXON_URL, content=b"truncated")
+            with self.assertLogs(), self.assertRaises(SystemExit):
+                transform.prepare_saxon_engine(saxon_path=self.cache_dir)
+        self.assertEqual(os.listdir(self.cache_dir), ["saxon.jar.lock"])
+
+    def test_configured_jar_or_cache_skips_network(self):
+        jar_path = os.path.join(self.cache_dir, "prebaked.jar")
+        with open(jar_path, "wb") as jar:
+            jar.write(FAKE_JAR)
+        with requests_mock.Mocker():
+            self.assertEqual(transform.prepare_saxon_engine(saxon_jar_path=jar_path), jar_path)
+            with patch.dict(os.environ, {"TULFLOW_SAXON_JAR": jar_path}):
+                self.assertEqual(transform.prepare_saxon_engine(), jar_path)
+            with patch.dict(os.environ, {"TULFLOW_SAXON_CACHE_DIR": self.cache_dir}):
+                self.assertEqual(
+                    transform.prepare_saxon_engine(saxon_jar="prebaked.jar"),
+                    jar_path,
+                )
+        with self.assertRaises(FileNotFoundError):
+            transform.prepare_saxon_engine(saxon_jar_path=jar_path + ".missing")
@@ -8,7 +8,7 @@ from unittest.mock import patch
 from airflow.sdk.exceptions import AirflowFailException
 from lxml import etree
 from moto import mock_aws
-from tulflow import validate
+from tulflow import harvest, validate
 
 
 class TestSchematronFiltering(unittest.TestCase):
@@ -243,6 +243,160 @@ class TestSchematronFiltering(unittest.TestCase):
         self.assertEqual(response, {"filtered": 0})
 
 
+    @mock_aws
+    @patch("tulflow.process.get_github_content")
+    def test_filter_s3_schematron_shards(self, mocked_get_github_content):
+        """Test Schematron Filtering shards of files, then merging shard counts & reports."""
+        access_id = self.kwargs.get("access_id")
+        access_secret = self.kwargs.get("access_secret")
+        bucket = self.kwargs.get("bucket")
+        conn = boto3.client("s3", aws_access_key_id=access_id, aws_secret_access_key=access_secret)
+        conn.create_bucket(Bucket=bucket)
+        keys = []
+        for fixture in ["sch-oai-valid.xml", "sch-oai-mix.xml", "sch-oai-invalid.xml"]:
+            keys.append(self.kwargs.get("source_prefix") + "/" + fixture)
+            with open("tests/fixtures/" + fixture, encoding="utf-8") as fixture_file:
+                conn.put_object(Bucket=bucket, Key=keys[-1], Body=fixture_file.read())
+        with open("tests/fixtures/sch-sample.sch", encoding="utf-8") as fixture_file:
+            mocked_get_github_content.return_value = fixture_file.read()
+
+        shard_results = [
+            validate.filter_s3_schematron_shard(keys[:2], 0, **self.kwargs),
+            validate.filter_s3_schematron_shard(keys[2:], 1, **self.kwargs),
+        ]
+        self.assertEqual(shard_results[1], {
+            "filtered": 5,
+            "records": 5,
+            "report": "dpla_test/harvest_filter-shard-1-invalid.csv",
+        })
+        with self.assertLogs() as log:
+            response = validate.merge_schematron_shards(shard_results, **self.kwargs)
+        self.assertEqual(response, {"filtered": 10})
+        self.assertIn("INFO:root:Total Filter Count: 10", log.output)
+
+        reports = conn.list_objects(Bucket=bucket, Prefix=self.kwargs.get("report_prefix"))
+        self.assertEqual([item["Key"] for item in reports["Contents"]], ["dpla_test/harvest_filter-invalid.csv"])
+        report = conn.get_object(Bucket=bucket, Key="dpla_test/harvest_filter-invalid.csv")["Body"].read()
+        self.assertEqual(report.count(b"id,report,record,source_file"), 1)
+        self.assertEqual(report.count(b"sch-oai-invalid.xml"), 5)
+        self.assertEqual(report.count(b"sch-oai-mix.xml"), 5)
+
+        shard_results[0]["records"] = 5
+        with self.assertRaises(AirflowFailException):
+            validate.merge_schematron_shards(shard_results, **self.kwargs)
+        merged_report = conn.get_object(Bucket=bucket, Key="dpla_test/harvest_filter-invalid.csv")["Body"].read()
+        self.assertEqual(merged_report, report)
+
+    @mock_aws
+    @patch("tulflow.process.get_github_content")
+    def test_schematron_filter_s3_incremental(self, mocked_get_github_content):
+        """Test a rerun skips files already filtered from the same source & schematron."""
+        bucket = self.kwargs.get("bucket")
+        conn = boto3.client("s3", aws_access_key_id="kittens", aws_secret_access_key="puppies")
+        conn.create_bucket(Bucket=bucket)
+        for name in ["sch-oai-valid.xml", "sch-oai-mix.xml"]:
+            with open(f"tests/fixtures/{name}", "rb") as fixture_file:
+                conn.put_object(Bucket=bucket, Key=f"dpla_test/transformed/{name}", Body=fixture_file.read())
+        with open("tests/fixtures/sch-sample.sch", "rb") as fixture_file:
+            mocked_get_github_content.return_value = fixture_file.read()
+        # A destination outside the source prefix, so reruns do not list the filtered files.
+        kwargs = dict(self.kwargs, destination_prefix="dpla_test/filtered", incremental=True)
+
+        def report():
+            return conn.get_object(Bucket=bucket, Key=first["report"])["Body"].read()
+
+        with self.assertLogs():
+            first = validate.schematron_filter_s3(**kwargs)
+        self.assertEqual(first["skipped"], 0)
+        first_report = report()
+        self.assertEqual(first_report.count(b"sch-oai-mix.xml"), 5)
+        with self.assertLogs() as log:
+            rerun = validate.schematron_filter_s3(**kwargs)
+        self.assertEqual(rerun, dict(first, skipped=2))
+        self.assertFalse([line for line in log.output if "Validating & Filtering File" in line])
+        self.assertEqual(report(), first_report)
+
+        with open("tests/fixtures/sch-oai-valid.xml", "rb") as fixture_file:
+            valid = fixture_file.read()
+        conn.put_object(Bucket=bucket, Key="dpla_test/transformed/sch-oai-valid.xml", Body=valid + b"\n")
+        with self.assertLogs() as log:
+            self.assertEqual(validate.schematron_filter_s3(**kwargs)["skipped"], 1)
+        self.assertIn("INFO:root:Validating & Filtering File: dpla_test/transformed/sch-oai-valid.xml", log.output)
+        self.assertEqual(report(), first_report)
+
+        conn.put_object(Bucket=bucket, Key="dpla_test/transformed/sch-oai-mix.xml", Body=valid)
+        with self.assertLogs() as log:
+            changed = validate.schematron_filter_s3(**kwargs)
+        self.assertEqual(changed["skipped"], 1)
+        self.assertIn("INFO:root:Validating & Filtering File: dpla_test/transformed/sch-oai-mix.xml", log.output)
+        self.assertEqual(report().count(b"sch-oai-mix.xml"), 0)
+
+        mocked_get_github_content.return_value += b"\n"
+        with self.assertLogs():
+            self.assertEqual(validate.schematron_filter_s3(**kwargs)["skipped"], 0)
+
+    @mock_aws
+    @patch("tulflow.process.get_github_content")
+    def test_filter_s3_schematron_shards_incremental(self, mocked_get_github_content):
+        """Test a sharded rerun keeps the skipped files' invalid records in the merged report."""
+        bucket = self.kwargs.get("bucket")
+        conn = boto3.client("s3", aws_access_key_id="kittens", aws_secret_access_key="puppies")
+        conn.create_bucket(Bucket=bucket)
+        keys = []
+        for name in ["sch-oai-mix.xml", "sch-oai-invalid.xml"]:
+            keys.append(f"dpla_test/transformed/{name}")
+            with open(f"tests/fixtures/{name}", "rb") as fixture_file:
+                conn.put_object(Bucket=bucket, Key=keys[-1], Body=fixture_file.read())
+        with open("tests/fixtures/sch-sample.sch", "rb") as fixture_file:
+            mocked_get_github_content.return_value = fixture_file.read()
+        kwargs = dict(self.kwargs, destination_prefix="dpla_test/filtered", incremental=True)
+
+        reports = []
+        for _ in range(2):
+            with self.assertLogs():
+                shard_results = [
+                    validate.filter_s3_schematron_shard(keys[:1], 0, **kwargs),
+                    validate.filter_s3_schematron_shard(keys[1:], 1, **kwargs),
+                ]
+                self.assertEqual(validate.merge_schematron_shards(shard_results, **kwargs), {"filtered": 10})
+            reports.append(
+                conn.get_object(Bucket=bucket, Key="dpla_test/harvest_filter-invalid.csv")["Body"].read()
+            )
+        self.assertEqual([result["skipped"] for result in shard_results], [1, 1])
+        self.assertEqual(reports[1], reports[0])
+        self.assertEqual(reports[1].count(b"sch-oai-mix.xml"), 5)
+        self.assertEqual(reports[1].count(b"sch-oai-invalid.xml"), 5)
+
+    @mock_aws
+    @patch("tulflow.process.get_github_content")
+    def test_schematron_filter_s3_from_manifest(self, mocked_get_github_content):
+        """Test only the files a run manifest lists under the source prefix are filtered."""
+        bucket = self.kwargs.get("bucket")
+        conn = boto3.client("s3", aws_access_key_id="kittens", aws_secret_access_key="puppies")
+        conn.create_bucket(Bucket=bucket)
+        with open("tests/fixtures/sch-oai-mix.xml", encoding="utf-8") as fixture_file:
+            body = fixture_file.read()
+        manifest = harvest.RunManifest("dpla_test")
+        key = manifest.add(body, "dpla_test/transformed", [])["key"]
+        manifest.write(bucket_name=bucket)
+        conn.put_object(Bucket=bucket, Key=key, Body=body)
+        # Not in the manifest, so not filtered.
+        conn.put_object(Bucket=bucket, Key="dpla_test/transformed/stray.xml", Body=body)
+        with open("tests/fixtures/sch-sample.sch", "rb") as fixture_file:
+            mocked_get_github_content.return_value = fixture_file.read()
+        kwargs = dict(self.kwargs, manifest_key="dpla_test/manifest.json")
+
+        with self.assertLogs() as log:
+            counts = validate.schematron_filter_s3(**kwargs)
+        self.assertEqual(counts["records"], 8)
+        self.assertIn(f"INFO:root:Validating & Filtering File: {key}", log.output)
+        filtered = conn.list_objects_v2(Bucket=bucket, Prefix="dpla_test/transformed-filtered/")
+        self.assertEqual(
+            [item["Key"] for item in filtered["Contents"]],
+            [key.replace("transformed", "transformed-filtered")],
+        )
+
+
 class TestSchematronReporting(unittest.TestCase):
     """Test Class for functions that generate reports on XML validated with Schematron."""
     maxDiff = None
@@ -3,26 +3,58 @@ tulflow.harvest
 ~~~~~~~~~~~~~~~
 This module contains objects to harvest data from one given location to another.
 """
+import contextlib
+import contextvars
 import hashlib
+import importlib
 import io
+import json
 import logging
-import pandas
-import sickle
+import queue
+import threading
+
+from datetime import datetime, timedelta, timezone
 
 from lxml import etree
-from sickle import Sickle
-from sickle.models import xml_to_dict
-from sickle.oaiexceptions import NoRecordsMatch
-from tulflow import process
+from tulflow import metrics, process
 
 NS = {
     "marc21": "http://www.loc.gov/MARC21/slim",
     "oai": "http://www.openarchives.org/OAI/2.0/"
 }
+# Defined in tulflow.harvest_sickle, so that importing this module does not import Sickle.
+SICKLE_CLASSES = ("HarvestResponse", "HarvestSickle", "HarvestIterator", "HarvestRecord")
 
 
+@metrics.instrumented("oai_to_s3")
 def oai_to_s3(**kwargs):
-    """Wrapper function for using OAI Harvest, Default Processor, and S3 Writer."""
+    """Wrapper function for using OAI Harvest, Default Processor, and S3 Writer.
+
+    With compact_bytes set, the small chunks left by the sets harvested are then merged into
+    files of about compact_bytes each. With write_manifest set, a RunManifest of the chunks
+    written is saved as {dag_id}/{timestamp}/manifest.json & its key returned as "manifest".
+    """
+    manifest = None
+    if kwargs.get("write_manifest"):
+        manifest = kwargs["manifest"] = RunManifest(
+            dag_s3_prefix(kwargs["dag"].dag_id, kwargs["timestamp"])
+        )
+    if int(kwargs.get("harvest_partitions") or 1) > 1:
+        # Loaded by name on first use: tulflow.harvest_async builds on this module.
+        results = importlib.import_module("tulflow.harvest_async").oai_to_s3_async(**kwargs)
+    else:
+        results = harvest_sets_to_s3(**kwargs)
+    if kwargs.get("compact_bytes"):
+        outdir = dag_s3_prefix(kwargs["dag"].dag_id, kwargs["timestamp"])
+        for subdir in ["/new-updated", "/deleted"]:
+            compact_s3_chunks(outdir + subdir, int(kwargs["compact_bytes"]), **kwargs)
+    if manifest is not None:
+        results["manifest"] = manifest.write(**kwargs)
+    return results
+
+
+def harvest_sets_to_s3(**kwargs):
+    """Harvest & process each OAI set in turn, writing chunks to S3; returns the counts."""
     kwargs["harvest_params"] = {
         "metadataPrefix": kwargs.get("metadata_prefix"),
         "from": kwargs.get("harvest_from_date"),
@@ -34,6 +66,7 @@ def oai_to_s3(**kwargs):
     oai_sets = generate_oai_sets(**kwargs)
     all_processed = []
     sets_with_no_records = []
+    set_counts = {}
     if oai_sets:
         for oai_set in oai_sets:
             kwargs["harvest_params"]["set"] = oai_set
@@ -45,26 +78,247 @@ def oai_to_s3(**kwargs):
             outdir = dag_s3_prefix(dag_id, dag_start_date)
             processed = process_xml(data, dag_write_string_to_s3, outdir, **kwargs)
             all_processed.append(processed)
+            set_counts[oai_set] = processed
     else:
         data = harvest_oai(**kwargs)
         if data == []:
-            sets_with_no_records.append(oai_set)
-        outdir = dag_s3_prefix(dag_id, dag_start_date)
-        processed = process_xml(data, dag_write_string_to_s3, outdir, **kwargs)
-        all_processed.append(processed)
+            sets_with_no_records.append(None)
+            logging.info("Skipping processing because the harvest has no data.")
+        else:
+            outdir = dag_s3_prefix(dag_id, dag_start_date)
+            processed = process_xml(data, dag_write_string_to_s3, outdir, **kwargs)
+            all_processed.append(processed)
     all_updated = sum(item["updated"] for item in all_processed)
     all_deleted = sum(item["deleted"] for item in all_processed)
     logging.info("Total OAI Records Harvested & Processed: %s", all_updated)
     logging.info("Total OAI Records Harvest & Marked for Deletion: %s", all_deleted)
     logging.info("Total sets with no records: %s", len(sets_with_no_records))
     logging.info("Sets with no records %s", sets_with_no_records)
+    log_set_counts(set_counts)
     return {
         "updated": all_updated,
         "deleted": all_deleted,
         "sets_with_no_records": sets_with_no_records,
+        "set_counts": set_counts,
     }
 
 
+def log_set_counts(set_counts):
+    """Log the updated & deleted record counts of each harvested set."""
+    for oai_set, counts in set_counts.items():
+        logging.info(
+            "Set %s: %s updated, %s deleted", oai_set, counts["updated"], counts["deleted"]
+        )
+
+
+def compact_s3_chunks(prefix, target_bytes, **kwargs):
+    """Merge the chunks under an S3 prefix smaller than target_bytes into files of about
+    target_bytes, deleting the merged chunks; returns the number of files written.
+
+    Chunks are merged in key order by concatenating their records under their shared
+    collection start & end tags. Chunks are found in, & their merge recorded to, the run's
+    manifest when given one; otherwise by listing the prefix.
+    """
+    access_id = kwargs.get("access_id")
+    access_secret = kwargs.get("access_secret")
+    bucket = kwargs.get("bucket_name")
+    manifest = kwargs.get("manifest")
+    if manifest is not None:
+        chunks = manifest.chunk_sizes(prefix + "/")
+    else:
+        chunks = process.list_s3_content_sizes(bucket, access_id, access_secret, prefix + "/")
+    small = [(key, size) for (key, size) in chunks or [] if size < target_bytes]
+    groups = [[]]
+    group_bytes = 0
+    for key, size in small:
+        if groups[-1] and group_bytes + size > target_bytes:
+            groups.append([])
+            group_bytes = 0
+        groups[-1].append(key)
+        group_bytes += size
+    written = 0
+    for keys in groups:
+        if len(keys) < 2:
+            continue
+        parts = [
+            split_collection(process.get_s3_content(bucket, key, access_id, access_secret))
+            for key in keys
+        ]
+        start, _, end = parts[0]
+        if any(part[0] != start or part[2] != end for part in parts):
+            logging.warning("Not compacting chunks under %s from different collections", prefix)
+            continue
+        merged = b"".join([start, *(body for (_, body, _) in parts), end])
+        merged_key = chunk_key(merged, prefix)
+        process.generate_s3_object(merged, bucket, merged_key, access_id, access_secret)
+        if manifest is not None:
+            manifest.merge(keys, merged, prefix, [len(body) for (_, body, _) in parts])
+        for key in keys:
+            process.remove_s3_object(bucket, key, access_id, access_secret)
+        written += 1
+        logging.info("Compacted %s chunks under %s into one file", len(keys), prefix)
+    return written
+
+
+def split_collection(chunk):
+    """Split a serialized chunk into its collection start tag, records & end tag."""
+    start = chunk.index(b">") + 1
+    end = chunk.rindex(b"</")
+    return chunk[:start], chunk[start:end], chunk[end:]
+
+
+class RunManifest:
+    """Index of the chunks a harvest run writes with dag_write_string_to_s3.
+
+    Each chunk's key, record count, byte size & md5, and the byte offset & length of each
+    of its records (by airflow-record-id). Later stages read it in place of listing the
+    run's prefix, balance work by chunk size, and fetch single records with ranged GETs;
+    a record's bytes parse within the run's collection start & end tags (record_element).
+    """
+
+    def __init__(self, outdir, chunks=None, collection=None):
+        self.outdir = outdir
+        self.chunks = {chunk["key"]: chunk for chunk in chunks or []}
+        self.collection = collection
+        self.lock = threading.Lock()
+
+    def add(self, chunk, prefix, record_index):
+        """Record a chunk about to be written under a prefix, with its OaiXml.record_index()."""
+        body = chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+        digest = hashlib.md5(body).hexdigest()
+        entry = {
+            "key": f"{prefix}/{digest}",
+            "record_count": len(record_index),
+            "bytes": len(body),
+            "md5": digest,
+            "records": record_index,
+        }
+        with self.lock:
+            self.chunks[entry["key"]] = entry
+            if record_index and self.collection is None:
+                start, _, end = split_collection(body)
+                self.collection = [start.decode("utf-8"), end.decode("utf-8")]
+        return entry
+
+    def merge(self, keys, merged, prefix, body_sizes):
+        """Replace the entries of chunks compacted into one, shifting their record offsets
+        by the records of the chunks merged ahead of them."""
+        with self.lock:
+            merged_records = []
+            shift = 0
+            for key, body_size in zip(keys, body_sizes):
+                for record_id, offset, length in self.chunks.pop(key)["records"]:
+                    merged_records.append([record_id, offset + shift, length])
+                shift += body_size
+        return self.add(merged, prefix, merged_records)
+
+    def chunk_sizes(self, prefix=""):
+        """(key, size) pairs of the chunks under a prefix, as process.list_s3_content_sizes."""
+        with self.lock:
+            return sorted(
+                (key, chunk["bytes"]) for (key, chunk) in self.chunks.items()
+                if key.startswith(prefix)
+            )
+
+    def record_locations(self):
+        """airflow-record-id -> (key, byte offset, byte length) of every record."""
+        with self.lock:
+            return {
+                record_id: (key, offset, length)
+                for (key, chunk) in self.chunks.items()
+                for (record_id, offset, length) in chunk["records"]
+            }
+
+    def record_element(self, record):
+        """Parse a record's bytes, e.g. from get_s3_record, under the run's collection."""
+        start, end = self.collection
+        collection = etree.fromstring(
+            start.encode("utf-8") + record + end.encode("utf-8"),
+            parser=etree.XMLParser(huge_tree=True),
+        )
+        return collection[0]
+
+    def to_dict(self):
+        with self.lock:
+            chunks = [self.chunks[key] for key in sorted(self.chunks)]
+        return {"outdir": self.outdir, "collection": self.collection, "chunks": chunks}
+
+    def write(self, **kwargs):
+        """Write the manifest as JSON next to the run's chunks; returns its key."""
+        key = f"{self.outdir}/manifest.json"
+        process.generate_s3_object(
+            json.dumps(self.to_dict()),
+            kwargs.get("bucket_name"),
+            key,
+            kwargs.get("access_id"),
+            kwargs.get("access_secret"),
+        )
+        logging.info("Wrote manifest of %s chunks to %s", len(self.chunks), key)
+        return key
+
+
+def load_manifest(bucket, key, access_id, access_secret):
+    """Read a RunManifest written by oai_to_s3."""
+    manifest = json.loads(process.get_s3_content(bucket, key, access_id, access_secret))
+    return RunManifest(manifest["outdir"], manifest["chunks"], manifest["collection"])
+
+
+def s3_content_sizes(bucket, access_id, access_secret, prefix="", manifest_key=None):
+    """(key, size) pairs of the objects under a prefix, read from a run manifest when
+    manifest_key is given; otherwise listed."""
+    if manifest_key:
+        return load_manifest(bucket, manifest_key, access_id, access_secret).chunk_sizes(prefix)
+    return process.list_s3_content_sizes(bucket, access_id, access_secret, prefix)
+
+
+def get_s3_record(bucket, location, access_id, access_secret):
+    """Get one record's bytes from its (key, byte offset, byte length) manifest location."""
+    key, offset, length = location
+    return process.get_s3_range(bucket, key, offset, length, access_id, access_secret)
+
+
+OAI_DATE_FORMATS = {
+    "day": ("%Y-%m-%d", timedelta(days=1)),
+    "second": ("%Y-%m-%dT%H:%M:%SZ", timedelta(seconds=1)),
+}
+
+
+def oai_date_granularity(oai_date):
+    """Return the OAI-PMH granularity ("day" or "second") of a from/until date."""
+    return "second" if "T" in str(oai_date) else "day"
+
+
+def partition_date_range(from_date, until_date, partitions):
+    """Split an OAI from/until window into up to N contiguous, non-overlapping sub-ranges.
+
+    Sub-ranges keep the granularity of from_date; an open until_date stays open on the last one.
+    """
+    if not from_date or int(partitions) <= 1:
+        return [(from_date, until_date)]
+    date_format, unit = OAI_DATE_FORMATS[oai_date_granularity(from_date)]
+    start = datetime.strptime(str(from_date), date_format)
+    if until_date:
+        until_format, until_unit = OAI_DATE_FORMATS[oai_date_granularity(until_date)]
+        # Latest instant covered by until_date, truncated to the granularity of from_date.
+        end = datetime.strptime(str(until_date), until_format) + until_unit - timedelta(seconds=1)
+    else:
+        end = datetime.now(timezone.utc).replace(tzinfo=None)
+    end = datetime.strptime(end.strftime(date_format), date_format)
+    units = (end - start) // unit + 1
+    partitions = min(int(partitions), units)
+    if partitions <= 1:
+        return [(from_date, until_date)]
+
+    ranges = []
+    for index in range(partitions):
+        range_start = start + unit * (units * index // partitions)
+        range_end = start + unit * (units * (index + 1) // partitions) - unit
+        ranges.append((range_start.strftime(date_format), range_end.strftime(date_format)))
+    ranges[0] = (from_date, ranges[0][1])
+    ranges[-1] = (ranges[-1][0], until_date)
+    return ranges
+
+
 def generate_oai_sets(**kwargs):
     """Generate the oai sets we want to harvest."""
     all_sets = bool(kwargs.get("all_sets"))
@@ -84,7 +338,8 @@ def generate_oai_sets(**kwargs):
         logging.info("Seeing Excluded SetSpec List.")
         if not isinstance(excluded_sets, list):
             excluded_sets = [excluded_sets]
-        list_sets = Sickle(oai_endpoint).ListSets()
+        from tulflow import harvest_sickle  # pylint: disable=import-outside-toplevel
+        list_sets = harvest_sickle.HarvestSickle(oai_endpoint).ListSets()
         all_sets = [oai_set.xml.find("oai:setSpec", namespaces=NS).text for oai_set in list_sets]
         remaining_sets = list(set(all_sets) - set(excluded_sets))
         logging.info(remaining_sets)
@@ -92,35 +347,12 @@ def generate_oai_sets(**kwargs):
     return []
 
 
-class HarvestIterator(sickle.iterator.OAIItemIterator):
-    """Custom iterator that skips deleted records and records without metadata."""
-
-    def next(self):
-        """Return the next record/header/set."""
-        while True:
-            for item in self._items:
-                mapped = self.mapper(item)
-                if self.ignore_deleted and mapped.deleted:
-                    continue
-                if hasattr(mapped, "metadata") and mapped.metadata is None:
-                    logging.info("Skipping record with no metadata: %s", mapped.header.identifier)
-                    continue
-                return mapped
-            if self.resumption_token and self.resumption_token.token:
-                self._next_response()
-            else:
-                raise StopIteration
-
-
-# TODO: Remove if https://github.com/mloesch/sickle/pull/47 gets merged.
-class HarvestRecord(sickle.models.Record):
-    """Custom Sickle record that unwraps metadata children."""
-
-    def get_metadata(self):
-        meta_data = self.xml.find(".//" + self._oai_namespace + "metadata")
-        if meta_data is not None:
-            return xml_to_dict(meta_data.getchildren()[0], strip_ns=self._strip_ns)
-        return None
+def __getattr__(name):
+    """The Sickle classes, imported (with Sickle) on first use rather than with this module."""
+    if name in SICKLE_CLASSES:
+        from tulflow import harvest_sickle  # pylint: disable=import-outside-toplevel
+        return getattr(harvest_sickle, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def harvest_oai(**kwargs):
@@ -129,15 +361,20 @@ def harvest_oai(**kwargs):
     harvest_params = kwargs.get("harvest_params")
     logging.info("Harvesting from %s", oai_endpoint)
     logging.info("Harvesting %s", harvest_params)
-    sickle_client = Sickle(oai_endpoint, retry_status_codes=[500, 503, 504], max_retries=3)
+    from tulflow import harvest_sickle  # pylint: disable=import-outside-toplevel
+    sickle_client = harvest_sickle.HarvestSickle(
+        oai_endpoint,
+        retry_status_codes=[500, 503, 504],
+        max_retries=3,
+    )
 
     class_mapping = harvest_params.get(
         "class_mapping",
         {
-            "ListRecords": HarvestRecord,
+            "ListRecords": harvest_sickle.HarvestRecord,
         },
     )
-    iterator = harvest_params.get("iterator", HarvestIterator)
+    iterator = harvest_params.get("iterator", harvest_sickle.HarvestIterator)
     for key in class_mapping:
         sickle_client.class_mapping[key] = class_mapping[key]
 
@@ -145,13 +382,13 @@ def harvest_oai(**kwargs):
 
     try:
         return sickle_client.ListRecords(**harvest_params)
-    except NoRecordsMatch:
+    except harvest_sickle.NoRecordsMatch:
         logging.info("No records found.")
         return []
 
 
 class OaiXml:
-    """oai-pmh xml etree wrapper"""
+    """oai-pmh xml collection, serialized record by record as records are appended."""
 
     def __init__(self, dag_id, timestamp):
         etree.register_namespace("oai", "http://www.openarchives.org/OAI/2.0/")
@@ -159,60 +396,224 @@ class OaiXml:
         self.root = etree.Element("{http://www.openarchives.org/OAI/2.0/}collection")
         self.root.attrib["dag-id"] = dag_id
         self.root.attrib["dag-timestamp"] = timestamp
+        self.records = []
+        self.record_ids = []
+        self.nbytes = 0
+        self._inherited_ns = [
+            f' xmlns:{prefix}="{uri}"'.encode("utf-8")
+            for (prefix, uri) in self.root.nsmap.items()
+        ]
 
     def append(self, record):
-        self.root.append(record)
+        """Serialize a record exactly as it would be inside the collection, then let it go.
+
+        Appending moves the record out of its harvested page (taking the collection's
+        namespace prefixes); removing it afterwards leaves nothing holding the page or record.
+        """
+        with metrics.timer("serialize", records=1) as stage:
+            self.root.append(record)
+            serialized = etree.tostring(record, encoding="utf-8")
+            self.root.remove(record)
+            stage.add(nbytes=len(serialized))
+        start_tag_end = serialized.find(b">")
+        for declaration in self._inherited_ns:
+            position = serialized.find(declaration, 0, start_tag_end)
+            if position != -1:
+                serialized = serialized[:position] + serialized[position + len(declaration):]
+                start_tag_end -= len(declaration)
+        self.records.append(serialized)
+        self.record_ids.append(record.get("airflow-record-id"))
+        self.nbytes += len(serialized)
+
+    def __len__(self):
+        return len(self.records)
+
+    def wrapper(self):
+        """The collection's serialized start & end tags."""
+        self.root.text = ""
+        wrapper = etree.tostring(self.root, encoding="utf-8")
+        self.root.text = None
+        split = wrapper.rindex(b"</")
+        return wrapper[:split], wrapper[split:]
 
     def tostring(self):
-        return etree.tostring(self.root, encoding="utf-8").decode("utf-8")
+        if not self.records:
+            return etree.tostring(self.root, encoding="utf-8").decode("utf-8")
+        start, end = self.wrapper()
+        return b"".join([start, *self.records, end]).decode("utf-8")
+
+    def record_index(self):
+        """[airflow-record-id, byte offset, byte length] of each record in tostring()'s
+        UTF-8 encoding."""
+        offset = len(self.wrapper()[0])
+        index = []
+        for record_id, serialized in zip(self.record_ids, self.records):
+            index.append([record_id, offset, len(serialized)])
+            offset += len(serialized)
+        return index
+
+
+# The harvest settings, running counts & two open chunks are each an attribute, read per record.
+class OaiXmlProcessor:  # pylint: disable=too-many-instance-attributes
+    """Sort harvested records into new-updated & deleted OaiXml chunks, ready for writing.
+
+    A chunk is cut at records_per_file records or, if chunk_bytes is set, once its serialized
+    records reach chunk_bytes bytes, whichever comes first.
+    """
+
+    def __init__(self, outdir, **kwargs):
+        self.outdir = outdir
+        self.kwargs = kwargs
+        self.parser = kwargs.get("parser")
+        self.records_per_file = int(kwargs.get("records_per_file") or 1000)
+        self.chunk_bytes = int(kwargs.get("chunk_bytes") or 0)
+        if kwargs.get("dag"):
+            self.run_id = kwargs.get("dag").dag_id
+        else:
+            self.run_id = "no-dag-provided"
+        if kwargs.get("timestamp"):
+            self.timestamp = kwargs.get("timestamp")
+        else:
+            self.timestamp = "no-timestamp-provided"
+        self.count = self.deleted_count = 0
+        self.manifest = kwargs.get("manifest")
+        self.record_log = metrics.record_logger("Processed", **kwargs)
+        self.oai_updates = OaiXml(self.run_id, self.timestamp)
+        self.oai_deletes = OaiXml(self.run_id, self.timestamp)
+
+    def add(self, record):
+        """Add a harvested record; return the (xml string, prefix) chunks now ready to write."""
+        record_id = record.header.identifier
+        record = record.xml
+        record.attrib["airflow-record-id"] = record_id
+        if self.parser:
+            with metrics.timer("parser_callback", records=1):
+                record = self.parser(record, **self.kwargs)
+        if record.xpath(".//oai:header[@status='deleted']", namespaces=NS):
+            self.record_log.log("Added record %s to deleted xml file(s)", record_id)
+            self.deleted_count += 1
+            self.oai_deletes.append(record)
+            if self.is_full(self.oai_deletes):
+                chunk = self.cut(self.oai_deletes, "/deleted")
+                self.oai_deletes = OaiXml(self.run_id, self.timestamp)
+                return [chunk]
+        else:
+            self.record_log.log("Added record %s to new-updated xml file", record_id)
+            self.count += 1
+            self.oai_updates.append(record)
+            if self.is_full(self.oai_updates):
+                chunk = self.cut(self.oai_updates, "/new-updated")
+                self.oai_updates = OaiXml(self.run_id, self.timestamp)
+                return [chunk]
+        return []
+
+    def is_full(self, oai_xml):
+        """Whether a chunk has reached the record count or byte size to be written."""
+        if len(oai_xml) >= self.records_per_file:
+            return True
+        return bool(self.chunk_bytes) and oai_xml.nbytes >= self.chunk_bytes
+
+    def flush(self):
+        """Return the remaining (xml string, prefix) chunks at the end of a harvest; empty
+        chunks are not written."""
+        chunks = [(self.oai_updates, "/new-updated"), (self.oai_deletes, "/deleted")]
+        return [self.cut(oai_xml, subdir) for (oai_xml, subdir) in chunks if len(oai_xml)]
+
+    def cut(self, oai_xml, subdir):
+        """Serialize a chunk for writing under outdir + subdir, adding it to the manifest."""
+        chunk = oai_xml.tostring()
+        prefix = self.outdir + subdir
+        if self.manifest is not None:
+            self.manifest.add(chunk, prefix, oai_xml.record_index())
+        return (chunk, prefix)
+
+    def results(self):
+        """Log & return the processed record counts."""
+        self.record_log.close()
+        logging.info("OAI Records Harvested & Processed: %s", self.count)
+        logging.info("OAI Records Harvest & Marked for Deletion: %s", self.deleted_count)
+        return {"updated": self.count, "deleted": self.deleted_count}
+
+
+class BackgroundWriter:
+    """Writer wrapper handing chunks to background upload threads through a bounded queue.
+
+    Calls block while max_pending chunks already wait for upload (backpressure). The first
+    upload error is raised by the next call or by close(), so a failed upload fails the task.
+    """
+
+    def __init__(self, writer, max_pending=2, workers=1):
+        self.writer = writer
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.errors = []
+        # Uploads run in the caller's context, so they count towards its metrics.
+        self.threads = [
+            threading.Thread(target=contextvars.copy_context().run, args=(self._upload,), daemon=True)
+            for _ in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def __call__(self, string, prefix, **kwargs):
+        self.raise_errors()
+        self.queue.put((string, prefix, kwargs))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, _exc, _traceback):
+        self.close(raise_errors=exc_type is None)
+
+    def _upload(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            string, prefix, kwargs = item
+            try:
+                if not self.errors:
+                    self.writer(string, prefix, **kwargs)
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                logging.error("Writing chunk to %s failed: %s", prefix, error)
+                self.errors.append(error)
+
+    def raise_errors(self):
+        if self.errors:
+            raise self.errors[0]
+
+    def close(self, raise_errors=True):
+        """Wait for queued uploads to finish; then raise the first upload error, if any."""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if raise_errors:
+            self.raise_errors()
+
+
+def background_writes(writer, **kwargs):
+    """Wrap writer in a BackgroundWriter when max_pending_writes is set; else use it as is."""
+    max_pending = int(kwargs.get("max_pending_writes") or 0)
+    if max_pending <= 0:
+        return contextlib.nullcontext(writer)
+    return BackgroundWriter(writer, max_pending, int(kwargs.get("write_workers") or 1))
 
 
 def process_xml(data, writer, outdir, **kwargs):
-    """Process & Write XML data to S3."""
-    parser = kwargs.get("parser")
-    records_per_file = kwargs.get("records_per_file")
-    if kwargs.get("dag"):
-        run_id = kwargs.get("dag").dag_id
-    else:
-        run_id = "no-dag-provided"
-    if kwargs.get("timestamp"):
-        timestamp = kwargs.get("timestamp")
-    else:
-        timestamp = "no-timestamp-provided"
-    if not records_per_file:
-        records_per_file = 1000
+    """Process & Write XML data to S3.
 
-    count = deleted_count = 0
-    oai_updates = OaiXml(run_id, timestamp)
-    oai_deletes = OaiXml(run_id, timestamp)
+    With max_pending_writes set, chunks upload in the background while harvesting goes on.
+    """
+    processor = OaiXmlProcessor(outdir, **kwargs)
     logging.info("Processing XML")
 
-    for record in data:
-        record_id = record.header.identifier
-        record = record.xml
-        record.attrib["airflow-record-id"] = record_id
-        if parser:
-            record = parser(record, **kwargs)
-        if record.xpath(".//oai:header[@status='deleted']", namespaces=NS):
-            logging.info("Added record %s to deleted xml file(s)", record_id)
-            deleted_count += 1
-            oai_deletes.append(record)
-
-            if deleted_count % int(records_per_file) == 0:
-                writer(oai_deletes.tostring(), outdir + "/deleted", **kwargs)
-                oai_deletes = OaiXml(run_id, timestamp)
-        else:
-            logging.info("Added record %s to new-updated xml file", record_id)
-            count += 1
-            oai_updates.append(record)
-            if count % int(records_per_file) == 0:
-                writer(oai_updates.tostring(), outdir + "/new-updated", **kwargs)
-                oai_updates = OaiXml(run_id, timestamp)
-    writer(oai_updates.tostring(), outdir + "/new-updated", **kwargs)
-    writer(oai_deletes.tostring(), outdir + "/deleted", **kwargs)
-    logging.info("OAI Records Harvested & Processed: %s", count)
-    logging.info("OAI Records Harvest & Marked for Deletion: %s", deleted_count)
-    return {"updated": count, "deleted": deleted_count}
+    with background_writes(writer, **kwargs) as chunk_writer:
+        for record in data:
+            for chunk, prefix in processor.add(record):
+                chunk_writer(chunk, prefix, **kwargs)
+        for chunk, prefix in processor.flush():
+            chunk_writer(chunk, prefix, **kwargs)
+    return processor.results()
 
 
 def perform_xml_lookup_with_cache():
@@ -228,13 +629,16 @@ def perform_xml_lookup_with_cache():
             bucket = kwargs.get("bucket_name")
             lookup_key = kwargs.get("lookup_key")
             csv_data = process.get_s3_content(bucket, lookup_key, access_id, access_secret)
+            import pandas  # pylint: disable=import-outside-toplevel
             cache["value"] = pandas.read_csv(io.BytesIO(csv_data), header=0)
+            cache["log"] = metrics.record_logger("Looked up", **kwargs)
 
         lookup_csv = cache["value"]
+        record_log = cache["log"]
 
         for record in oai_record.xpath(".//marc21:record", namespaces=NS):
             record_id = process.get_record_001(record)
-            logging.info("Reading in Record %s", record_id)
+            record_log.log("Reading in Record %s", record_id)
             parent_txt = lookup_csv.loc[lookup_csv.child_id == int(record_id), "parent_xml"].values
             if len(set(parent_txt)) >= 1:
                 logging.info("Child XML record found %s", record_id)
@@ -257,9 +661,17 @@ def dag_write_string_to_s3(string, prefix, **kwargs):
     bucket_name = kwargs.get("bucket_name")
     logging.info("Writing to S3 Bucket %s", bucket_name)
 
-    our_hash = hashlib.md5(string.encode("utf-8")).hexdigest()
-    filename = f"{prefix}/{our_hash}"
-    process.generate_s3_object(string, bucket_name, filename, access_id, access_secret)
+    filename = chunk_key(string, prefix)
+    # Uploads in a BackgroundWriter raise their errors, for it to fail the task with.
+    options = {"raise_errors": True} if kwargs.get("max_pending_writes") else {}
+    process.generate_s3_object(string, bucket_name, filename, access_id, access_secret, **options)
+
+
+def chunk_key(chunk, prefix):
+    """The S3 key of a chunk written under a prefix: the md5 of its contents."""
+    if isinstance(chunk, str):
+        chunk = chunk.encode("utf-8")
+    return f"{prefix}/{hashlib.md5(chunk).hexdigest()}"
 
 
 def write_log(string, prefix, **_kwargs):
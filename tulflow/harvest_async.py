@@ -0,0 +1,317 @@
+"""
+tulflow.harvest_async
+~~~~~~~~~~~~~~~~~~~~~
+This module contains an asyncio OAI-PMH client, an alternative harvest engine to Sickle.
+"""
+import asyncio
+import email.utils
+import logging
+import time
+
+import aiohttp
+from lxml import etree
+from sickle import oaiexceptions
+from sickle.iterator import VERBS_ELEMENTS
+from sickle.models import Set
+from tulflow import harvest, harvest_sickle, oai
+
+OAI_NAMESPACE = "{http://www.openarchives.org/OAI/2.0/}"
+RETRY_STATUS_CODES = (500, 503, 504)
+# harvest_params keys that configure tulflow, rather than being sent to the OAI endpoint.
+CLIENT_PARAMS = ("class_mapping", "iterator")
+
+
+# Its retry, timeout & mapping options mirror HarvestSickle's keyword arguments one to one.
+class AsyncOaiClient:  # pylint: disable=too-many-instance-attributes
+    """Non-blocking OAI-PMH client keeping the HarvestRecord/HarvestIterator semantics.
+
+    Use it as an async context manager; pass an existing aiohttp.ClientSession to share
+    one connection pool between many clients (sets or endpoints) in a single worker.
+    """
+
+    def __init__(
+        self,
+        endpoint,
+        session=None,
+        max_retries=3,
+        retry_status_codes=RETRY_STATUS_CODES,
+        backoff_factor=2,
+        max_retry_after=300,
+        timeout=300,
+        class_mapping=None,
+        ignore_deleted=False,
+    ):
+        self.endpoint = endpoint
+        self.session = session
+        self._owns_session = session is None
+        self.max_retries = max_retries
+        self.retry_status_codes = retry_status_codes
+        self.backoff_factor = backoff_factor
+        self.max_retry_after = max_retry_after
+        self.timeout = timeout
+        self.class_mapping = {
+            "ListRecords": harvest_sickle.HarvestRecord,
+            "ListSets": Set,
+        }
+        self.class_mapping.update(class_mapping or {})
+        self.ignore_deleted = ignore_deleted
+
+    async def __aenter__(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self
+
+    async def __aexit__(self, *_exc):
+        if self._owns_session and self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def get_retry_after(self, response, attempt):
+        """Seconds to wait before retrying: the Retry-After header if given, else backoff."""
+        retry_after = response.headers.get("Retry-After")
+        delay = None
+        if retry_after:
+            try:
+                delay = int(retry_after)
+            except ValueError:
+                retry_date = email.utils.parsedate_to_datetime(retry_after)
+                if retry_date is not None:
+                    delay = retry_date.timestamp() - time.time()
+        if delay is None:
+            delay = self.backoff_factor * (2 ** attempt)
+        return min(max(delay, 0), self.max_retry_after)
+
+    async def harvest(self, **params):
+        """Issue one OAI-PMH request & return the parsed response XML."""
+        query = encode_params(params)
+        for attempt in range(self.max_retries + 1):
+            async with self.session.get(self.endpoint, params=query) as response:
+                if response.status in self.retry_status_codes and attempt < self.max_retries:
+                    delay = self.get_retry_after(response, attempt)
+                    logging.warning(
+                        "HTTP %s from %s! Retrying after %s seconds...",
+                        response.status,
+                        self.endpoint,
+                        delay,
+                    )
+                else:
+                    response.raise_for_status()
+                    content = await response.read()
+                    return parse_oai_response(content)
+            await asyncio.sleep(delay)
+
+    async def iter_items(self, verb, **params):
+        """Asynchronously iterate over OAI items, following resumption tokens."""
+        mapper = self.class_mapping[verb]
+        element = OAI_NAMESPACE + VERBS_ELEMENTS[verb]
+        params = dict(params, verb=verb)
+        while True:
+            xml = await self.harvest(**params)
+            for item in xml.iterfind(".//" + element):
+                mapped = mapper(item)
+                if skip_item(mapped, self.ignore_deleted):
+                    continue
+                yield mapped
+            token = xml.find(".//" + OAI_NAMESPACE + "resumptionToken")
+            if token is None or not token.text:
+                return
+            params = {"verb": verb, "resumptionToken": token.text}
+
+    def list_records(self, **params):
+        """Issue an asynchronous ListRecords request."""
+        return self.iter_items("ListRecords", **params)
+
+    def list_sets(self, **params):
+        """Issue an asynchronous ListSets request."""
+        return self.iter_items("ListSets", **params)
+
+
+def skip_item(mapped, ignore_deleted):
+    """Apply HarvestIterator's skip rules to records; sets are never skipped."""
+    if not hasattr(mapped, "deleted"):
+        return False
+    return oai.skip_harvested_item(mapped, ignore_deleted)
+
+
+def encode_params(params):
+    """Drop empty & tulflow-only params and expand lists, as requests would for Sickle."""
+    query = []
+    for key, value in params.items():
+        if value is None or key in CLIENT_PARAMS:
+            continue
+        values = value if isinstance(value, (list, tuple)) else [value]
+        query.extend((key, str(item)) for item in values)
+    return query
+
+
+def parse_oai_response(content):
+    """Parse an OAI-PMH response & raise the matching Sickle exception for OAI errors."""
+    xml = etree.XML(content, parser=oai.OAI_PARSER)
+    error = xml.find(".//" + OAI_NAMESPACE + "error")
+    if error is not None:
+        code = error.attrib.get("code", "UNKNOWN")
+        description = error.text or ""
+        exception = getattr(oaiexceptions, code[0].upper() + code[1:], oaiexceptions.OAIError)
+        raise exception(description)
+    return xml
+
+
+async def harvest_oai_async(client, **kwargs):
+    """Asynchronously yield harvested records; yields nothing if no records match."""
+    harvest_params = kwargs.get("harvest_params")
+    logging.info("Harvesting from %s", client.endpoint)
+    logging.info("Harvesting %s", harvest_params)
+    try:
+        async for record in client.list_records(**harvest_params):
+            yield record
+    except oaiexceptions.NoRecordsMatch:
+        logging.info("No records found.")
+
+
+async def generate_oai_sets_async(client, **kwargs):
+    """Generate the oai sets we want to harvest, listing sets without blocking."""
+    excluded_sets = kwargs.get("excluded_sets")
+    if kwargs.get("all_sets") or kwargs.get("included_sets") or not excluded_sets:
+        return harvest.generate_oai_sets(**kwargs)
+    logging.info("Seeing Excluded SetSpec List.")
+    if not isinstance(excluded_sets, list):
+        excluded_sets = [excluded_sets]
+    all_sets = [oai_set.setSpec async for oai_set in client.list_sets()]
+    remaining_sets = list(set(all_sets) - set(excluded_sets))
+    logging.info(remaining_sets)
+    return remaining_sets
+
+
+async def process_xml_async(data, writer, outdir, **kwargs):
+    """Process an async stream of records & write XML chunks without blocking the loop."""
+    processor = harvest.OaiXmlProcessor(outdir, **kwargs)
+    logging.info("Processing XML")
+
+    async for record in data:
+        for chunk, prefix in processor.add(record):
+            await asyncio.to_thread(writer, chunk, prefix, **kwargs)
+    for chunk, prefix in processor.flush():
+        await asyncio.to_thread(writer, chunk, prefix, **kwargs)
+    return processor.results()
+
+
+async def unique_records(records, seen):
+    """Drop records already harvested with the same or a newer header datestamp.
+
+    A record changed mid-harvest is returned by two date ranges; the copy with the newest
+    datestamp is always kept, whichever range returns it first. An older copy that arrived
+    first has already been passed on, so the newer one is written after it.
+    seen maps identifier to datestamp for every record of the set's harvest, so its memory
+    grows with the set (roughly 200 bytes a record); it is only kept for partitioned harvests.
+    """
+    async for record in records:
+        identifier = record.header.identifier
+        datestamp = record.header.datestamp or ""
+        if identifier in seen and seen[identifier] >= datestamp:
+            logging.info("Skipping duplicate record %s", identifier)
+            continue
+        seen[identifier] = datestamp
+        yield record
+
+
+async def _harvest_and_process(client, harvest_params, outdir, seen=None, **kwargs):
+    """Harvest one ListRecords request & process it; None when it has no records."""
+    records = harvest_oai_async(client, **dict(kwargs, harvest_params=harvest_params))
+    if seen is not None:
+        records = unique_records(records, seen)
+    first = await anext(records, None)
+    if first is None:
+        return None
+
+    async def stream():
+        yield first
+        async for record in records:
+            yield record
+
+    return await process_xml_async(
+        stream(),
+        harvest.dag_write_string_to_s3,
+        outdir,
+        **dict(kwargs, harvest_params=harvest_params),
+    )
+
+
+async def harvest_to_s3_async(session=None, **kwargs):
+    """Coroutine version of harvest.oai_to_s3, harvesting sets concurrently.
+
+    With harvest_partitions > 1, each set's from/until window is also split into date
+    sub-ranges harvested concurrently; their counts are merged & records de-duplicated,
+    keeping the newest datestamp.
+    Gather several of these on one shared aiohttp session to drive many endpoints at once.
+    """
+    harvest_params = {
+        "metadataPrefix": kwargs.get("metadata_prefix"),
+        "from": kwargs.get("harvest_from_date"),
+        "until": kwargs.get("harvest_until_date")
+    }
+    outdir = harvest.dag_s3_prefix(kwargs["dag"].dag_id, kwargs["timestamp"])
+    partitions = int(kwargs.get("harvest_partitions") or 1)
+    semaphore = asyncio.Semaphore(int(kwargs.get("max_concurrent_harvests") or 4))
+
+    async with AsyncOaiClient(
+        kwargs.get("oai_endpoint"),
+        session=session,
+        max_retries=kwargs.get("max_retries", 3),
+    ) as client:
+        oai_sets = await generate_oai_sets_async(client, **kwargs)
+
+        async def harvest_range(params, seen):
+            async with semaphore:
+                return await _harvest_and_process(client, params, outdir, seen, **kwargs)
+
+        async def harvest_set(oai_set):
+            params = dict(harvest_params)
+            if oai_set is not None:
+                params["set"] = oai_set
+            ranges = harvest.partition_date_range(params["from"], params["until"], partitions)
+            seen = {} if len(ranges) > 1 else None
+            processed = await asyncio.gather(*[
+                harvest_range(dict(params, **{"from": from_date, "until": until_date}), seen)
+                for (from_date, until_date) in ranges
+            ])
+            processed = [item for item in processed if item is not None]
+            if not processed:
+                return None
+            return {
+                "updated": sum(item["updated"] for item in processed),
+                "deleted": sum(item["deleted"] for item in processed),
+            }
+
+        results = await asyncio.gather(*[harvest_set(oai_set) for oai_set in oai_sets or [None]])
+
+    all_processed = []
+    sets_with_no_records = []
+    set_counts = {}
+    for oai_set, processed in zip(oai_sets or [None], results):
+        if processed is None:
+            sets_with_no_records.append(oai_set)
+            logging.info("Skipping processing %s set because it has no data.", oai_set)
+        else:
+            all_processed.append(processed)
+            if oai_set is not None:
+                set_counts[oai_set] = processed
+    all_updated = sum(item["updated"] for item in all_processed)
+    all_deleted = sum(item["deleted"] for item in all_processed)
+    logging.info("Total OAI Records Harvested & Processed: %s", all_updated)
+    logging.info("Total OAI Records Harvest & Marked for Deletion: %s", all_deleted)
+    logging.info("Total sets with no records: %s", len(sets_with_no_records))
+    logging.info("Sets with no records %s", sets_with_no_records)
+    harvest.log_set_counts(set_counts)
+    return {
+        "updated": all_updated,
+        "deleted": all_deleted,
+        "sets_with_no_records": sets_with_no_records,
+        "set_counts": set_counts,
+    }
+
+
+def oai_to_s3_async(**kwargs):
+    """Airflow callable wrapping harvest_to_s3_async: OAI sets harvested concurrently to S3."""
+    return asyncio.run(harvest_to_s3_async(**kwargs))
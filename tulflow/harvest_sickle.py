@@ -0,0 +1,101 @@
+"""
+tulflow.harvest_sickle
+~~~~~~~~~~~~~~~~~~~~~~
+This module contains the Sickle client, response, iterator & record classes tulflow harvests
+with. tulflow.harvest imports it (and so Sickle & requests) only once a harvest starts.
+"""
+import functools
+
+import sickle
+from lxml import etree
+from sickle import Sickle
+from sickle.models import xml_to_dict
+from sickle.oaiexceptions import NoRecordsMatch  # pylint: disable=unused-import
+from tulflow import metrics, oai
+
+
+class HarvestResponse(sickle.response.OAIResponse):
+    """OAI response parsed once, with the tuned OAI_PARSER, rather than on every access."""
+
+    @functools.cached_property
+    def xml(self):
+        content = self.http_response.content
+        with metrics.timer("oai_parse", nbytes=len(content)):
+            return etree.XML(content, parser=oai.OAI_PARSER)
+
+
+class HarvestSickle(Sickle):
+    """Sickle client returning HarvestResponses."""
+
+    def harvest(self, **kwargs):
+        with metrics.timer("oai_fetch") as stage:
+            response = super().harvest(**kwargs)
+            stage.add(nbytes=len(response.http_response.content))
+        return HarvestResponse(response.http_response, params=response.params)
+
+
+class HarvestIterator(sickle.iterator.OAIItemIterator):
+    """Custom iterator that skips deleted records and records without metadata."""
+
+    def _next_response(self):
+        # Release the previous page first, so it can be freed before the next one is parsed.
+        self._items = iter(())
+        self.oai_response = None
+        super()._next_response()
+
+    def next(self):
+        """Return the next record/header/set."""
+        while True:
+            for item in self._items:
+                mapped = self.mapper(item)
+                if oai.skip_harvested_item(mapped, self.ignore_deleted):
+                    continue
+                return mapped
+            if self.resumption_token and self.resumption_token.token:
+                self._next_response()
+            else:
+                raise StopIteration
+
+
+class HarvestRecord(sickle.models.Record):
+    """Custom Sickle record keeping the lxml metadata element; its dict is built on request."""
+
+    # Record.__init__ is skipped on purpose: it converts the metadata to a dict eagerly (and
+    # assigns self.metadata, which is a lazy property here), the cost this class avoids. Only
+    # OAIItem.__init__, which sets xml & the namespace options, is run; header & deleted are
+    # set as Record.__init__ sets them.
+    def __init__(self, record_element, strip_ns=True):  # pylint: disable=super-init-not-called
+        sickle.models.OAIItem.__init__(  # pylint: disable=non-parent-init-called
+            self, record_element, strip_ns=strip_ns
+        )
+        self.header = sickle.models.Header(self.xml.find(self._oai_namespace + "header"))
+        self.deleted = self.header.deleted
+        self._metadata = None
+
+    @property
+    def metadata_element(self):
+        """The element wrapped by the record's metadata element, or None."""
+        meta_data = self.xml.find(self._oai_namespace + "metadata")
+        if meta_data is not None and len(meta_data):
+            return meta_data[0]
+        return None
+
+    @property
+    def has_metadata(self):
+        """Cheap check for metadata, without converting it to a dict."""
+        return self.metadata_element is not None
+
+    @property
+    def metadata(self):
+        """Metadata as a dict, like Sickle records; deleted records have none."""
+        if self.deleted:
+            raise AttributeError("Deleted records have no metadata.")
+        if self._metadata is None:
+            self._metadata = self.get_metadata()
+        return self._metadata
+
+    def get_metadata(self):
+        meta_data = self.metadata_element
+        if meta_data is not None:
+            return xml_to_dict(meta_data, strip_ns=self._strip_ns)
+        return None
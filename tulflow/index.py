@@ -0,0 +1,280 @@
+"""
+tulflow.index
+~~~~~~~~~~~~~
+This module contains objects to bulk index transformed XML records into SolrCloud.
+"""
+import contextvars
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+from lxml import etree
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from tulflow import metrics, process
+from tulflow.solr_api_utils import raise_for_solr_error
+
+# Updates & deletes by id are idempotent, so server errors are safe to retry.
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+# airflow-record-ids of the records in a harvested (e.g. deleted) OaiXml chunk.
+RECORD_IDS = etree.XPath("/*/*/@airflow-record-id")
+
+
+def record_to_solr_doc(record):
+    """Default doc builder: a Solr JSON doc with one field per child element of a record.
+
+    Solr XML style <field name="..."> children use their name attribute, any other child
+    its local element name; repeated fields become lists. The airflow-record-id is the id
+    unless the record has its own.
+    """
+    doc = {}
+    for field in record.iterchildren(etree.Element):
+        name = etree.QName(field).localname
+        if name == "field" and field.get("name"):
+            name = field.get("name")
+        doc.setdefault(name, []).append(field.text)
+    doc = {name: values[0] if len(values) == 1 else values for name, values in doc.items()}
+    if record.get("airflow-record-id") is not None:
+        doc.setdefault("id", record.get("airflow-record-id"))
+    return doc
+
+
+def iter_xml_records(source):
+    """Stream the records (children of the root element) of an XML file-like object,
+    clearing each record once it has been yielded."""
+    depth = 0
+    for event, element in etree.iterparse(source, events=("start", "end"), huge_tree=True):
+        if event == "start":
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1:
+            yield element
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+
+def list_s3_keys(bucket, prefix, access_id, access_secret):
+    """List the keys of every S3 object under a prefix, past the first 1000."""
+    sizes = process.list_s3_content_sizes(bucket, access_id, access_secret, prefix)
+    return [s3_key for (s3_key, _) in sizes or []]
+
+
+def iter_s3_records(bucket, prefix, access_id, access_secret):
+    """Stream the records of every XML file under an S3 prefix."""
+    for s3_key in list_s3_keys(bucket, prefix, access_id, access_secret):
+        logging.info("Indexing File %s", s3_key)
+        body = process.get_s3_stream(bucket, s3_key, access_id, access_secret)
+        if body is None:
+            continue
+        try:
+            yield from iter_xml_records(body)
+        finally:
+            body.close()
+
+
+def iter_s3_record_ids(bucket, prefix, access_id, access_secret):
+    """Stream the airflow-record-ids of every XML file under an S3 prefix."""
+    for s3_key in list_s3_keys(bucket, prefix, access_id, access_secret):
+        logging.info("Reading Record IDs from File %s", s3_key)
+        body = process.get_s3_stream(bucket, s3_key, access_id, access_secret)
+        if body is None:
+            continue
+        try:
+            tree = etree.parse(body, parser=etree.XMLParser(huge_tree=True))
+        finally:
+            body.close()
+        yield from (str(record_id) for record_id in RECORD_IDS(tree))
+
+
+def batched(items, size):
+    """Group an iterable into lists of at most `size` items."""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class SolrIndexer:
+    """Post batched JSON updates to a Solr collection over a pooled, retrying session.
+
+    Up to `concurrency` batches are in flight at once; commits are left to Solr through
+    commitWithin (milliseconds) rather than issued per batch.
+    """
+
+    def __init__(
+        self,
+        solr_url,
+        batch_size=500,
+        concurrency=4,
+        commit_within=10000,
+        max_retries=3,
+        backoff_factor=0.5,
+        auth_user=None,
+        auth_pass=None,
+        timeout=60,
+    ):
+        self.update_url = solr_url.rstrip("/") + "/update"
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.commit_within = commit_within
+        self.timeout = timeout
+        self.session = requests.Session()
+        if auth_user and auth_pass:
+            self.session.auth = (auth_user, auth_pass)
+        retries = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUS_CODES,
+            allowed_methods=frozenset(["POST"]),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(max_retries=retries, pool_maxsize=concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def post(self, body):
+        """Post one JSON update request to Solr."""
+        response = self.session.post(
+            self.update_url,
+            params={"commitWithin": self.commit_within, "wt": "json"},
+            json=body,
+            timeout=self.timeout,
+        )
+        raise_for_solr_error(response)
+        return response
+
+    def post_counted(self, body, count):
+        """Post one JSON update request to Solr, returning the number of items it held."""
+        with metrics.timer("solr_update", records=count):
+            self.post(body)
+        return count
+
+    def post_batches(self, batches):
+        """Post update request bodies concurrently, keeping at most `concurrency` in flight.
+
+        `batches` yields (body, item count) pairs; returns the items & requests posted.
+        """
+        posted = 0
+        requests_posted = 0
+        pending = set()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            try:
+                for body, count in batches:
+                    if len(pending) >= self.concurrency:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        posted += sum(future.result() for future in done)
+                    pending.add(executor.submit(
+                        contextvars.copy_context().run, self.post_counted, body, count
+                    ))
+                    requests_posted += 1
+                done, pending = wait(pending)
+                posted += sum(future.result() for future in done)
+            finally:
+                for future in pending:
+                    future.cancel()
+        return posted, requests_posted
+
+    def index(self, docs):
+        """Index an iterable of Solr docs in batches; returns throughput statistics."""
+        start = time.perf_counter()
+        indexed, requests_posted = self.post_batches(
+            (batch, len(batch)) for batch in batched(docs, self.batch_size)
+        )
+        return self.stats(indexed, requests_posted, start)
+
+    def delete(self, ids, batch_size=5000):
+        """Delete documents by id, many ids per request; returns throughput statistics."""
+        start = time.perf_counter()
+        deleted, requests_posted = self.post_batches(
+            ({"delete": batch}, len(batch)) for batch in batched(ids, batch_size)
+        )
+        return self.stats(deleted, requests_posted, start)
+
+    @staticmethod
+    def stats(count, requests_posted, start):
+        """Summarize a bulk run: documents, requests & documents per second."""
+        seconds = time.perf_counter() - start
+        docs_per_second = count / seconds if seconds > 0 else float(count)
+        logging.info(
+            "Sent %s documents in %s requests: %.1f docs/sec",
+            count,
+            requests_posted,
+            docs_per_second,
+        )
+        return {
+            "documents": count,
+            "requests": requests_posted,
+            "seconds": round(seconds, 3),
+            "docs_per_second": round(docs_per_second, 1),
+        }
+
+
+@metrics.instrumented("s3_to_solr")
+def s3_to_solr(**kwargs):
+    """Stream transformed XML records from an S3 prefix into Solr as batched JSON updates.
+
+    `doc_builder` (default record_to_solr_doc) turns each lxml record into a Solr doc.
+    """
+    indexer = SolrIndexer(
+        kwargs["solr_url"],
+        batch_size=int(kwargs.get("batch_size") or 500),
+        concurrency=int(kwargs.get("concurrency") or 4),
+        commit_within=int(kwargs.get("commit_within") or 10000),
+        max_retries=int(kwargs.get("max_retries", 3)),
+        auth_user=kwargs.get("solr_auth_user"),
+        auth_pass=kwargs.get("solr_auth_pass"),
+    )
+    doc_builder = kwargs.get("doc_builder") or record_to_solr_doc
+    records = iter_s3_records(
+        kwargs.get("bucket"),
+        kwargs.get("source_prefix"),
+        kwargs.get("access_id"),
+        kwargs.get("access_secret"),
+    )
+    return indexer.index(doc_builder(record) for record in records)
+
+
+@metrics.instrumented("s3_deletes_to_solr")
+def s3_deletes_to_solr(**kwargs):
+    """Stream the harvested deleted records' ids from S3 into batched Solr delete-by-id requests.
+
+    The source_prefix defaults to the harvest's deleted chunks for the dag & timestamp; the
+    Solr collection URL is solr_url, or built from solr_conn & collection.
+    """
+    if kwargs.get("source_prefix"):
+        source_prefix = kwargs["source_prefix"]
+    else:
+        from tulflow import harvest  # pylint: disable=import-outside-toplevel
+        source_prefix = harvest.dag_s3_prefix(kwargs["dag"].dag_id, kwargs["timestamp"]) + "/deleted"
+    solr_url = kwargs.get("solr_url")
+    auth_user = kwargs.get("solr_auth_user")
+    auth_pass = kwargs.get("solr_auth_pass")
+    if not solr_url:
+        from tulflow import tasks  # pylint: disable=import-outside-toplevel
+        solr_conn = kwargs["solr_conn"]
+        solr_url = tasks.get_solr_url(solr_conn, kwargs["collection"])
+        auth_user = auth_user or solr_conn.login
+        auth_pass = auth_pass or solr_conn.password
+    indexer = SolrIndexer(
+        solr_url,
+        concurrency=int(kwargs.get("concurrency") or 4),
+        commit_within=int(kwargs.get("commit_within") or 10000),
+        max_retries=int(kwargs.get("max_retries", 3)),
+        auth_user=auth_user,
+        auth_pass=auth_pass,
+    )
+    record_ids = iter_s3_record_ids(
+        kwargs.get("bucket"),
+        source_prefix,
+        kwargs.get("access_id"),
+        kwargs.get("access_secret"),
+    )
+    return indexer.delete(record_ids, batch_size=int(kwargs.get("delete_batch_size") or 5000))
@@ -0,0 +1,293 @@
+"""
+tulflow.metrics
+~~~~~~~~~~~~~~~
+This module contains lightweight per-stage timers & counters for tulflow pipelines, and
+per-record logging that can be sampled or summarized on hot paths.
+
+Metrics are only collected inside `collecting`, which Airflow callables enter when asked to
+through their kwargs (metrics, statsd_host or prometheus_textfile). Elsewhere `timer` & `count`
+are no-ops costing one context variable lookup.
+"""
+import contextvars
+import functools
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+CURRENT = contextvars.ContextVar("tulflow_metrics", default=None)
+
+
+class Stage:
+    """Running totals for one pipeline stage."""
+
+    __slots__ = ("calls", "records", "bytes", "seconds", "lock")
+
+    def __init__(self):
+        self.calls = 0
+        self.records = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, records=0, nbytes=0, seconds=0.0, calls=0):
+        """Add records, bytes, time or calls to the stage."""
+        with self.lock:
+            self.calls += calls
+            self.records += records
+            self.bytes += nbytes
+            self.seconds += seconds
+
+    def summary(self):
+        """Totals & records/bytes per second spent in the stage."""
+        return {
+            "calls": self.calls,
+            "records": self.records,
+            "bytes": self.bytes,
+            "seconds": round(self.seconds, 6),
+            "records_per_second": round(self.records / self.seconds, 1) if self.seconds else None,
+            "bytes_per_second": round(self.bytes / self.seconds, 1) if self.seconds else None,
+        }
+
+
+class NullStage:
+    """Stage stand-in used when metrics are disabled."""
+
+    __slots__ = ()
+
+    def add(self, records=0, nbytes=0, seconds=0.0, calls=0):
+        """Ignore the measurement."""
+
+
+NULL_STAGE = NullStage()
+NULL_TIMER = nullcontext(NULL_STAGE)
+
+
+class Metrics:
+    """Timers & counters for the stages of one pipeline run."""
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def stage(self, stage):
+        """Get (or start) the totals for a stage."""
+        try:
+            return self.stages[stage]
+        except KeyError:
+            with self.lock:
+                return self.stages.setdefault(stage, Stage())
+
+    @contextmanager
+    def timer(self, stage, records=0, nbytes=0):
+        """Time a block as one call of a stage; add records & bytes known later to the
+        yielded stage, e.g. stage.add(nbytes=len(body))."""
+        totals = self.stage(stage)
+        start = time.perf_counter()
+        try:
+            yield totals
+        finally:
+            totals.add(records, nbytes, time.perf_counter() - start, calls=1)
+
+    def count(self, stage, records=0, nbytes=0):
+        """Count records & bytes for a stage without timing it."""
+        self.stage(stage).add(records, nbytes)
+
+    def summary(self):
+        """Totals & throughput of every stage."""
+        return {stage: totals.summary() for (stage, totals) in sorted(self.stages.items())}
+
+    def statsd_lines(self, prefix="tulflow"):
+        """Stage totals as StatsD counters & timers."""
+        lines = []
+        for stage, totals in sorted(self.stages.items()):
+            key = f"{prefix}.{self.name}.{stage}"
+            lines.append(f"{key}.calls:{totals.calls}|c")
+            lines.append(f"{key}.records:{totals.records}|c")
+            lines.append(f"{key}.bytes:{totals.bytes}|c")
+            lines.append(f"{key}.seconds:{round(totals.seconds * 1000, 3)}|ms")
+        return lines
+
+    def send_statsd(self, host, port=8125, prefix="tulflow"):
+        """Send stage totals to a StatsD server over UDP."""
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            for line in self.statsd_lines(prefix):
+                sock.sendto(line.encode("utf-8"), (host, int(port)))
+
+    def prometheus_text(self, prefix="tulflow"):
+        """Stage totals in the Prometheus text exposition format."""
+        lines = []
+        for field in ["calls", "records", "bytes", "seconds"]:
+            metric = f"{prefix}_stage_{field}_total"
+            lines.append(f"# TYPE {metric} counter")
+            for stage, totals in sorted(self.stages.items()):
+                labels = f'pipeline="{self.name}",stage="{stage}"'
+                lines.append(f"{metric}{{{labels}}} {getattr(totals, field)}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus_textfile(self, path, prefix="tulflow"):
+        """Atomically write stage totals for the node exporter's textfile collector."""
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as textfile:
+            textfile.write(self.prometheus_text(prefix))
+        os.replace(temp_path, path)
+
+
+def timer(stage, records=0, nbytes=0):
+    """Time a block as one call of a stage of the current pipeline run, if collecting."""
+    current = CURRENT.get()
+    if current is None:
+        return NULL_TIMER
+    return current.timer(stage, records, nbytes)
+
+
+def count(stage, records=0, nbytes=0):
+    """Count records & bytes for a stage of the current pipeline run, if collecting."""
+    current = CURRENT.get()
+    if current is not None:
+        current.count(stage, records, nbytes)
+
+
+@contextmanager
+def collecting(name, **kwargs):
+    """Collect metrics for a pipeline run when kwargs ask for them, yielding Metrics or None.
+
+    Nested runs add to the enclosing run's metrics. On exit, totals are sent to StatsD
+    (statsd_host, statsd_port, statsd_prefix) & written to a Prometheus textfile
+    (prometheus_textfile) when configured.
+    """
+    enabled = kwargs.get("metrics") or kwargs.get("statsd_host") or kwargs.get("prometheus_textfile")
+    if not enabled or CURRENT.get() is not None:
+        yield CURRENT.get()
+        return
+    collected = Metrics(name)
+    token = CURRENT.set(collected)
+    try:
+        yield collected
+    finally:
+        CURRENT.reset(token)
+    for stage, totals in collected.summary().items():
+        logging.info("%s %s: %s", name, stage, totals)
+    prefix = kwargs.get("statsd_prefix") or "tulflow"
+    if kwargs.get("statsd_host"):
+        try:
+            collected.send_statsd(kwargs["statsd_host"], kwargs.get("statsd_port") or 8125, prefix)
+        except OSError as error:
+            logging.warning("Sending metrics to StatsD failed: %s", error)
+    if kwargs.get("prometheus_textfile"):
+        collected.write_prometheus_textfile(kwargs["prometheus_textfile"], prefix)
+
+
+def instrumented(name):
+    """Decorate an Airflow callable to collect metrics for its run, when its kwargs ask for
+    them, adding the summary to its returned dict."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(**kwargs):
+            with collecting(name, **kwargs) as collected:
+                result = func(**kwargs)
+            return with_summary(result, collected)
+        return wrapper
+    return decorator
+
+
+def with_summary(result, collected):
+    """Add the collected metrics summary to a callable's returned dict, if collecting."""
+    if collected is not None and isinstance(result, dict):
+        result["metrics"] = collected.summary()
+    return result
+
+
+def merge_summaries(summaries):
+    """Combine metrics summaries, e.g. of mapped tasks, adding up each stage's totals &
+    recomputing its throughput."""
+    merged = Metrics("merged")
+    for summary in summaries:
+        for stage, totals in summary.items():
+            merged.stage(stage).add(
+                totals["records"], totals["bytes"], totals["seconds"], totals["calls"]
+            )
+    return merged.summary()
+
+
+def merge_results(results):
+    """Combine the returned dicts of mapped tasks: numeric counts are added up & metrics
+    summaries merged; other values are left out."""
+    merged = {}
+    summaries = []
+    for result in results:
+        for key, value in result.items():
+            if key == "metrics":
+                summaries.append(value)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                merged[key] = merged.get(key, 0) + value
+    if summaries:
+        merged["metrics"] = merge_summaries(summaries)
+    return merged
+
+
+LOG_MODES = ("record", "sample", "summary")
+
+
+class RecordLogger:  # pylint: disable=too-many-instance-attributes
+    """Per-record log lines, in one of three modes.
+
+    record: every line, as before; sample: the first & then every `every`-th line;
+    summary: no record lines, but a progress line with the record rate every `interval`
+    seconds & once more on close(). Threads, e.g. transforming ranges of one file, may share
+    a logger.
+    """
+
+    def __init__(self, stage, mode="record", every=1000, interval=30):
+        if mode not in LOG_MODES:
+            raise ValueError(f"log_mode must be one of {LOG_MODES}, not {mode}")
+        self.stage = stage
+        self.mode = mode
+        self.every = max(int(every), 1)
+        self.interval = interval
+        self.count = 0
+        self.start = self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def log(self, msg, *args):
+        """Count a record & log its line, as the mode allows."""
+        with self.lock:
+            self.count += 1
+            number = self.count
+        if self.mode == "record":
+            logging.info(msg, *args)
+        elif self.mode == "sample":
+            if number % self.every == 1 or self.every == 1:
+                logging.info(msg + " (record %s)", *args, number)
+        else:
+            now = time.monotonic()
+            with self.lock:
+                due = now - self.last >= self.interval
+                if due:
+                    self.last = now
+            if due:
+                self.progress(now)
+
+    def progress(self, now=None):
+        """Log the records counted so far & their rate."""
+        seconds = (now or time.monotonic()) - self.start
+        rate = self.count / seconds if seconds > 0 else 0.0
+        logging.info("%s: %s records, %.1f records/sec", self.stage, self.count, rate)
+
+    def close(self):
+        """Log the final progress line in summary & sample modes."""
+        if self.mode != "record":
+            self.progress()
+
+
+def record_logger(stage, **kwargs):
+    """RecordLogger configured by the log_mode, log_sample_every & log_summary_seconds kwargs."""
+    return RecordLogger(
+        stage,
+        mode=kwargs.get("log_mode") or "record",
+        every=kwargs.get("log_sample_every") or 1000,
+        interval=float(kwargs.get("log_summary_seconds") or 30),
+    )
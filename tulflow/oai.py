@@ -0,0 +1,35 @@
+"""
+tulflow.oai
+~~~~~~~~~~~
+This module contains the OAI-PMH parsing & record filtering shared by tulflow's harvest
+engines (tulflow.harvest_sickle & tulflow.harvest_async); it imports no other tulflow module.
+"""
+import logging
+
+from lxml import etree
+
+# Reused for every OAI-PMH response: no network or DTD access, and no limits on large records.
+OAI_PARSER = etree.XMLParser(
+    remove_blank_text=True,
+    recover=True,
+    huge_tree=True,
+    no_network=True,
+    resolve_entities=False,
+    load_dtd=False,
+)
+
+
+def skip_harvested_item(mapped, ignore_deleted=False):
+    """Check if a mapped OAI item should be skipped (deleted if ignored, or without metadata)."""
+    if ignore_deleted and mapped.deleted:
+        return True
+    if getattr(mapped, "deleted", False):
+        return False
+    if hasattr(mapped, "has_metadata"):
+        missing_metadata = not mapped.has_metadata
+    else:
+        missing_metadata = hasattr(mapped, "metadata") and mapped.metadata is None
+    if missing_metadata:
+        logging.info("Skipping record with no metadata: %s", mapped.header.identifier)
+        return True
+    return False
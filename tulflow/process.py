@@ -3,11 +3,10 @@ import io
 import logging
 import sys
 import tarfile
-import boto3
-import requests
 
 from lxml import etree
 from botocore.exceptions import ClientError
+from tulflow import metrics
 
 NS = {
     "marc21": "http://www.loc.gov/MARC21/slim",
@@ -19,8 +18,12 @@ etree.register_namespace("oai", "http://www.openarchives.org/OAI/2.0")
 
 LOGGER = logging.getLogger("tulflow_process")
 PARSER = etree.XMLParser(remove_blank_text=True)
+# Destination object metadata recording what it was written from, for incremental reruns.
+FINGERPRINT = "tulflow-fingerprint"
 
 def s3_client(access_id, access_secret):
+    # boto3 & requests are imported on first use, keeping DAG parse time imports light.
+    import boto3  # pylint: disable=import-outside-toplevel
     kwargs = {}
     if access_id:
         kwargs["aws_access_key_id"] = access_id
@@ -93,6 +96,7 @@ def generate_bw_parent_field(parent_id):
 
 def get_github_content(repository, filename, branch="main"):
     """Get the contents of GitHub file."""
+    import requests  # pylint: disable=import-outside-toplevel
     raw_url = f"https://raw.githubusercontent.com/{repository}/{branch}/{filename}"
     try:
         resp = requests.get(raw_url, timeout=30)
@@ -113,14 +117,41 @@ def remove_s3_object(bucket, key, access_id, access_secret):
 def get_s3_content(bucket, key, access_id, access_secret):
     """Get the contents of S3 object located at given S3 Key."""
     try:
-        response = s3_client(access_id, access_secret).get_object(Bucket=bucket, Key=key)
-        body = response["Body"].read()
+        with metrics.timer("s3_get") as stage:
+            response = s3_client(access_id, access_secret).get_object(Bucket=bucket, Key=key)
+            body = response["Body"].read()
+            stage.add(nbytes=len(body))
+        return body
+    except ClientError as error:
+        LOGGER.error(error)
+        return None
+
+
+def get_s3_range(bucket, key, start, length, access_id, access_secret):
+    """Get `length` bytes of the S3 object located at given S3 Key, from byte `start`."""
+    try:
+        with metrics.timer("s3_get") as stage:
+            response = s3_client(access_id, access_secret).get_object(
+                Bucket=bucket, Key=key, Range=f"bytes={start}-{start + length - 1}"
+            )
+            body = response["Body"].read()
+            stage.add(nbytes=len(body))
         return body
     except ClientError as error:
         LOGGER.error(error)
         return None
 
 
+def get_s3_stream(bucket, key, access_id, access_secret):
+    """Get a streaming, file-like body for the S3 object located at given S3 Key."""
+    try:
+        response = s3_client(access_id, access_secret).get_object(Bucket=bucket, Key=key)
+        return response["Body"]
+    except ClientError as error:
+        LOGGER.error(error)
+        return None
+
+
 def list_s3_content(bucket, access_id, access_secret, prefix=""):
     """Get a list of S3 objects located in a Bucket at the given Prefix"""
     try:
@@ -135,8 +166,91 @@ def list_s3_content(bucket, access_id, access_secret, prefix=""):
         return None
 
 
-def generate_s3_object(body, bucket, key, access_id, access_secret):
+def list_s3_content_sizes(bucket, access_id, access_secret, prefix=""):
+    """Get (key, size) pairs of all S3 objects located in a Bucket at the given Prefix,
+    following pagination past 1000 objects."""
+    try:
+        paginator = s3_client(access_id, access_secret).get_paginator("list_objects_v2")
+        return [
+            (item["Key"], item["Size"])
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+            for item in page.get("Contents", [])
+        ]
+    except ClientError as error:
+        LOGGER.error(error)
+        return None
+
+
+def list_s3_content_etags(bucket, access_id, access_secret, prefix=""):
+    """Get {key: ETag} of all S3 objects located in a Bucket at the given Prefix."""
+    try:
+        paginator = s3_client(access_id, access_secret).get_paginator("list_objects_v2")
+        return {
+            item["Key"]: item["ETag"].strip('"')
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+            for item in page.get("Contents", [])
+        }
+    except ClientError as error:
+        LOGGER.error(error)
+        return None
+
+
+def get_s3_metadata(bucket, key, access_id, access_secret):
+    """Get the user metadata of the S3 object located at given S3 Key; None if there is none."""
+    try:
+        response = s3_client(access_id, access_secret).head_object(Bucket=bucket, Key=key)
+        return response["Metadata"]
+    except ClientError as error:
+        if error.response.get("Error", {}).get("Code") not in ("404", "NoSuchKey"):
+            LOGGER.error(error)
+        return None
+
+
+def written_from(bucket, key, fingerprint, access_id, access_secret):
+    """The metadata of the S3 object at key if it was written from the given fingerprint
+    (see FINGERPRINT), else None: it is missing, stale or was written without one."""
+    if fingerprint is None:
+        return None
+    metadata = get_s3_metadata(bucket, key, access_id, access_secret)
+    if metadata and metadata.get(FINGERPRINT) == fingerprint:
+        return metadata
+    return None
+
+
+def source_fingerprints(bucket, access_id, access_secret, prefix, digest):
+    """{key: fingerprint} of the S3 objects under a prefix: each one's ETag & the digest of
+    what processes it (e.g. a stylesheet), for written_from."""
+    etags = list_s3_content_etags(bucket, access_id, access_secret, prefix)
+    return {key: f"{etag}:{digest}" for (key, etag) in (etags or {}).items()}
+
+
+def fingerprint_metadata(fingerprint, **counts):
+    """Destination object metadata recording its source fingerprint & record counts."""
+    if fingerprint is None:
+        return None
+    metadata = {f"tulflow-{name}": str(count) for (name, count) in counts.items()}
+    metadata[FINGERPRINT] = fingerprint
+    return metadata
+
+
+def generate_s3_object(
+    body, bucket, key, access_id, access_secret, metadata=None, raise_errors=False
+):
+    """Write an S3 object from a string, bytes or a BytesIO buffer (uploaded in place, not
+    copied); errors are logged, and raised too with raise_errors."""
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    if isinstance(body, io.BytesIO):
+        nbytes = body.getbuffer().nbytes
+        body.seek(0)
+    else:
+        nbytes = len(body)
     try:
-        s3_client(access_id, access_secret).put_object(Bucket=bucket, Key=key, Body=body)
+        with metrics.timer("s3_put", nbytes=nbytes):
+            s3_client(access_id, access_secret).put_object(
+                Bucket=bucket, Key=key, Body=body, Metadata=metadata or {}
+            )
     except ClientError as error:
         LOGGER.error(error)
+        if raise_errors:
+            raise
@@ -1,12 +1,95 @@
 """Submodule for interating with SolrCloud API *not* through Airflow Connections."""
+import copy
 import logging
+import threading
+import time
+import uuid
+from bisect import bisect_left
 from collections import defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from re import compile as recompile
 from re import split as resplit
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+# Gateway & availability errors, retried for read-only calls only: a change (CREATE, DELETE,
+# CREATEALIAS, RELOAD...) answered with one of them may well have been accepted by Solr.
+RETRY_STATUS_CODES = (502, 503, 504)
+# Collections & ConfigSets API actions that only read state; calls without an action (e.g.
+# /api/cluster/configs or /select warm-up queries) are read-only too.
+READ_ONLY_ACTIONS = frozenset(["CLUSTERSTATUS", "LIST", "LISTALIASES", "REQUESTSTATUS"])
+ACTION = recompile(r"[?&]action=([^&]+)")
 
-class SolrApiUtils():
+
+def raise_for_solr_error(response):
+    """Raise an HTTPError carrying Solr's own error message for a failed response."""
+    try:
+        response.raise_for_status()
+    except requests.exceptions.HTTPError as http_error:
+        msg = response.json().get("error", {}).get(
+            "msg",
+            "Unknown error from Solr",
+        )
+        raise requests.exceptions.HTTPError(
+            f"{http_error} caused by\n{msg}"
+        ) from http_error
+
+
+def collection_base_name(collection):
+    """Strip a blue/green generation suffix (-N) from a collection name."""
+    return resplit(r"-(\d+)$", collection)[0]
+
+
+def collection_version(collection):
+    """Get the blue/green generation (N in collection-N) of a collection name, if any."""
+    split = resplit(r"-(\d+)$", collection)
+    return int(split[1]) if len(split) > 1 else None
+
+
+class ConfigsetIndex():
+    """Versioned ConfigSet names (name-N) parsed once: name to sorted versions."""
+
+    VERSION = recompile(r"-(\d+)")
+
+    def __init__(self, configsets):
+        self.configsets = configsets
+        versions = defaultdict(set)
+        for configset in configsets:
+            split = self.VERSION.split(configset, maxsplit=1)
+            if len(split) > 1:
+                config, version, *_ = split
+                versions[config].add(int(version))
+        self.versions = {config: sorted(found) for (config, found) in versions.items()}
+        self.latest = {
+            config: f"{config}-{found[-1]}" for (config, found) in self.versions.items()
+        }
+        self.names = sorted(self.versions)
+
+    def latest_version(self, config):
+        """Most recent versioned ConfigSet name for a ConfigSet, or None."""
+        return self.latest.get(config)
+
+    def most_recent(self):
+        """Most recent versioned ConfigSet name for every ConfigSet."""
+        return list(self.latest.values())
+
+    def with_prefix(self, prefix):
+        """Most recent versioned ConfigSet names for ConfigSets starting with prefix."""
+        start = bisect_left(self.names, prefix)
+        matches = []
+        for config in self.names[start:]:
+            if not config.startswith(prefix):
+                break
+            matches.append(self.latest[config])
+        return matches
+
+
+# One client per Solr cluster: its sessions, cached cluster state & admin API calls belong
+# together, so the attributes & public methods are not split across classes.
+class SolrApiUtils():  # pylint: disable=too-many-instance-attributes,too-many-public-methods
     """Class for interacting with SolrCloud API over HTTP."""
 
     @classmethod
@@ -22,11 +105,20 @@ class SolrApiUtils():
         numShards=None,
         replicationFactor=None,
         maxShardsPerNode=None,
+        max_retries=3,
+        backoff_factor=0.5,
     ):
-        """Method to remove & re-add collection to SolrCloud Alias."""
+        """Method to remove & re-add collection to SolrCloud Alias, from one cluster snapshot."""
         url = solr_url + (f":{solr_port}" if solr_port else "")
         logging.info("Trying %s", url)
-        sc = cls(url, auth_user=solr_auth_user, auth_pass=solr_auth_pass)
+        sc = cls(
+            url,
+            auth_user=solr_auth_user,
+            auth_pass=solr_auth_pass,
+            max_retries=max_retries,
+            backoff_factor=backoff_factor,
+            cluster_status=True,
+        )
         sc.remove_collection_from_alias(collection=collection, alias=alias)
         sc.delete_collection(collection)
         create_params = {
@@ -42,79 +134,388 @@ class SolrApiUtils():
         sc.create_collection(**cleaned_create_params)
         sc.add_collection_to_alias(collection=collection, alias=alias)
 
-    def __init__(self, solr_url, auth_user=None, auth_pass=None):
+    @classmethod
+    def remove_and_recreate_collections_from_aliases(
+        cls,
+        specs,
+        solr_url,
+        solr_port=None,
+        solr_auth_user=None,
+        solr_auth_pass=None,
+        max_workers=4,
+        max_retries=3,
+        backoff_factor=0.5,
+        poll_interval=1,
+        async_timeout=600,
+    ):
+        """Method to remove & re-add many collections to their aliases concurrently.
+
+        Each spec is a dict of remove_and_recreate_collection_from_alias arguments: collection,
+        alias & optionally configset, numShards, replicationFactor, maxShardsPerNode. Deletes
+        & creates are submitted as async Solr requests whose status is polled; collections
+        sharing an alias are refreshed one after another.
+        """
+        url = solr_url + (f":{solr_port}" if solr_port else "")
+        logging.info("Trying %s", url)
+        sc = cls(
+            url,
+            auth_user=solr_auth_user,
+            auth_pass=solr_auth_pass,
+            max_retries=max_retries,
+            backoff_factor=backoff_factor,
+            pool_maxsize=max_workers,
+            cluster_status=True,
+            poll_interval=poll_interval,
+            async_timeout=async_timeout,
+        )
+        sc.load_cluster_status()
+        alias_locks = {spec["alias"]: threading.Lock() for spec in specs}
+        # Each alias' specs run one after another on a client of their own, so a change failing
+        # (& dropping that client's cached state) never pulls state from under another alias'.
+        alias_clients = {alias: sc.fork() for alias in alias_locks}
+
+        def refresh(spec):
+            params = dict(spec)
+            collection = params.pop("collection")
+            alias = params.pop("alias")
+            with alias_locks[alias]:
+                client = alias_clients[alias]
+                client.remove_collection_from_alias(collection=collection, alias=alias)
+                client.delete_collection(collection, run_async=True)
+                client.create_collection(
+                    collection=collection,
+                    run_async=True,
+                    **{k: v for k, v in params.items() if v is not None},
+                )
+                client.add_collection_to_alias(collection=collection, alias=alias)
+            return collection
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [(spec, executor.submit(refresh, spec)) for spec in specs]
+        errors = []
+        for spec, future in futures:
+            error = future.exception()
+            if error is not None:
+                logging.error(
+                    "Refreshing %s in %s failed: %s", spec["collection"], spec["alias"], error
+                )
+                errors.append(error)
+        if errors:
+            raise errors[0]
+        return [spec["collection"] for spec in specs]
+
+    @classmethod
+    def create_next_collection_version(
+        cls,
+        collection,
+        solr_url,
+        configset="_default",
+        solr_port=None,
+        solr_auth_user=None,
+        solr_auth_pass=None,
+        numShards=None,
+        replicationFactor=None,
+        maxShardsPerNode=None,
+    ):
+        """Method to create the next blue/green generation (collection-N) of a collection.
+
+        Returns the new collection name, for indexing into before blue_green_swap_alias.
+        """
+        url = solr_url + (f":{solr_port}" if solr_port else "")
+        logging.info("Trying %s", url)
+        sc = cls(url, auth_user=solr_auth_user, auth_pass=solr_auth_pass, cluster_status=True)
+        next_collection = sc.next_collection_version(collection)
+        create_params = {
+            "configset": configset,
+            "numShards": numShards,
+            "replicationFactor": replicationFactor,
+            "maxShardsPerNode": maxShardsPerNode,
+        }
+        sc.create_collection(
+            collection=next_collection,
+            **{k: v for k, v in create_params.items() if v is not None},
+        )
+        return next_collection
+
+    @classmethod
+    def blue_green_swap_alias(
+        cls,
+        collection,
+        alias,
+        solr_url,
+        solr_port=None,
+        solr_auth_user=None,
+        solr_auth_pass=None,
+        warm_queries=None,
+        keep=2,
+    ):
+        """Method to warm up an indexed collection generation, swap it into an alias atomically
+        & delete old generations beyond the newest `keep`."""
+        url = solr_url + (f":{solr_port}" if solr_port else "")
+        logging.info("Trying %s", url)
+        sc = cls(url, auth_user=solr_auth_user, auth_pass=solr_auth_pass, cluster_status=True)
+        sc.warm_collection(collection, warm_queries or [])
+        sc.swap_collection_generation_in_alias(collection=collection, alias=alias)
+        return sc.delete_old_collection_versions(collection, keep=keep)
+
+    def __init__(
+        self,
+        solr_url,
+        auth_user=None,
+        auth_pass=None,
+        max_retries=3,
+        backoff_factor=0.5,
+        pool_maxsize=10,
+        cluster_status=False,
+        poll_interval=1,
+        async_timeout=600,
+        state_ttl=None,
+    ):
         self.solr_url = solr_url
         self.auth_user = auth_user
         self.auth_pass = auth_pass
         self.configsets = None
+        self.configset_index = None
         self.collections = None
         self.aliases = None
+        # Fill collections & aliases from one CLUSTERSTATUS snapshot, not LIST & LISTALIASES.
+        self.cluster_status = cluster_status
+        self.poll_interval = poll_interval
+        self.async_timeout = async_timeout
+        # Cached configsets/collections/aliases are re-fetched after state_ttl seconds (if set),
+        # or after a failed change; state_version counts every fetch & local change. Threads
+        # sharing a client read, fetch & change the cache under state_lock, but a failed change
+        # still drops the state for all of them (see fork for a client with its own cache).
+        self.state_lock = threading.RLock()
+        self.state_ttl = state_ttl
+        self.state_loaded_at = {}
+        self.state_version = 0
+        # Read-only calls retry gateway statuses too; changes, which are GETs as well but not
+        # idempotent, go through a session retrying only connections Solr never received.
+        self.session = self.build_session(max_retries, backoff_factor, pool_maxsize)
+        self.change_session = self.build_session(
+            max_retries, backoff_factor, pool_maxsize, status_forcelist=()
+        )
+
+    def build_session(
+        self, max_retries=3, backoff_factor=0.5, pool_maxsize=10, status_forcelist=RETRY_STATUS_CODES
+    ):
+        """Build a keep-alive HTTP session, authenticated & retrying failed connections & the
+        status_forcelist statuses; never reads that failed or timed out after a request was sent.
+        """
+        session = requests.Session()
+        if self.auth_user and self.auth_pass:
+            session.auth = (self.auth_user, self.auth_pass)
+        retries = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=0,
+            other=0,
+            backoff_factor=backoff_factor,
+            status_forcelist=status_forcelist,
+            allowed_methods=frozenset(["GET", "POST"]),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(max_retries=retries, pool_maxsize=pool_maxsize)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def fork(self):
+        """Copy this client, sharing its HTTP session but with its own copy of cached state."""
+        with self.state_lock:
+            client = copy.copy(self)
+            client.configsets = None if self.configsets is None else list(self.configsets)
+            client.collections = None if self.collections is None else list(self.collections)
+            client.aliases = None if self.aliases is None else dict(self.aliases)
+            client.state_loaded_at = dict(self.state_loaded_at)
+        client.state_lock = threading.RLock()
+        return client
+
+    def state_is_stale(self, scope):
+        """Check if cached state (configsets, collections or aliases) needs fetching."""
+        if getattr(self, scope, None) is None:
+            return True
+        if self.state_ttl is None:
+            return False
+        return time.monotonic() - self.state_loaded_at.get(scope, 0) > self.state_ttl
 
-    def get_from_solr_api(self, path, timeout=30):
+    def state_loaded(self, *scopes):
+        """Record that cached state was just fetched from Solr."""
+        now = time.monotonic()
+        with self.state_lock:
+            for scope in scopes:
+                self.state_loaded_at[scope] = now
+            self.state_version += 1
+
+    def state_changed(self):
+        """Record a local, in place change to cached state mirroring a successful Solr change."""
+        with self.state_lock:
+            self.state_version += 1
+
+    def invalidate(self, *scopes):
+        """Drop cached state so it is fetched from Solr on next use."""
+        with self.state_lock:
+            for scope in scopes:
+                setattr(self, scope, None)
+                self.state_loaded_at.pop(scope, None)
+                if scope == "configsets":
+                    self.configset_index = None
+            self.state_version += 1
+
+    @contextmanager
+    def refetch_on_error(self, *scopes):
+        """Invalidate cached state if a change fails, since Solr's state is then unknown."""
+        try:
+            yield
+        except Exception:
+            self.invalidate(*scopes)
+            raise
+
+    def get_from_solr_api(self, path, timeout=30, params=None):
         """Issue HTTP Get Request to SolrCloud API."""
         url = self.solr_url + path
         logging.info("Requesting %s", url)
-        if self.auth_user and self.auth_pass:
-            return requests.get(
-                url,
-                auth=(self.auth_user, self.auth_pass),
-                timeout=timeout,
-            )
-        return requests.get(url, timeout=timeout)
+        return self.session_for(path).get(url, timeout=timeout, params=params)
+
+    def session_for(self, path):
+        """The session for a call: status retrying for reads, connect-only retrying for changes."""
+        action = ACTION.search(path)
+        if action is None or action.group(1).upper() in READ_ONLY_ACTIONS:
+            return self.session
+        return self.change_session
+
+    def get_from_solr_api_async(self, path):
+        """Issue a Collections API call as an async Solr request & wait for it to finish."""
+        request_id = uuid.uuid4().hex
+        response = self.get_from_solr_api(f"{path}&async={request_id}")
+        raise_for_solr_error(response)
+        self.wait_for_request(request_id)
+        return response
+
+    def wait_for_request(self, request_id):
+        """Poll REQUESTSTATUS until an async Solr request completes, fails or times out."""
+        deadline = time.monotonic() + self.async_timeout
+        path = f"/solr/admin/collections?action=REQUESTSTATUS&requestid={request_id}"
+        while True:
+            response = self.get_from_solr_api(path)
+            raise_for_solr_error(response)
+            status = response.json().get("status", {})
+            state = status.get("state")
+            if state == "completed":
+                return status
+            if state in ("failed", "notfound"):
+                msg = status.get("msg", "Unknown error from Solr")
+                raise RuntimeError(f"Solr request {request_id} {state}: {msg}")
+            if time.monotonic() > deadline:
+                raise TimeoutError(
+                    f"Solr request {request_id} still {state} after {self.async_timeout}s"
+                )
+            time.sleep(self.poll_interval)
+
+    def load_cluster_status(self):
+        """Issue HTTP Get Request to SolrCloud API to snapshot Collections & Aliases at once."""
+        with self.state_lock:
+            cluster = self.get_from_solr_api(
+                "/solr/admin/collections?action=CLUSTERSTATUS"
+            ).json()["cluster"]
+            self.collections = list(cluster.get("collections", {}))
+            self.aliases = dict(cluster.get("aliases", {}))
+            self.state_loaded("collections", "aliases")
+        return cluster
 
     def get_configsets(self):
         """Issue HTTP Get Request to SolrCloud API to retrieve ConfigSets List."""
-        if getattr(self, "configsets", None) is None:
-            json_response = self.get_from_solr_api(
-                "/api/cluster/configs?omitHeader=true"
-            ).json()
-            try:
-                self.configsets = json_response["configSets"]
-            except KeyError as solr_error:
-                msg = json_response.get("error", {}).get(
-                    "msg",
-                    "Unknown error from Solr",
-                )
-                raise KeyError(f"{solr_error}: caused by\n{msg}") from solr_error
-        return self.configsets
+        with self.state_lock:
+            if self.state_is_stale("configsets"):
+                json_response = self.get_from_solr_api(
+                    "/api/cluster/configs?omitHeader=true"
+                ).json()
+                try:
+                    self.configsets = json_response["configSets"]
+                except KeyError as solr_error:
+                    msg = json_response.get("error", {}).get(
+                        "msg",
+                        "Unknown error from Solr",
+                    )
+                    raise KeyError(f"{solr_error}: caused by\n{msg}") from solr_error
+                self.state_loaded("configsets")
+            return self.configsets
+
+    def get_configset_index(self):
+        """Get the parsed ConfigSets index, built once per ConfigSets List snapshot."""
+        with self.state_lock:
+            configsets = self.get_configsets()
+            if self.configset_index is None or self.configset_index.configsets is not configsets:
+                self.configset_index = ConfigsetIndex(configsets)
+            return self.configset_index
 
     def most_recent_configsets(self):
         """Issue HTTP Get Request to SolrCloud API to retrieve Recent ConfigSets."""
-        configs = defaultdict(set)
-        for configset in self.get_configsets():
-            split = resplit(r"-(\d+)", configset)
-            if len(split) > 1:
-                config, version, *_ = split
-                configs[config].add(int(version))
-        return [
-            f"{configset}-{max(versions)}"
-            for (configset, versions) in configs.items()
-        ]
+        return self.get_configset_index().most_recent()
+
+    def latest_configset(self, configset):
+        """Get the most recent versioned name (configset-N) of a ConfigSet, or None."""
+        return self.get_configset_index().latest_version(configset)
+
+    def recent_configsets_with_prefix(self, prefix):
+        """Get the most recent versioned names of ConfigSets starting with prefix."""
+        return self.get_configset_index().with_prefix(prefix)
+
+    def create_configset(self, configset, base_configset="_default"):
+        """Issue HTTP Get Request to SolrCloud API to create a ConfigSet from a base ConfigSet."""
+        path = (
+            f"/solr/admin/configs?action=CREATE&name={configset}"
+            f"&baseConfigSet={base_configset}"
+        )
+        with self.refetch_on_error("configsets"):
+            raise_for_solr_error(self.get_from_solr_api(path))
+        with self.state_lock:
+            if self.configsets is not None:
+                self.configsets.append(configset)
+            self.configset_index = None
+            self.state_changed()
+        logging.info("ConfigSet %s created", configset)
+
+    def delete_configset(self, configset):
+        """Issue HTTP Get Request to SolrCloud API to delete a ConfigSet."""
+        path = f"/solr/admin/configs?action=DELETE&name={configset}"
+        with self.refetch_on_error("configsets"):
+            raise_for_solr_error(self.get_from_solr_api(path))
+        with self.state_lock:
+            if self.configsets is not None and configset in self.configsets:
+                self.configsets.remove(configset)
+            self.configset_index = None
+            self.state_changed()
+        logging.info("ConfigSet %s deleted", configset)
 
     def get_collections(self):
         """Issue HTTP Get Request to SolrCloud API to retrieve Collections List."""
-        if getattr(self, "collections", None) is None:
-            self.collections = self.get_from_solr_api(
-                "/solr/admin/collections?action=List"
-            ).json()["collections"]
-        return self.collections
+        with self.state_lock:
+            if self.state_is_stale("collections"):
+                if self.cluster_status:
+                    self.load_cluster_status()
+                else:
+                    self.collections = self.get_from_solr_api(
+                        "/solr/admin/collections?action=List"
+                    ).json()["collections"]
+                    self.state_loaded("collections")
+            return self.collections
 
-    def delete_collection(self, collection):
+    def delete_collection(self, collection, run_async=False):
         """Issue HTTP Get Request to SolrCloud API to delete a Collection."""
         if self.collection_exists(collection):
             path = "/solr/admin/collections?action=DELETE&name=" + collection
-            response = self.get_from_solr_api(path)
-            try:
-                response.raise_for_status()
-            except requests.exceptions.HTTPError as http_error:
-                msg = response.json().get("error", {}).get(
-                    "msg",
-                    "Unknown error from Solr",
-                )
-                raise requests.exceptions.HTTPError(
-                    f"{http_error} caused by\n{msg}"
-                ) from http_error
-            self.__unsetattr("collections")
+            with self.refetch_on_error("collections", "aliases"):
+                if run_async:
+                    response = self.get_from_solr_api_async(path)
+                else:
+                    response = self.get_from_solr_api(path)
+                raise_for_solr_error(response)
+            with self.state_lock:
+                if self.collections is not None and collection in self.collections:
+                    self.collections.remove(collection)
+                self.state_changed()
             logging.info("Collection %s deleted", collection)
         else:
             logging.info(
@@ -129,6 +530,7 @@ class SolrApiUtils():
         numShards=1,
         replicationFactor=1,
         maxShardsPerNode=1,
+        run_async=False,
     ):
         """Create a SolrCloud collection (not through Airflow Task; that is in tasks.py)"""
         path = (
@@ -138,18 +540,16 @@ class SolrApiUtils():
             f"&replicationFactor={replicationFactor}"
             f"&maxShardsPerNode={maxShardsPerNode}"
         )
-        response = self.get_from_solr_api(path)
-        try:
-            response.raise_for_status()
-        except requests.exceptions.HTTPError as http_error:
-            msg = response.json().get("error", {}).get(
-                "msg",
-                "Unknown error from Solr",
-            )
-            raise requests.exceptions.HTTPError(
-                f"{http_error} caused by\n{msg}"
-            ) from http_error
-        self.__unsetattr("collections")
+        with self.refetch_on_error("collections"):
+            if run_async:
+                response = self.get_from_solr_api_async(path)
+            else:
+                response = self.get_from_solr_api(path)
+            raise_for_solr_error(response)
+        with self.state_lock:
+            if self.collections is not None:
+                self.collections.append(collection)
+                self.state_changed()
         logging.info("Collection %s created", collection)
 
     def collection_exists(self, collection):
@@ -158,11 +558,16 @@ class SolrApiUtils():
 
     def get_aliases(self):
         """Issue HTTP Get Request to SolrCloud API to retrieve Aliases List."""
-        if getattr(self, "aliases", None) is None:
-            self.aliases = self.get_from_solr_api(
-                "/solr/admin/collections?action=ListAliases"
-            ).json()["aliases"]
-        return self.aliases
+        with self.state_lock:
+            if self.state_is_stale("aliases"):
+                if self.cluster_status:
+                    self.load_cluster_status()
+                else:
+                    self.aliases = self.get_from_solr_api(
+                        "/solr/admin/collections?action=ListAliases"
+                    ).json()["aliases"]
+                    self.state_loaded("aliases")
+            return self.aliases
 
     def create_or_modify_alias_and_set_collections(self, alias, collections):
         """Issue HTTP Get Request to SolrCloud API to update an Alias' Collections"""
@@ -171,24 +576,19 @@ class SolrApiUtils():
             f"/solr/admin/collections?action=CREATEALIAS&name={alias}"
             f"&collections={collectionlist}"
         )
-        response = self.get_from_solr_api(path)
-        try:
-            response.raise_for_status()
-        except requests.exceptions.HTTPError as http_error:
-            msg = response.json().get("error", {}).get(
-                "msg",
-                "Unknown error from Solr",
-            )
-            raise requests.exceptions.HTTPError(
-                f"{http_error} caused by\n{msg}"
-            ) from http_error
+        with self.refetch_on_error("aliases"):
+            raise_for_solr_error(self.get_from_solr_api(path))
         logging.info("%s is now an alias for collections %s", alias, collectionlist)
-        self.__unsetattr("aliases")
+        with self.state_lock:
+            if self.aliases is not None:
+                self.aliases[alias] = collectionlist
+                self.state_changed()
 
     def get_alias_collections(self, alias):
         """Issue HTTP Get Request to SolrCloud API to get Collections behind an Alias."""
-        if self.alias_exists(alias):
-            return self.get_aliases().get(alias).split(",")
+        collections = self.get_aliases().get(alias)
+        if collections is not None:
+            return collections.split(",")
         raise LookupError(f"{alias} is not an existing alias")
 
     def get_alias_collections_without_init(self, alias):
@@ -214,7 +614,6 @@ class SolrApiUtils():
                     alias=alias,
                     collections=collections,
                 )
-                self.__unsetattr("aliases")
             else:
                 raise ValueError("Cannot delete only collection from alias")
         else:
@@ -232,7 +631,68 @@ class SolrApiUtils():
             alias=alias,
             collections=collections,
         )
-        self.__unsetattr("aliases")
+
+    def collection_versions(self, collection):
+        """List the blue/green generations (collection-N) of a collection, newest first."""
+        base = collection_base_name(collection)
+        versions = [
+            existing for existing in self.get_collections()
+            if collection_version(existing) is not None
+            and collection_base_name(existing) == base
+        ]
+        return sorted(versions, key=collection_version, reverse=True)
+
+    def next_collection_version(self, collection):
+        """Name the next blue/green generation of a collection."""
+        versions = self.collection_versions(collection)
+        latest = collection_version(versions[0]) if versions else 0
+        return f"{collection_base_name(collection)}-{latest + 1}"
+
+    def warm_collection(self, collection, queries, timeout=60):
+        """Run warm-up queries against a collection to fill its Solr caches before it is live.
+
+        Each query is a dict of Solr request params, or a string used as `q`.
+        """
+        for query in queries:
+            params = {"q": query} if isinstance(query, str) else dict(query)
+            params.setdefault("rows", 0)
+            response = self.get_from_solr_api(
+                f"/solr/{collection}/select",
+                timeout=timeout,
+                params=params,
+            )
+            raise_for_solr_error(response)
+        logging.info("Collection %s warmed with %s queries", collection, len(queries))
+
+    def swap_collection_generation_in_alias(self, collection, alias):
+        """Point an alias at a collection generation in place of its other generations, in
+        one CREATEALIAS call so queries never see the alias without the collection."""
+        generations = set(self.collection_versions(collection))
+        if self.alias_exists(alias):
+            collections = [
+                existing for existing in self.get_alias_collections_without_init(alias)
+                if existing not in generations and existing != collection
+            ]
+        else:
+            collections = []
+        collections.append(collection)
+        self.create_or_modify_alias_and_set_collections(alias=alias, collections=collections)
+
+    def delete_old_collection_versions(self, collection, keep=2):
+        """Delete blue/green generations beyond the newest `keep`, unless an alias uses them."""
+        aliased = {
+            existing
+            for collections in self.get_aliases().values()
+            for existing in collections.split(",")
+        }
+        deleted = []
+        for old_collection in self.collection_versions(collection)[keep:]:
+            if old_collection in aliased:
+                logging.info("Keeping %s, it is still behind an alias", old_collection)
+                continue
+            self.delete_collection(old_collection)
+            deleted.append(old_collection)
+        return deleted
 
     def filter_init_collection(self, collections_list, init_collection_name=None):
         """Remove initial dummy collection added to create alias"""
@@ -243,7 +703,3 @@ class SolrApiUtils():
             def test(collection):
                 return collection != init_collection_name
         return [collection for collection in collections_list if test(collection)]
-
-    def __unsetattr(self, attr):
-        if hasattr(self, attr):
-            delattr(self, attr)
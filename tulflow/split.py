@@ -0,0 +1,188 @@
+"""
+tulflow.split
+~~~~~~~~~~~~~
+This module contains objects to split one large XML collection (e.g. an expanded Alma
+export) into byte ranges of whole records, processed in parallel & reassembled in order.
+
+Record boundaries come from a harvest run manifest's record index, or from a scan for the
+records' start & end tags, which is much cheaper than parsing the collection. Data may be
+bytes or an mmap; S3 objects indexed in a manifest are read range by range.
+"""
+import contextvars
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from lxml import etree
+from tulflow import metrics, process
+
+# A start or end tag, skipping the XML declaration, processing instructions, comments & DTD.
+TAG = re.compile(
+    rb"<!--.*?-->|<\?.*?\?>|<!\[CDATA\[.*?\]\]>|<![^>]*>"
+    rb"|<(/?)([^\s/>]+)(?:[^>\"'/]|/(?!>)|\"[^\"]*\"|'[^']*')*(/?)>",
+    re.S,
+)
+# The rest of a start tag from after its name: attributes, then > or />.
+TAG_REST = re.compile(rb"(?:[^>\"'/]|/(?!>)|\"[^\"]*\"|'[^']*')*(/?)>")
+# What may come between records: whitespace & comments.
+GAP = re.compile(rb"(?:\s|<!--.*?-->)*", re.S)
+PARSER = etree.XMLParser(huge_tree=True)
+
+
+class UnsplittableCollection(ValueError):
+    """A collection whose records a boundary scan can't find, e.g. with other elements or
+    processing instructions between them; process it whole instead."""
+
+
+def first_tags(data):
+    """The root & first record tag matches of a serialized collection (either may be None)."""
+    tags = (match for match in TAG.finditer(data) if match.group(2))
+    root = next(tags, None)
+    if root is None or root.group(3):
+        return root, None
+    record = next(tags, None)
+    if record is None or record.group(1):
+        return root, None
+    return root, record
+
+
+def record_boundaries(data):
+    """(start, end) byte offsets of each record (child element of the root) of a collection.
+
+    Found by scanning for the first record's tag name, counting nested tags of the same name;
+    raises UnsplittableCollection if anything but whitespace or comments lies between the
+    records.
+    """
+    root, first = first_tags(data)
+    if first is None:
+        return []
+    qname = first.group(2)
+    record_tags = re.compile(
+        rb"<!--.*?-->|<\?.*?\?>|<!\[CDATA\[.*?\]\]>|<(/?)" + re.escape(qname) + rb"(?=[\s/>])",
+        re.S,
+    )
+    boundaries = []
+    depth = 0
+    start = previous_end = root.end()
+    for match in record_tags.finditer(data, first.start()):
+        if match.group(1) is None:
+            continue
+        if match.group(1):
+            tag_end = data.find(b">", match.end()) + 1
+            depth -= 1
+            if depth < 0:
+                break
+            if depth == 0:
+                boundaries.append((start, tag_end))
+                previous_end = tag_end
+            continue
+        rest = TAG_REST.match(data, match.end())
+        if depth == 0:
+            if not GAP.fullmatch(data, previous_end, match.start()):
+                raise UnsplittableCollection(f"Collection has content other than <{qname.decode()}> records")
+            start = match.start()
+            if rest.group(1):
+                boundaries.append((start, rest.end()))
+                previous_end = rest.end()
+                continue
+        if not rest.group(1):
+            depth += 1
+    if boundaries and not GAP.fullmatch(data, previous_end, data.rfind(b"</")):
+        raise UnsplittableCollection(f"Collection has content other than <{qname.decode()}> records")
+    return boundaries
+
+
+def split_ranges(boundaries, parts):
+    """Group record boundaries into at most `parts` contiguous (start, end, records) ranges of
+    about equal size."""
+    if not boundaries:
+        return []
+    total = sum(end - start for (start, end) in boundaries)
+    target = total / max(int(parts), 1)
+    ranges = []
+    size = 0
+    range_start = None
+    count = 0
+    for start, end in boundaries:
+        if range_start is None:
+            range_start = start
+        size += end - start
+        count += 1
+        if size >= target * (len(ranges) + 1):
+            ranges.append((range_start, end, count))
+            range_start = None
+            count = 0
+    if range_start is not None:
+        ranges.append((range_start, boundaries[-1][1], count))
+    return ranges
+
+
+def collection_tags(data, boundaries):
+    """The bytes before the first record (XML declaration & root start tag) & after the last."""
+    return bytes(data[:boundaries[0][0]]), bytes(data[boundaries[-1][1]:])
+
+
+def parse_range(start_tags, records, end_tags):
+    """Parse a range of records as a collection of its own."""
+    return etree.fromstring(b"".join([start_tags, records, end_tags]), parser=PARSER)
+
+
+def map_ranges(func, read_range, ranges, start_tags, end_tags, workers=4):
+    """Run func on each range's records, parsed as a collection, in parallel threads;
+    returns func's results in range order.
+
+    read_range(start, end) returns a range's bytes, e.g. a slice or a ranged S3 GET.
+    """
+    def run(byte_range):
+        start, end, count = byte_range
+        with metrics.timer("split_range", records=count, nbytes=end - start):
+            return func(parse_range(start_tags, read_range(start, end), end_tags))
+
+    with ThreadPoolExecutor(max_workers=max(int(workers), 1)) as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, run, byte_range) for byte_range in ranges
+        ]
+        return [future.result() for future in futures]
+
+
+def process_collection(data, func, parts=4, workers=4):
+    """Split a serialized collection (bytes or mmap) into `parts` ranges by a boundary scan &
+    run func on each in parallel; returns func's results in order."""
+    with metrics.timer("boundary_scan", nbytes=len(data)):
+        boundaries = record_boundaries(data)
+    if not boundaries:
+        return []
+    ranges = split_ranges(boundaries, parts)
+    logging.info("Split %s records into %s ranges", len(boundaries), len(ranges))
+    start_tags, end_tags = collection_tags(data, boundaries)
+    return map_ranges(
+        func, lambda start, end: bytes(data[start:end]), ranges, start_tags, end_tags, workers
+    )
+
+
+def process_s3_collection(
+    bucket, key, func, access_id, access_secret, manifest=None, parts=4, workers=4
+):
+    """Run func on `parts` ranges of an S3 collection in parallel; returns func's results in order.
+
+    With a harvest RunManifest indexing the key, each range is read with its own ranged GET;
+    otherwise the object is read once & split by a boundary scan.
+    """
+    chunk = manifest.chunks.get(key) if manifest is not None else None
+    if chunk is None or not chunk["records"] or manifest.collection is None:
+        data = process.get_s3_content(bucket, key, access_id, access_secret)
+        return process_collection(data, func, parts, workers)
+    boundaries = [(offset, offset + length) for (_, offset, length) in chunk["records"]]
+    ranges = split_ranges(boundaries, parts)
+    logging.info("Split %s records of %s into %s ranges", len(boundaries), key, len(ranges))
+    start_tags, end_tags = (tag.encode("utf-8") for tag in manifest.collection)
+    return map_ranges(
+        func,
+        lambda start, end: process.get_s3_range(
+            bucket, key, start, end - start, access_id, access_secret
+        ),
+        ranges,
+        start_tags,
+        end_tags,
+        workers,
+    )
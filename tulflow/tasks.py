@@ -1,14 +1,18 @@
 """Generic Airflow Tasks Functions, Abstracted for Reuse."""
+import heapq
 import re
 import pprint
-from airflow.providers.http.operators.http import HttpOperator
-from airflow.providers.standard.operators.python import PythonOperator
-from tulflow.solr_api_utils import SolrApiUtils
+from tulflow import harvest, transform, validate
+
+# Airflow operators & SolrApiUtils (with requests) are imported inside the task functions, so
+# DAG files pay for them only when building those tasks.
+# pylint: disable=import-outside-toplevel
 
 PP = pprint.PrettyPrinter(indent=4)
 
 def create_sc_collection(dag, sc_conn_id, sc_coll_name, sc_coll_repl, sc_configset_name):
     """Creates a new SolrCloud Collection."""
+    from airflow.providers.http.operators.http import HttpOperator
     task_instance = HttpOperator(
         task_id="create_collection",
         method="GET",
@@ -32,6 +36,7 @@ def create_sc_collection(dag, sc_conn_id, sc_coll_name, sc_coll_repl, sc_configs
 
 def swap_sc_alias(dag, sc_conn_id, sc_coll_name, sc_configset_name):
     """Create or point an existing SolrCloud Alias to an existing SolrCloud Collection."""
+    from airflow.providers.http.operators.http import HttpOperator
     task_instance = HttpOperator(
         task_id="solr_alias_swap",
         method="GET",
@@ -51,6 +56,8 @@ def swap_sc_alias(dag, sc_conn_id, sc_coll_name, sc_configset_name):
 
 def refresh_sc_collection_for_alias(dag, sc_conn, sc_coll_name, sc_alias, configset,numShards=None, replicationFactor=None, maxShardsPerNode=None):
     """Removes collection from alias, deletes collection, creates new collection & adds to alias"""
+    from airflow.providers.standard.operators.python import PythonOperator
+    from tulflow.solr_api_utils import SolrApiUtils
     task_instance = PythonOperator(
         task_id="refresh_sc_collection_for_alias",
         python_callable=SolrApiUtils.remove_and_recreate_collection_from_alias,
@@ -70,6 +77,140 @@ def refresh_sc_collection_for_alias(dag, sc_conn, sc_coll_name, sc_alias, config
     )
     return task_instance
 
+def refresh_sc_collections_for_aliases(dag, sc_conn, specs, max_workers=4):
+    """Refreshes many collections in their aliases concurrently, each as above."""
+    from airflow.providers.standard.operators.python import PythonOperator
+    from tulflow.solr_api_utils import SolrApiUtils
+    task_instance = PythonOperator(
+        task_id="refresh_sc_collections_for_aliases",
+        python_callable=SolrApiUtils.remove_and_recreate_collections_from_aliases,
+        op_kwargs={
+            "specs": specs,
+            "solr_url": sc_conn.host,
+            "solr_port": sc_conn.port,
+            "solr_auth_user": sc_conn.login or "",
+            "solr_auth_pass": sc_conn.password or "",
+            "max_workers": max_workers,
+        },
+        dag=dag
+    )
+    return task_instance
+
+def create_next_sc_collection(dag, sc_conn, sc_coll_name, configset, numShards=None, replicationFactor=None, maxShardsPerNode=None):
+    """Creates the next blue/green generation of a collection; its name is the task's XCom"""
+    from airflow.providers.standard.operators.python import PythonOperator
+    from tulflow.solr_api_utils import SolrApiUtils
+    task_instance = PythonOperator(
+        task_id="create_next_sc_collection",
+        python_callable=SolrApiUtils.create_next_collection_version,
+        op_kwargs={
+            "collection": sc_coll_name,
+            "configset": configset,
+            "solr_url": sc_conn.host,
+            "solr_port": sc_conn.port,
+            "solr_auth_user": sc_conn.login or "",
+            "solr_auth_pass": sc_conn.password or "",
+            "numShards": numShards,
+            "replicationFactor": replicationFactor,
+            "maxShardsPerNode": maxShardsPerNode
+        },
+        dag=dag
+    )
+    return task_instance
+
+def blue_green_swap_sc_alias(dag, sc_conn, sc_alias, sc_coll_name=None, warm_queries=None, keep=2, create_task_id="create_next_sc_collection"):
+    """Warms an indexed collection generation, swaps it into an alias & cleans up old ones
+
+    The generation defaults to the one named by the create_task_id task's XCom.
+    """
+    from airflow.providers.standard.operators.python import PythonOperator
+    from tulflow.solr_api_utils import SolrApiUtils
+    if sc_coll_name is None:
+        sc_coll_name = "{{ ti.xcom_pull(task_ids='" + create_task_id + "') }}"
+    task_instance = PythonOperator(
+        task_id="blue_green_swap_sc_alias",
+        python_callable=SolrApiUtils.blue_green_swap_alias,
+        op_kwargs={
+            "collection": sc_coll_name,
+            "alias": sc_alias,
+            "solr_url": sc_conn.host,
+            "solr_port": sc_conn.port,
+            "solr_auth_user": sc_conn.login or "",
+            "solr_auth_pass": sc_conn.password or "",
+            "warm_queries": warm_queries,
+            "keep": keep
+        },
+        dag=dag
+    )
+    return task_instance
+
+def shard_s3_keys(bucket, source_prefix, shards=4, access_id=None, access_secret=None, manifest_key=None, **_kwargs):
+    """Split the S3 keys under a prefix into shards of roughly equal total object size.
+
+    Keys & sizes come from the harvest's run manifest when manifest_key is given, else a LIST.
+    Returns [s3_keys, shard] op_args for each non-empty shard, for dynamic task mapping.
+    """
+    shard_keys = [[] for _ in range(int(shards))]
+    loads = [(0, shard) for shard in range(int(shards))]
+    s3_objects = harvest.s3_content_sizes(
+        bucket, access_id, access_secret, source_prefix, manifest_key
+    )
+    # Largest objects first, each onto the currently lightest shard.
+    for key, size in sorted(s3_objects or [], key=lambda item: item[1], reverse=True):
+        load, shard = heapq.heappop(loads)
+        shard_keys[shard].append(key)
+        heapq.heappush(loads, (load + size, shard))
+    return [[sorted(keys), shard] for (shard, keys) in enumerate(shard_keys) if keys]
+
+def mapped_s3_shard_tasks(dag, task_id, shard_callable, reduce_callable, op_kwargs, shards=4):
+    """Shard the source_prefix keys, run shard_callable as mapped tasks, then reduce results.
+
+    Returns the (shard, mapped, reduce) tasks; the reduce task returns the combined result.
+    """
+    from airflow.providers.standard.operators.python import PythonOperator
+    shard_task = PythonOperator(
+        task_id=f"{task_id}_shards",
+        python_callable=shard_s3_keys,
+        op_kwargs={**op_kwargs, "shards": shards},
+        dag=dag
+    )
+    mapped_task = PythonOperator.partial(
+        task_id=task_id,
+        python_callable=shard_callable,
+        op_kwargs=op_kwargs,
+        dag=dag
+    ).expand(op_args=shard_task.output)
+    reduce_task = PythonOperator(
+        task_id=f"{task_id}_reduce",
+        python_callable=reduce_callable,
+        op_kwargs={**op_kwargs, "shard_results": mapped_task.output},
+        dag=dag
+    )
+    shard_task >> mapped_task >> reduce_task  # pylint: disable=pointless-statement
+    return shard_task, mapped_task, reduce_task
+
+def parallel_transform_s3_xsl(dag, op_kwargs, shards=4, task_id="transform_s3_xsl"):
+    """transform_s3_xsl spread over mapped tasks, each transforming a shard of the files"""
+    return mapped_s3_shard_tasks(
+        dag,
+        task_id,
+        transform.transform_s3_xsl_shard,
+        transform.merge_transform_shards,
+        op_kwargs,
+        shards,
+    )
+
+def parallel_filter_s3_schematron(dag, op_kwargs, shards=4, task_id="filter_s3_schematron"):
+    """filter_s3_schematron spread over mapped tasks, each filtering a shard of the files"""
+    return mapped_s3_shard_tasks(
+        dag,
+        task_id,
+        validate.filter_s3_schematron_shard,
+        validate.merge_schematron_shards,
+        op_kwargs,
+        shards,
+    )
+
 def get_solr_url(conn, core):
     """  Generates a solr url from  passed in connection and core.
 
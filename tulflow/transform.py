@@ -3,22 +3,131 @@ tulflow.transform
 ~~~~~~~~~~~~~~~
 This module contains objects to transform data using a known transform language.
 """
+import copy
+import fcntl
 import hashlib
+import io
 import logging
 import os
+import re
 import subprocess
 import sys
+import tempfile
 from pathlib import Path
 
-import requests
 from lxml import etree
 
-from tulflow import process
+from tulflow import harvest, metrics, process, split
+
+# A leading XML declaration, & a UTF-8 one (Saxon's default output encoding).
+XML_DECLARATION = re.compile(rb"\s*<\?xml\s[^>]*\?>\s*")
+UTF8_DECLARATION = re.compile(
+    rb"""^(?:(?!encoding).)*$|encoding\s*=\s*["']utf-8["']""", re.I | re.S
+)
+# The root element's start tag, attribute values quoted, ending in > or />.
+ROOT_START_TAG = re.compile(rb"""<([^\s/>!?]+)(?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|'[^']*'))*\s*(/?)>""")
+# An end tag closing the whole result.
+LAST_END_TAG = re.compile(rb"</([^\s/>!?]+)\s*>\Z")
+# Escapes for a double quoted attribute value, newlines & tabs included so they survive parsing.
+ATTRIBUTE_ESCAPES = str.maketrans({
+    "&": "&amp;",
+    "<": "&lt;",
+    '"': "&quot;",
+    "\n": "&#10;",
+    "\r": "&#13;",
+    "\t": "&#9;",
+})
+XSL_ENGINES = ("saxon", "lxml", "auto")
+SAXON_VERSION = "12.5"
+SAXON_SHA1 = "57c007520e2879387b8d13d0a512e9566eeffa73"
+
+
+class SaxonEngine:
+    """XSLT 2.0/3.0 engine: the Saxon HE jar, run once per record on the stylesheet URL."""
+
+    def __init__(self, xsl, saxon=None):
+        self.xsl = xsl
+        self.saxon = saxon
+
+    def transform(self, record):
+        """Transform a record element, returning the serialized result."""
+        if self.saxon is None:
+            self.saxon = prepare_saxon_engine()
+        return subprocess.check_output(
+            ["java", "-jar", self.saxon, "-xsl:" + self.xsl, "-s:-"],
+            input=etree.tostring(record, encoding="utf-8"),
+        )
+
+
+class LxmlXsltEngine:
+    """XSLT 1.0 engine run in-process by libxslt.
+
+    The stylesheet is compiled on first use & dropped when pickled, so an engine can be
+    handed to process pool workers, each compiling it once.
+    """
+
+    def __init__(self, stylesheet, base_url=None):
+        self.stylesheet = stylesheet
+        self.base_url = base_url
+        self._xslt = None
+
+    def __getstate__(self):
+        return dict(self.__dict__, _xslt=None)
+
+    def transform(self, record):
+        """Transform a record element, returning the serialized result."""
+        if self._xslt is None:
+            self._xslt = etree.XSLT(etree.fromstring(self.stylesheet, base_url=self.base_url))
+        return bytes(self._xslt(record))
+
+
+def get_xsl_engine(**kwargs):
+    """The XSLT engine for the xsl_repository, xsl_branch & xsl_filename kwargs.
+
+    xsl_engine is "saxon" (default), "lxml", or "auto": lxml for stylesheets declaring
+    version 1.0, else Saxon. saxon_cache_dir & saxon_jar_path go to prepare_saxon_engine.
+    """
+    engine = kwargs.get("xsl_engine") or "saxon"
+    if engine not in XSL_ENGINES:
+        raise ValueError(f"xsl_engine must be one of {XSL_ENGINES}, not {engine}")
+    repository = kwargs.get("xsl_repository", "tulibraries/aggregator_mdx")
+    branch = kwargs.get("xsl_branch", "main")
+    filename = kwargs.get("xsl_filename")
+    xsl = f"https://raw.githubusercontent.com/{repository}/{branch}/{filename}"
+
+    def saxon_engine():
+        saxon = prepare_saxon_engine(
+            saxon_path=kwargs.get("saxon_cache_dir"),
+            saxon_jar_path=kwargs.get("saxon_jar_path"),
+        )
+        return SaxonEngine(xsl, saxon)
+
+    if engine == "saxon":
+        return saxon_engine()
+    stylesheet = process.get_github_content(repository, filename, branch)
+    if engine == "auto":
+        version = etree.fromstring(stylesheet).get("version")
+        if version != "1.0":
+            logging.info("Using Saxon for XSLT %s stylesheet %s", version, xsl)
+            return saxon_engine()
+    return LxmlXsltEngine(stylesheet, base_url=xsl)
 
 
 # pylint: disable=unexpected-keyword-arg
+@metrics.instrumented("transform_s3_xsl")
 def transform_s3_xsl(**kwargs):
-    """Transform & Write XML data to S3 using Saxon XSLT Engine."""
+    """Transform & Write XML data to S3 using the Saxon (or, with xsl_engine, lxml) XSLT Engine.
+
+    Transforms every file under source_prefix, or only the given s3_keys; with manifest_key,
+    the files under source_prefix are read from the harvest's run manifest instead of listed.
+    With split_bytes set, files at least that large are split into split_parts ranges of
+    records transformed in parallel, their results written back in order; files the manifest
+    indexes are read range by range, never downloaded whole.
+
+    With incremental set, each destination file records its source file's ETag & the
+    stylesheet's SHA1 in its metadata, and files already written from the same source &
+    stylesheet are skipped, so reruns only do the remaining work.
+    """
     access_id = kwargs.get("access_id")
     access_secret = kwargs.get("access_secret")
     bucket = kwargs.get("bucket")
@@ -29,75 +138,266 @@ def transform_s3_xsl(**kwargs):
     else:
         run_id = "no-dag-provided"
 
-    saxon = prepare_saxon_engine()
-    transformed = etree.Element("collection")
-    transformed.attrib["dag-id"] = run_id
-    transformed.attrib["dag-timestamp"] = kwargs.get(
+    engine = get_xsl_engine(**kwargs)
+    collection = etree.Element("collection")
+    collection.attrib["dag-id"] = run_id
+    collection.attrib["dag-timestamp"] = kwargs.get(
         "timestamp",
         "no-timestamp-provided",
     )
-    xsl = (
-        f"https://raw.githubusercontent.com/"
-        f"{kwargs.get('xsl_repository', 'tulibraries/aggregator_mdx')}/"
-        f"{kwargs.get('xsl_branch', 'main')}/"
-        f"{kwargs.get('xsl_filename')}"
-    )
+    collection.text = ""
+    wrapper = etree.tostring(collection, encoding="utf-8")
+    end_tag = wrapper.rindex(b"</")
+    collection_start, collection_end = wrapper[:end_tag], wrapper[end_tag:]
 
-    for s3_key in process.list_s3_content(
-        bucket,
-        access_id,
-        access_secret,
-        source_prefix,
-    ):
-        logging.info("Transforming File %s", s3_key)
-        s3_content = process.get_s3_content(
+    manifest = None
+    if kwargs.get("manifest_key"):
+        manifest = harvest.load_manifest(bucket, kwargs["manifest_key"], access_id, access_secret)
+    s3_keys = kwargs.get("s3_keys")
+    if s3_keys is None and manifest is not None:
+        s3_keys = [key for (key, _) in manifest.chunk_sizes(source_prefix)]
+    if s3_keys is None:
+        s3_keys = process.list_s3_content(
             bucket,
-            s3_key,
             access_id,
             access_secret,
+            source_prefix,
         )
-        s3_xml = etree.fromstring(s3_content)
-        for record in s3_xml.iterchildren():
+    fingerprints = {}
+    if kwargs.get("incremental"):
+        fingerprints = process.source_fingerprints(
+            bucket, access_id, access_secret, source_prefix, stylesheet_digest(engine, **kwargs)
+        )
+    split_bytes = int(kwargs.get("split_bytes") or 0)
+    split_parts = int(kwargs.get("split_parts") or 4)
+    record_log = metrics.record_logger("Transformed", **kwargs)
+
+    def transform_records(source, engine=engine):
+        """Yield a collection's transformed records, each with its record id added."""
+        for record in source.iterchildren():
             record_id = record.get("airflow-record-id")
-            logging.info("Transforming Record %s", record_id)
-            result_str = subprocess.check_output(
-                ["java", "-jar", saxon, "-xsl:" + xsl, "-s:-"],
-                input=etree.tostring(record, encoding="utf-8"),
+            record_log.log("Transforming Record %s", record_id)
+            with metrics.timer("xslt", records=1) as stage:
+                result_str = engine.transform(record)
+                stage.add(nbytes=len(result_str))
+            yield with_record_id(result_str, record_id)
+
+    def transform_range(source):
+        # Each range gets its own copy of the engine, so lxml compiles its stylesheet per thread.
+        return list(transform_records(source, copy.copy(engine)))
+
+    def split_file(s3_key):
+        """Transform a large file's record ranges in parallel: (range results, None), or
+        (None, the file's content) to transform it whole, if it is small or can't be split."""
+        chunk = manifest.chunks.get(s3_key) if manifest is not None else None
+        s3_content = None
+        try:
+            if split_bytes and chunk is not None and chunk["bytes"] >= split_bytes:
+                return split.process_s3_collection(
+                    bucket,
+                    s3_key,
+                    transform_range,
+                    access_id,
+                    access_secret,
+                    manifest=manifest,
+                    parts=split_parts,
+                    workers=split_parts,
+                ), None
+            s3_content = process.get_s3_content(
+                bucket,
+                s3_key,
+                access_id,
+                access_secret,
             )
-            result = etree.fromstring(result_str)
-            result.attrib["airflow-record-id"] = record_id
-            transformed.append(result)
+            if not split_bytes or len(s3_content) < split_bytes:
+                return None, s3_content
+            return split.process_collection(
+                s3_content, transform_range, parts=split_parts, workers=split_parts
+            ), None
+        except split.UnsplittableCollection as error:
+            logging.warning("Transforming File %s whole, it can't be split: %s", s3_key, error)
+        if s3_content is None:
+            s3_content = process.get_s3_content(bucket, s3_key, access_id, access_secret)
+        return None, s3_content
+
+    def transform_file(s3_key):
+        """Yield a source file's transformed records, from parallel ranges if it is large."""
+        ranges, s3_content = split_file(s3_key)
+        if ranges is None:
+            yield from transform_records(etree.fromstring(s3_content))
+            return
+        for range_results in ranges:
+            yield from range_results
+
+    record_count = 0
+    skipped = 0
+    for s3_key in s3_keys:
         filename = s3_key.replace(source_prefix, dest_prefix)
-        transformed_xml = etree.tostring(transformed, encoding="utf-8")
+        fingerprint = fingerprints.get(s3_key)
+        written = process.written_from(bucket, filename, fingerprint, access_id, access_secret)
+        if written is not None:
+            logging.info("Skipping File %s: %s is up to date", s3_key, filename)
+            record_count += int(written.get("tulflow-records") or 0)
+            skipped += 1
+            continue
+        logging.info("Transforming File %s", s3_key)
+        # Each destination file holds only its own source file's records; the engine's output
+        # is written into one buffer as it comes, with only the record id added to it, & the
+        # buffer itself is uploaded.
+        transformed_xml = io.BytesIO()
+        transformed_xml.write(collection_start)
+        file_records = 0
+        for result in transform_file(s3_key):
+            transformed_xml.write(result)
+            file_records += 1
+        transformed_xml.write(collection_end)
+        record_count += file_records
         process.generate_s3_object(
             transformed_xml,
             bucket,
             filename,
             access_id,
             access_secret,
+            metadata=process.fingerprint_metadata(fingerprint, records=file_records),
+        )
+    record_log.close()
+    if kwargs.get("incremental"):
+        logging.info("Skipped %s up to date files", skipped)
+        return {"transformed": record_count, "skipped": skipped}
+    return {"transformed": record_count}
+
+
+def stylesheet_digest(engine, **kwargs):
+    """SHA1 of the stylesheet an engine runs; fetched for Saxon, which reads it by URL."""
+    stylesheet = getattr(engine, "stylesheet", None)
+    if stylesheet is None:
+        stylesheet = process.get_github_content(
+            kwargs.get("xsl_repository", "tulibraries/aggregator_mdx"),
+            kwargs.get("xsl_filename"),
+            kwargs.get("xsl_branch", "main"),
         )
+    return hashlib.sha1(stylesheet).hexdigest()
+
+
+def with_record_id(result, record_id):
+    """Add the airflow-record-id attribute to a serialized XSLT result, ready to be written
+    inside a collection.
+
+    The attribute is spliced into the root start tag, so the result is not parsed & serialized
+    again, once it is seen to be one element (a root start tag, & the matching end tag closing
+    the result). Other results (e.g. other encodings, leading comments, or malformed &
+    multi-root output) are parsed instead, so bad output still raises XMLSyntaxError.
+    """
+    declaration = XML_DECLARATION.match(result)
+    fragment = result[declaration.end():].rstrip() if declaration else result.strip()
+    match = ROOT_START_TAG.match(fragment)
+    if (
+        match is None
+        or not is_one_element(fragment, match)
+        or b"airflow-record-id" in match.group(0)
+        or (declaration and not UTF8_DECLARATION.search(declaration.group(0)))
+    ):
+        element = etree.fromstring(result)
+        element.attrib["airflow-record-id"] = record_id
+        return etree.tostring(element, encoding="utf-8")
+    end = match.end() - len(match.group(2)) - 1
+    attribute = f' airflow-record-id="{record_id.translate(ATTRIBUTE_ESCAPES)}"'.encode("utf-8")
+    return fragment[:end] + attribute + fragment[end:]
+
+
+def is_one_element(fragment, start_tag):
+    """Check a serialized result is its root element only: one empty element tag, or ending in
+    the root's end tag with no other tag of the root's name in between."""
+    if start_tag.group(2):
+        return start_tag.end() == len(fragment)
+    end_tag = LAST_END_TAG.search(fragment, start_tag.end())
+    if end_tag is None or end_tag.group(1) != start_tag.group(1):
+        return False
+    # Another tag of the root's name may mean several roots, e.g. <r></r><r></r>; such rare
+    # results are parsed instead.
+    inner = fragment[start_tag.end():end_tag.start()]
+    return re.search(rb"</?" + re.escape(start_tag.group(1)) + rb"[\s/>]", inner) is None
 
 
-def prepare_saxon_engine(saxon_jar="saxon.jar", saxon_path="/tmp/saxon/"):
-    """Set up Saxon HE 9 Java Engine for XML & XSL tasks."""
-    saxon_version = "12.5"
-    saxon_download_sha1 = "57c007520e2879387b8d13d0a512e9566eeffa73"
+def transform_s3_xsl_shard(s3_keys, shard, **kwargs):
+    """Airflow mapped task callable: transform_s3_xsl over one shard of the source keys."""
+    logging.info("Transforming shard %s: %s files", shard, len(s3_keys))
+    return transform_s3_xsl(**dict(kwargs, s3_keys=s3_keys))
 
-    if not os.path.exists(saxon_path + saxon_jar):
-        Path(saxon_path).mkdir(parents=True, exist_ok=True)
+
+def merge_transform_shards(shard_results, **_kwargs):
+    """Reduce transform_s3_xsl_shard results to one transform_s3_xsl return value, with the
+    counts (transformed, skipped) & metrics of every shard."""
+    return metrics.merge_results(shard_results)
+
+
+def prepare_saxon_engine(saxon_jar="saxon.jar", saxon_path=None, saxon_jar_path=None):
+    """Set up Saxon HE Java Engine for XML & XSL tasks, returning the jar's path.
+
+    A pre-baked saxon_jar_path (or TULFLOW_SAXON_JAR) is used as is. Otherwise the jar is
+    downloaded once into saxon_path (or TULFLOW_SAXON_CACHE_DIR, default /tmp/saxon/), under a
+    file lock & renamed into place once its SHA1 is verified; the verified digest is kept in a
+    .sha1 sidecar so later calls, from any process, only compare it.
+    """
+    saxon_jar_path = saxon_jar_path or os.environ.get("TULFLOW_SAXON_JAR")
+    if saxon_jar_path:
+        if not os.path.exists(saxon_jar_path):
+            raise FileNotFoundError(f"Saxon jar {saxon_jar_path} does not exist.")
+        return saxon_jar_path
+    saxon_path = saxon_path or os.environ.get("TULFLOW_SAXON_CACHE_DIR") or "/tmp/saxon/"
+    jar_path = os.path.join(saxon_path, saxon_jar)
+    if saxon_jar_verified(jar_path):
+        return jar_path
+
+    Path(saxon_path).mkdir(parents=True, exist_ok=True)
+    with open(jar_path + ".lock", "w", encoding="utf-8") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if saxon_jar_verified(jar_path):
+            return jar_path
+        if os.path.exists(jar_path) and file_sha1(jar_path) == SAXON_SHA1:
+            write_atomically(jar_path + ".sha1", SAXON_SHA1.encode("utf-8"))
+            return jar_path
         request_url = "https://repo1.maven.org/maven2/net/sf/saxon/Saxon-HE/"
-        request_url += saxon_version + "/Saxon-HE-" + saxon_version + ".jar"
-        resp = requests.get(
-            request_url,
-            allow_redirects=True,
-            verify=False,
-            timeout=30,
-        )
-        if hashlib.sha1(resp.content).hexdigest() == saxon_download_sha1:
-            with open(saxon_path + saxon_jar, "wb") as saxon_file:
-                saxon_file.write(resp.content)
-            os.chmod(saxon_path + saxon_jar, 0o744)
-            return saxon_path + saxon_jar
-        logging.fatal("SHA1 Digests do not match.")
-        sys.exit()
-    return saxon_path + saxon_jar
+        request_url += SAXON_VERSION + "/Saxon-HE-" + SAXON_VERSION + ".jar"
+        import requests  # pylint: disable=import-outside-toplevel
+        logging.info("Downloading Saxon HE %s to %s", SAXON_VERSION, jar_path)
+        resp = requests.get(request_url, allow_redirects=True, timeout=30)
+        resp.raise_for_status()
+        if hashlib.sha1(resp.content).hexdigest() != SAXON_SHA1:
+            logging.fatal("SHA1 Digests do not match.")
+            sys.exit()
+        write_atomically(jar_path, resp.content, mode=0o744)
+        write_atomically(jar_path + ".sha1", SAXON_SHA1.encode("utf-8"))
+    return jar_path
+
+
+def saxon_jar_verified(jar_path):
+    """Whether the jar is in place with a sidecar recording its verified SHA1."""
+    try:
+        with open(jar_path + ".sha1", encoding="utf-8") as sidecar:
+            verified = sidecar.read().strip() == SAXON_SHA1
+    except FileNotFoundError:
+        return False
+    return verified and os.path.exists(jar_path)
+
+
+def file_sha1(path):
+    """SHA1 hex digest of a file, read in blocks."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as checked_file:
+        for block in iter(lambda: checked_file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_atomically(path, content, mode=0o644):
+    """Write a file beside its destination & rename it into place, so readers never see
+    part of it."""
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as temp_file:
+        temp_file.write(content)
+    try:
+        os.chmod(temp_file.name, mode)
+        os.replace(temp_file.name, path)
+    except OSError:
+        os.remove(temp_file.name)
+        raise
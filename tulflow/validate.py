@@ -1,14 +1,89 @@
 """Generic Data (primarily XML & JSON) Validation Methods."""
 import logging
 import csv
+import hashlib
 import io
-from airflow.sdk.exceptions import AirflowFailException
 from lxml import etree, isoschematron
-from tulflow import process
+from tulflow import harvest, metrics, process
 
 
+@metrics.instrumented("filter_s3_schematron")
 def filter_s3_schematron(**kwargs):
     """Wrapper function for using S3 Retrieval, Schematron Filtering, and S3 Writer."""
+    counts = schematron_filter_s3(**kwargs)
+    if counts["filtered"] == counts["records"] and counts["records"] != 0:
+        raise all_filtered_error(counts["records"])
+    return {"filtered": counts["filtered"]}
+
+
+def all_filtered_error(record_count):
+    """The AirflowFailException failing a task that filtered out every record; Airflow is
+    imported only then, not with this module at DAG parse time."""
+    # pylint: disable=import-outside-toplevel
+    from airflow.sdk.exceptions import AirflowFailException
+    return AirflowFailException(f"All records were filtered out: {record_count}")
+
+
+def filter_s3_schematron_shard(s3_keys, shard, **kwargs):
+    """Airflow mapped task callable: Schematron Filtering of one shard of the source keys,
+    reporting invalid records to a per-shard CSV for merge_schematron_shards."""
+    report_prefix = f"{kwargs.get('report_prefix')}-shard-{shard}"
+    # Invalid records of files skipped by an incremental rerun are kept from the merged report.
+    previous_report = kwargs.get("report_prefix") + "-invalid.csv"
+    return schematron_filter_s3(
+        **dict(kwargs, s3_keys=s3_keys, report_prefix=report_prefix, previous_report=previous_report)
+    )
+
+
+def merge_schematron_shards(shard_results, **kwargs):
+    """Reduce filter_s3_schematron_shard results to one invalid records CSV & the
+    filter_s3_schematron return value."""
+    bucket = kwargs.get("bucket")
+    access_id = kwargs.get("access_id")
+    access_secret = kwargs.get("access_secret")
+    shard_results = list(shard_results)
+    total_filter_count = sum(result["filtered"] for result in shard_results)
+    total_record_count = sum(result["records"] for result in shard_results)
+
+    merged_csv = io.StringIO()
+    for result in shard_results:
+        report = process.get_s3_content(bucket, result["report"], access_id, access_secret)
+        if report is None:
+            continue
+        lines = report.decode("utf-8").splitlines(keepends=True)
+        merged_csv.writelines(lines[1:] if merged_csv.tell() else lines)
+        process.remove_s3_object(bucket, result["report"], access_id, access_secret)
+    invalid_filename = kwargs.get("report_prefix") + "-invalid.csv"
+    logging.info("Total Filter Count: %s", total_filter_count)
+    logging.info(
+        "Invalid Records report: https://%s.s3.amazonaws.com/%s",
+        bucket,
+        invalid_filename,
+    )
+    # Shard reports are gone when a retried merge already wrote the merged report.
+    if merged_csv.tell():
+        process.generate_s3_object(
+            merged_csv.getvalue(),
+            bucket,
+            invalid_filename,
+            access_id,
+            access_secret,
+        )
+    if total_filter_count == total_record_count and total_record_count != 0:
+        raise all_filtered_error(total_record_count)
+    return {"filtered": total_filter_count}
+
+
+def schematron_filter_s3(**kwargs):
+    """S3 Retrieval, Schematron Filtering & S3 Writer of the source keys (all keys under the
+    source prefix, or the given s3_keys); returns filtered & record counts and the report key.
+    With manifest_key, the keys under the source prefix are read from the harvest's run
+    manifest instead of listed.
+
+    With incremental set, files already filtered from the same source ETag & schematron are
+    skipped, their counts read from the destination's metadata & their invalid records carried
+    over from the previous report (previous_report, by default this run's report key).
+    """
     source_prefix = kwargs.get("source_prefix")
     dest_prefix = kwargs.get("destination_prefix")
     report_prefix = kwargs.get("report_prefix")
@@ -40,14 +115,34 @@ def filter_s3_schematron(**kwargs):
         etree.fromstring(schematron_doc),
         store_report=True,
     )
+    fingerprints = {}
+    if kwargs.get("incremental"):
+        fingerprints = process.source_fingerprints(
+            bucket,
+            access_id,
+            access_secret,
+            source_prefix,
+            hashlib.sha1(schematron_doc).hexdigest(),
+        )
     total_filter_count = 0
     total_record_count = 0
-    for s3_key in process.list_s3_content(
-        bucket,
-        access_id,
-        access_secret,
-        source_prefix,
-    ):
+    skipped_files = set()
+    s3_keys = kwargs.get("s3_keys")
+    if s3_keys is None:
+        s3_objects = harvest.s3_content_sizes(
+            bucket, access_id, access_secret, source_prefix, kwargs.get("manifest_key")
+        )
+        s3_keys = [key for (key, _) in s3_objects or []]
+    for s3_key in s3_keys:
+        filename = s3_key.replace(source_prefix, dest_prefix)
+        fingerprint = fingerprints.get(s3_key)
+        written = process.written_from(bucket, filename, fingerprint, access_id, access_secret)
+        if written is not None:
+            logging.info("Skipping File %s: %s is up to date", s3_key, filename)
+            total_record_count += int(written.get("tulflow-records") or 0)
+            total_filter_count += int(written.get("tulflow-filtered") or 0)
+            skipped_files.add(source_file_url(bucket, s3_key))
+            continue
         logging.info("Validating & Filtering File: %s", s3_key)
         s3_content = process.get_s3_content(
             bucket,
@@ -64,7 +159,9 @@ def filter_s3_schematron(**kwargs):
         for record in s3_xml.iterchildren():
             record_count += 1
             total_record_count += 1
-            if not schematron.validate(record):
+            with metrics.timer("schematron", records=1):
+                valid = schematron.validate(record)
+            if not valid:
                 record_id = record.get("airflow-record-id")
                 logging.error("Invalid record found: %s", record_id)
                 s3_xml.remove(record)
@@ -76,14 +173,10 @@ def filter_s3_schematron(**kwargs):
                             schematron.validation_report
                         ),
                         "record": identifier_or_full_record(record),
-                        "source_file": (
-                            f"https://s3.console.aws.amazon.com/s3/object/"
-                            f"{bucket}/{s3_key}"
-                        ),
+                        "source_file": source_file_url(bucket, s3_key),
                     }
                 )
         total_filter_count += filter_count
-        filename = s3_key.replace(source_prefix, dest_prefix)
         updated_s3_xml = etree.tostring(
             s3_xml,
             encoding="utf-8",
@@ -94,6 +187,9 @@ def filter_s3_schematron(**kwargs):
             filename,
             access_id,
             access_secret,
+            metadata=process.fingerprint_metadata(
+                fingerprint, records=record_count, filtered=filter_count
+            ),
         )
         if filter_count == record_count and record_count != 0:
             logging.warning(
@@ -103,6 +199,10 @@ def filter_s3_schematron(**kwargs):
             )
 
     invalid_filename = report_prefix + "-invalid.csv"
+    previous_report = kwargs.get("previous_report") or invalid_filename
+    invalid_csv.writerows(
+        report_rows(bucket, previous_report, access_id, access_secret, skipped_files)
+    )
     logging.info("Total Filter Count: %s", total_filter_count)
     logging.info(
         "Invalid Records report: https://%s.s3.amazonaws.com/%s",
@@ -116,13 +216,34 @@ def filter_s3_schematron(**kwargs):
         access_id,
         access_secret,
     )
-    if total_filter_count == total_record_count and total_record_count != 0:
-        raise AirflowFailException(
-            f"All records were filtered out: {total_record_count}"
-        )
-    return {"filtered": total_filter_count}
+    counts = {
+        "filtered": total_filter_count,
+        "records": total_record_count,
+        "report": invalid_filename,
+    }
+    if kwargs.get("incremental"):
+        logging.info("Skipped %s up to date files", len(skipped_files))
+        counts["skipped"] = len(skipped_files)
+    return counts
+
+
+def source_file_url(bucket, s3_key):
+    """S3 console link to a source file, as listed in invalid records reports."""
+    return f"https://s3.console.aws.amazon.com/s3/object/{bucket}/{s3_key}"
+
+
+def report_rows(bucket, key, access_id, access_secret, source_files):
+    """Rows of an invalid records report CSV listing records of the given source files."""
+    if not source_files:
+        return []
+    report = process.get_s3_content(bucket, key, access_id, access_secret)
+    if report is None:
+        return []
+    rows = csv.DictReader(io.StringIO(report.decode("utf-8")))
+    return [row for row in rows if row["source_file"] in source_files]
 
 
+@metrics.instrumented("report_s3_schematron")
 def report_s3_schematron(**kwargs):  # pylint: disable=too-many-locals
     """Wrapper function for using S3 Retrieval, Schematron Reporting, and S3 Writer."""
     source_prefix = kwargs.get("source_prefix")
@@ -149,6 +270,7 @@ def report_s3_schematron(**kwargs):  # pylint: disable=too-many-locals
     )
 
     total_transform_count = 0
+    record_log = metrics.record_logger("Reported on", **kwargs)
     for s3_key in process.list_s3_content(
         bucket,
         access_id,
@@ -166,8 +288,9 @@ def report_s3_schematron(**kwargs):  # pylint: disable=too-many-locals
         for record in s3_xml.iterchildren():
             total_transform_count += 1
             record_id = record.get("airflow-record-id")
-            logging.info("Ran report on record: %s", record_id)
-            schematron.validate(record)
+            record_log.log("Ran report on record: %s", record_id)
+            with metrics.timer("schematron", records=1):
+                schematron.validate(record)
             report_csv.writerow(
                 {
                     "id": record_id,
@@ -181,6 +304,7 @@ def report_s3_schematron(**kwargs):  # pylint: disable=too-many-locals
                     ),
                 }
             )
+    record_log.close()
     report_filename = dest_prefix + "-report.csv"
     logging.info(
         "Records report: https://%s.s3.amazonaws.com/%s",